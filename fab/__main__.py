@@ -0,0 +1,8 @@
+"""
+Allow running FAB with ``python -m fab``.
+"""
+
+import sys
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+In-memory editing of the passwd, group, shadow and gshadow databases of a root tree.
+"""
+
+import os
+import time
+import fcntl
+import shutil
+import logging
+import contextlib
+
+# Defaults used by shadow-utils when login.defs does not set them
+LOGIN_DEFS_DEFAULTS = {
+    'UID_MIN': 1000,
+    'UID_MAX': 60000,
+    'GID_MIN': 1000,
+    'GID_MAX': 60000,
+    'PASS_MIN_DAYS': 0,
+    'PASS_MAX_DAYS': 99999,
+    'PASS_WARN_AGE': 7,
+}
+
+# Field counts of each database, and mode for files that do not exist yet
+DATABASES = {
+    'passwd': (7, 0o644),
+    'group': (4, 0o644),
+    'shadow': (9, 0o000),
+    'gshadow': (4, 0o000),
+}
+
+
+class AccountError(Exception):
+    """Exception raised when an account change conflicts with the existing databases."""
+    pass
+
+
+class AccountTable:
+    """
+    One colon-separated database, with lookups by name and (for passwd/group) by id
+    """
+
+    def __init__(self, path, fields, id_field=None):
+        self.path = path
+        self.fields = fields
+        self.id_field = id_field
+        self.entries = []
+        self.by_name = {}
+        self.by_id = {}
+        self.exists = os.path.exists(path)
+        self.dirty = False
+        if self.exists:
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if not line:
+                        continue
+                    fields = line.split(':')
+                    if len(fields) < self.fields:
+                        fields += [''] * (self.fields - len(fields))
+                    self._index(fields)
+
+    def _index(self, fields):
+        self.entries.append(fields)
+        self.by_name.setdefault(fields[0], fields)
+        if self.id_field is not None:
+            try:
+                self.by_id.setdefault(int(fields[self.id_field]), fields)
+            except ValueError:
+                pass
+
+    def add(self, fields):
+        self._index(fields)
+        self.dirty = True
+
+    def touch(self):
+        self.dirty = True
+
+    def ids(self):
+        return self.by_id.keys()
+
+    def write(self, default_mode):
+        """
+        Atomically replace the file, keeping its mode and ownership
+        """
+        directory = os.path.dirname(self.path)
+        tmp = os.path.join(directory, '+' + os.path.basename(self.path))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(':'.join(fields) + '\n' for fields in self.entries))
+                f.flush()
+                os.fsync(f.fileno())
+            if self.exists:
+                stat = os.stat(self.path)
+                os.chmod(tmp, stat.st_mode & 0o7777)
+                if os.geteuid() == 0:
+                    os.chown(tmp, stat.st_uid, stat.st_gid)
+            else:
+                os.chmod(tmp, default_mode)
+            os.replace(tmp, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+        self.dirty = False
+        self.exists = True
+
+
+class AccountDatabase:
+    """
+    The account databases of a root tree, loaded once and written back once.
+
+    Groups and users are added in memory with the same rules as groupadd and
+    useradd (unique names and ids, ids allocated from the login.defs ranges,
+    per-user private groups), then ``commit()`` writes each changed file with a
+    single atomic rename while holding the shadow-utils lock.
+    """
+
+    def __init__(self, root='/'):
+        self.root = root
+        self.etc = os.path.join(root, 'etc')
+        self.defs = self._read_login_defs()
+        self.passwd = AccountTable(os.path.join(self.etc, 'passwd'), DATABASES['passwd'][0], id_field=2)
+        self.group = AccountTable(os.path.join(self.etc, 'group'), DATABASES['group'][0], id_field=2)
+        self.shadow = AccountTable(os.path.join(self.etc, 'shadow'), DATABASES['shadow'][0])
+        self.gshadow = AccountTable(os.path.join(self.etc, 'gshadow'), DATABASES['gshadow'][0])
+        self.homes = []
+
+    def _read_login_defs(self):
+        defs = dict(LOGIN_DEFS_DEFAULTS)
+        try:
+            with open(os.path.join(self.etc, 'login.defs'), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and not parts[0].startswith('#'):
+                        defs[parts[0]] = parts[1]
+        except FileNotFoundError:
+            pass
+        return defs
+
+    def _def(self, name):
+        return int(self.defs.get(name, LOGIN_DEFS_DEFAULTS.get(name, 0)))
+
+    def _allocate(self, used, minimum, maximum):
+        """
+        Pick an id like shadow-utils: one above the highest id in range, else the first free one
+        """
+        in_range = [i for i in used if minimum <= i <= maximum]
+        candidate = max(in_range) + 1 if in_range else minimum
+        if candidate <= maximum:
+            return candidate
+        for candidate in range(minimum, maximum + 1):
+            if candidate not in used:
+                return candidate
+        raise AccountError('No free id left between {} and {}'.format(minimum, maximum))
+
+    def allocate_gid(self):
+        return self._allocate(set(self.group.ids()), self._def('GID_MIN'), self._def('GID_MAX'))
+
+    def allocate_uid(self):
+        return self._allocate(set(self.passwd.ids()), self._def('UID_MIN'), self._def('UID_MAX'))
+
+    def add_group(self, name, gid=None):
+        """
+        Add a group, returning its gid
+        """
+        if name in self.group.by_name:
+            raise AccountError("group '{}' already exists".format(name))
+        if gid is None:
+            gid = self.allocate_gid()
+        elif gid in self.group.by_id:
+            raise AccountError("GID '{}' already exists (group '{}')".format(gid, self.group.by_id[gid][0]))
+        self.group.add([name, 'x', str(gid), ''])
+        self.gshadow.add([name, '!', '', ''])
+        return gid
+
+    def _group_entry(self, group):
+        """Find a group by name or gid."""
+        entry = self.group.by_name.get(str(group))
+        if entry is None:
+            try:
+                entry = self.group.by_id.get(int(group))
+            except ValueError:
+                entry = None
+        if entry is None:
+            raise AccountError("group '{}' does not exist".format(group))
+        return entry
+
+    def add_user(self, name, uid=None, gid=None, groups=(), homedir=None, shell=None, gecos='', password=None,
+                 lock=False, create_home=True):
+        """
+        Add a user, returning its uid
+
+        Args:
+            password: already hashed password, None for a locked account without one
+        """
+        if name in self.passwd.by_name:
+            raise AccountError("user '{}' already exists".format(name))
+        if uid is not None and uid in self.passwd.by_id:
+            raise AccountError("UID '{}' already exists (user '{}')".format(uid, self.passwd.by_id[uid][0]))
+        supplementary = [self._group_entry(group) for group in groups]
+        if uid is None:
+            uid = self.allocate_uid()
+
+        if gid is not None:
+            primary = int(self._group_entry(gid)[2])
+        else:
+            # private group named after the user, reusing the uid as gid when it is free
+            if name in self.group.by_name:
+                raise AccountError("group '{}' already exists - use --gid to add the user to it".format(name))
+            primary = self.add_group(name, uid if uid not in self.group.by_id else None)
+
+        homedir = homedir or os.path.join(self.defs.get('HOME', '/home'), name)
+        shell = shell or self.defs.get('SHELL', '/bin/bash')
+        self.passwd.add([name, 'x', str(uid), str(primary), gecos or '', homedir, shell])
+
+        if password is None:
+            password = '!'
+        elif lock:
+            password = '!' + password
+        lastchg = str(int(time.time() // 86400))
+        self.shadow.add([name, password, lastchg, str(self._def('PASS_MIN_DAYS')), str(self._def('PASS_MAX_DAYS')),
+                         str(self._def('PASS_WARN_AGE')), '', '', ''])
+
+        for entry in supplementary:
+            members = [m for m in entry[3].split(',') if m]
+            if name not in members:
+                entry[3] = ','.join(members + [name])
+                self.group.touch()
+                shadow_entry = self.gshadow.by_name.get(entry[0])
+                if shadow_entry is not None:
+                    shadow_entry[3] = ','.join([m for m in shadow_entry[3].split(',') if m] + [name])
+                    self.gshadow.touch()
+        if create_home:
+            self.homes.append((homedir, uid, primary))
+        return uid
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self.etc, exist_ok=True)
+        with open(os.path.join(self.etc, '.pwd.lock'), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            yield
+
+    def _create_home(self, homedir, uid, gid):
+        path = os.path.join(self.root, homedir.lstrip('/'))
+        if os.path.lexists(path):
+            return
+        skel = os.path.join(self.etc, 'skel')
+        if os.path.isdir(skel):
+            shutil.copytree(skel, path, symlinks=True)
+        else:
+            os.makedirs(path)
+        os.chmod(path, 0o700)
+        if os.geteuid() == 0:
+            for directory, dirs, files in os.walk(path):
+                for entry in [directory] + [os.path.join(directory, name) for name in dirs + files]:
+                    os.lchown(entry, uid, gid)
+
+    def commit(self):
+        """
+        Write every changed database back exactly once and create the new home directories
+        """
+        with self._locked():
+            for name, (_, mode) in DATABASES.items():
+                table = getattr(self, name)
+                if table.dirty:
+                    logging.debug('Writing {} ({} entries)'.format(table.path, len(table.entries)))
+                    table.write(mode)
+        for homedir, uid, gid in self.homes:
+            self._create_home(homedir, uid, gid)
+        self.homes = []
@@ -0,0 +1,303 @@
+"""
+Benchmarks for fab itself.
+
+Every suite runs offline: builds use the stub container tool from
+fab/stubtool.py, kickstarts are applied to a temporary root.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import contextlib
+import statistics
+import subprocess
+
+SAMPLE_KICKSTART = 'group --name fabbers\nuser --name fab --groups fabbers\n'
+
+# Subcommand invocations timed by startup(); {dir} is a scratch directory
+STARTUP_COMMANDS = {
+    'help': ['--help'],
+    'version': ['version'],
+    'kickstart': ['kickstart', '{dir}/bench.ks', '--dry-run'],
+    'catalog': ['catalog', 'index', '{dir}'],
+}
+
+SUITES = ('startup', 'plan', 'build', 'logs', 'kickstart', 'crypt')
+
+RESULTS_VERSION = 1
+
+# Relative change against a baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def startup(commands=None, runs=5, command=None):
+    """
+    Measure cold-start time of each subcommand, every run in a fresh interpreter
+
+    Args:
+        commands: name -> argument list, STARTUP_COMMANDS if None
+        runs: number of runs per command
+        command: how to start fab, ``python -m fab`` if None
+
+    Returns:
+        Dict of name -> (best, median) wall time in seconds
+    """
+    commands = commands or STARTUP_COMMANDS
+    command = command or [sys.executable, '-m', 'fab']
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'bench.ks'), 'w') as f:
+            f.write(SAMPLE_KICKSTART)
+        for name, args in commands.items():
+            args = [arg.format(dir=directory) for arg in args]
+            times = []
+            for _ in range(runs):
+                start = time.monotonic()
+                subprocess.run(command + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append(time.monotonic() - start)
+            results[name] = (min(times), statistics.median(times))
+    return results
+
+
+def generate_fabfile(directory, modules=15, buildargs=10):
+    """
+    Write a Fabfile including modules synthetic modules whose Containerfiles declare buildargs ARGs
+
+    Returns:
+        Path of the Fabfile
+    """
+    names = ['ARG{}'.format(i) for i in range(buildargs)]
+    includes = []
+    for index in range(modules):
+        module_dir = os.path.join(directory, 'modules', 'mod{}'.format(index))
+        os.makedirs(module_dir)
+        with open(os.path.join(module_dir, 'mod{}.yaml'.format(index)), 'w') as f:
+            f.write('metadata:\n  name: mod{0}\n  description: Synthetic module {0}\n'
+                    'containerfile: Containerfile\nbuildargs:\n'.format(index))
+            f.write(''.join('  - {}\n'.format(name) for name in names))
+        with open(os.path.join(module_dir, 'Containerfile'), 'w') as f:
+            f.write(''.join('ARG {}\n'.format(name) for name in names))
+            f.write('RUN echo module {} {}\n'.format(index, ' '.join('${}'.format(name) for name in names)))
+        with open(os.path.join(module_dir, 'payload.txt'), 'w') as f:
+            f.write('payload {}\n'.format(index) * 256)
+        includes.append(os.path.join(module_dir, 'mod{}.yaml'.format(index)))
+    path = os.path.join(directory, 'Fabfile')
+    with open(path, 'w') as f:
+        f.write('metadata:\n  name: bench\n  description: Synthetic Fabfile\n'
+                'from: localhost/bench-base:latest\nbuildargs:\n')
+        f.write(''.join('  - {}: value{}\n'.format(name, i) for i, name in enumerate(names)))
+        f.write('include:\n' + ''.join('  - {}\n'.format(include) for include in includes))
+    return path
+
+
+def generate_kickstart(path, users=1000, groups=None):
+    """
+    Write a kickstart creating groups groups and users users, each user in one group
+    """
+    groups = users if groups is None else groups
+    with open(path, 'w') as f:
+        for index in range(groups):
+            f.write('group --name bgroup{}\n'.format(index))
+        for index in range(users):
+            f.write('user --name buser{} --groups bgroup{} --password $6$bench$x --iscrypted\n'.format(
+                index, index % max(1, groups)))
+
+
+def make_root(directory):
+    """
+    Create a minimal root tree with account databases for kickstart runs
+    """
+    etc = os.path.join(directory, 'etc')
+    os.makedirs(etc)
+    for name, content in (('passwd', 'root:x:0:0:root:/root:/bin/bash\n'), ('group', 'root:x:0:\n'),
+                          ('shadow', 'root:!::0:99999:7:::\n'), ('gshadow', 'root:::\n')):
+        with open(os.path.join(etc, name), 'w') as f:
+            f.write(content)
+    return directory
+
+
+@contextlib.contextmanager
+def _environment(**values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update({name: str(value) for name, value in values.items()})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+class BenchSuite:
+    """
+    Runs the benchmark suites and collects their metrics.
+
+    Metrics are keyed by name and carry a value, a unit and whether lower or
+    higher values are better, so results can be compared against a baseline.
+    """
+
+    def __init__(self, modules=15, buildargs=10, users=1000, stub_latency=0.05, stub_lines=200, log_mb=64,
+                 runs=5):
+        self.modules = modules
+        self.buildargs = buildargs
+        self.users = users
+        self.stub_latency = stub_latency
+        self.stub_lines = stub_lines
+        self.log_mb = log_mb
+        self.runs = runs
+        self.metrics = {}
+
+    def run(self, suites=SUITES):
+        with tempfile.TemporaryDirectory(prefix='fab-bench-') as directory:
+            for suite in suites:
+                workdir = os.path.join(directory, suite)
+                os.makedirs(workdir)
+                getattr(self, 'bench_{}'.format(suite))(workdir)
+        return self.results()
+
+    def results(self):
+        return {
+            'version': RESULTS_VERSION,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'parameters': {'modules': self.modules, 'buildargs': self.buildargs, 'users': self.users,
+                           'stub_latency': self.stub_latency, 'stub_lines': self.stub_lines,
+                           'log_mb': self.log_mb},
+            'metrics': self.metrics,
+        }
+
+    def bench_startup(self, workdir):
+        for name, (_, median) in startup(runs=self.runs).items():
+            self.metrics['startup_{}_s'.format(name)] = _metric(median, 's')
+
+    def _builder(self, workdir):
+        from .builder import StageBuilder
+        from .cache import StageCache
+        from .logstream import QUIET, LogConsole
+        from .stubtool import install
+        return StageBuilder(install(workdir), cache=StageCache(os.path.join(workdir, 'stages.json')),
+                            console=LogConsole(QUIET, stream=io.StringIO()),
+                            log_dir=os.path.join(workdir, 'logs'))
+
+    def _load(self, workdir):
+        from .fabfile import FabFile
+        from .module import DEFINITIONS
+        path = generate_fabfile(workdir, self.modules, self.buildargs)
+        DEFINITIONS.entries.clear()
+        start = time.monotonic()
+        fabfile = FabFile(path)
+        return fabfile, time.monotonic() - start
+
+    def bench_plan(self, workdir):
+        from .matrix import StageTree
+        fabfile, load_time = self._load(workdir)
+        self.metrics['yaml_load_s'] = _metric(load_time, 's')
+        builder = self._builder(workdir)
+        start = time.monotonic()
+        tree = StageTree(fabfile.images())
+        parent = 'sha256:' + '0' * 64
+        for node in tree.stages():
+            parent = builder.stage_key(node.module, parent, node.buildargs)
+        self.metrics['plan_s'] = _metric(time.monotonic() - start, 's')
+
+    def bench_build(self, workdir):
+        from .matrix import MatrixBuild
+        fabfile, _ = self._load(workdir)
+        builder = self._builder(workdir)
+        with _environment(FAB_STUB_STATE=os.path.join(workdir, 'stub.json'), FAB_STUB_LATENCY=self.stub_latency,
+                          FAB_STUB_LINES=self.stub_lines):
+            start = time.monotonic()
+            if not MatrixBuild(fabfile.images(), builder).build():
+                raise RuntimeError('Benchmark build failed, logs in {}'.format(builder.log_dir))
+            elapsed = time.monotonic() - start
+            start = time.monotonic()
+            MatrixBuild(fabfile.images(), builder).build()
+            cached = time.monotonic() - start
+        stages = max(1, self.modules)
+        self.metrics['build_s'] = _metric(elapsed, 's')
+        self.metrics['build_overhead_per_stage_s'] = _metric(max(0.0, elapsed / stages - self.stub_latency), 's')
+        self.metrics['cached_build_s'] = _metric(cached, 's')
+
+    def bench_logs(self, workdir):
+        from .logstream import QUIET, LogConsole, StageLog, stream
+        script = ('import sys\nline = b"x" * 99 + b"\\n"\nblock = line * 10240\n'
+                  'for _ in range({}): sys.stdout.buffer.write(block)\n'.format(self.log_mb))
+        process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        log = StageLog('bench', workdir)
+        start = time.monotonic()
+        stream(process, log, LogConsole(QUIET, stream=io.StringIO()))
+        elapsed = time.monotonic() - start
+        self.metrics['log_stream_mb_per_s'] = _metric(log.byte_count / elapsed / 1024 / 1024, 'MB/s', 'higher')
+
+    def bench_kickstart(self, workdir):
+        from .kickstart import FabKickstart
+        path = os.path.join(workdir, 'bench.ks')
+        generate_kickstart(path, self.users)
+        root = make_root(os.path.join(workdir, 'root'))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.monotonic()
+            rc = FabKickstart(path, root=root).handle_kickstart()
+            elapsed = time.monotonic() - start
+        if rc != 0:
+            raise RuntimeError('Benchmark kickstart failed')
+        self.metrics['kickstart_s'] = _metric(elapsed, 's')
+        self.metrics['kickstart_entries_per_s'] = _metric(self.users * 2 / elapsed, 'entries/s', 'higher')
+
+    def bench_crypt(self, workdir):
+        from .sha512crypt import benchmark
+        (_, rate), = benchmark(count=max(8, os.cpu_count() or 1) * 4, workers=(os.cpu_count() or 1,))
+        self.metrics['password_hashes_per_s'] = _metric(rate, 'hashes/s', 'higher')
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare results with a baseline
+
+    Returns:
+        List of messages, one per metric worse than the baseline by more than threshold
+    """
+    regressions = []
+    for name, metric in results['metrics'].items():
+        base = baseline.get('metrics', {}).get(name)
+        if base is None or not base['value']:
+            continue
+        change = metric['value'] / base['value'] - 1
+        worse = change if metric['better'] == 'lower' else -change
+        if worse > threshold:
+            regressions.append('{}: {:.4g} {} vs baseline {:.4g} ({:+.1%})'.format(
+                name, metric['value'], metric['unit'], base['value'], change))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = []
+    for name, metric in sorted(results['metrics'].items()):
+        line = '  {:<30} {:>12.4g} {:<9}'.format(name, metric['value'], metric['unit'])
+        base = (baseline or {}).get('metrics', {}).get(name)
+        if base and base['value']:
+            line += ' (baseline {:.4g}, {:+.1%})'.format(base['value'], metric['value'] / base['value'] - 1)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def write_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    for name, (best, median) in startup(command=sys.argv[1:] or None).items():
+        print('{:<10} best {:7.1f} ms   median {:7.1f} ms'.format(name, best * 1000, median * 1000))
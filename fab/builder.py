@@ -0,0 +1,403 @@
+"""
+Container tool plumbing shared by Fabfile builds.
+"""
+
+import os
+import logging
+import tempfile
+import threading
+import time
+from .cache import DigestCache, StageCache, hash_context, stage_key
+from .context import context_files, staged_context
+from .engine import CliEngine
+from .logstream import DEFAULT_TAIL, LogConsole, StageLog
+
+
+class StageBuilder:
+    """
+    Builds single stages with the container tool and keeps the stage cache up to date
+
+    Commands go through engine, the container tool CLI unless another backend is given.
+    """
+
+    def __init__(self, container_tool='/usr/bin/podman', tool_args="", stage_cache=True, cache=None,
+                 console=None, log_dir=None, log_tail=DEFAULT_TAIL, tracer=None, digests=None, engine=None):
+        self.container_tool = container_tool
+        self.tool_args = tool_args
+        self.engine = engine if engine is not None else CliEngine(container_tool, tool_args)
+        self.stage_cache = stage_cache
+        self.cache = cache if cache is not None else StageCache()
+        self.console = console if console is not None else LogConsole()
+        # stage logs live next to the stage cache index unless told otherwise
+        self.log_dir = log_dir if log_dir is not None else os.path.join(self.cache.path.parent, 'logs')
+        self.log_tail = log_tail
+        self.tracer = tracer
+        self.digests = digests if digests is not None else DigestCache(self.cache.path.parent / 'digests.json')
+        # pruned build contexts are staged here, next to the cache so files can be hard linked
+        self.context_dir = os.path.join(self.cache.path.parent, 'contexts')
+        self.logs = {}
+        # running container tool processes by label, and the labels cancelled
+        self._processes = {}
+        self.cancelled = set()
+        # (reference, platform, seconds, exit code) of every pull
+        self.pulls = []
+        self._images = None
+        self._lock = threading.Lock()
+
+    def _started(self, label, process):
+        with self._lock:
+            self._processes[label] = process
+            if label in self.cancelled:
+                process.terminate()
+
+    def run(self, args, cwd=None, label=None, span=None):
+        """
+        Run the container tool with args, streaming its output, and return the exit code
+
+        Runs given a label get their output saved to a log file named after it. When
+        tracing, runs given span arguments are recorded as a span carrying them.
+        """
+        start = time.monotonic()
+        if label is not None and label in self.cancelled:
+            return -1
+        if label is None:
+            log = StageLog(self.engine.name, tail=self.log_tail)
+        else:
+            log = StageLog(label, self.log_dir, self.log_tail)
+            self.logs[label] = log
+        started = (lambda process: self._started(label, process)) if label is not None else None
+        try:
+            rc = self.engine.run(args, cwd, log, self.console, started)
+        finally:
+            if label is not None:
+                with self._lock:
+                    self._processes.pop(label, None)
+        if self.tracer is not None and span is not None:
+            span = dict(span)
+            self.tracer.run(span.pop('name', label or log.name), span.pop('category', 'stage'), log, start, **span)
+        return rc
+
+    def cancel(self, label):
+        """
+        Stop the run labelled label if it is running, and keep it from starting otherwise
+        """
+        with self._lock:
+            self.cancelled.add(label)
+            process = self._processes.get(label)
+            if process is not None and process.poll() is None:
+                logging.info('Cancelling {}'.format(label))
+                process.terminate()
+
+    def pull(self, reference, platform=None):
+        """
+        Pull reference (for platform if given), record how long it took and return the exit code
+        """
+        start = time.monotonic()
+        if platform is None:
+            rc = self.run(['pull', reference], span={'name': 'pull {}'.format(reference), 'category': 'pull'})
+        else:
+            rc = self.run(['pull', '--platform', platform, reference],
+                          span={'name': 'pull {} ({})'.format(reference, platform), 'category': 'pull'})
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.pulls.append((reference, platform, elapsed, rc))
+        logging.info('Pulled {}{} in {:.1f}s'.format(reference, ' ({})'.format(platform) if platform else '', elapsed))
+        return rc
+
+    def available(self):
+        """
+        Return True if the container engine answers
+        """
+        return self._capture(['info', '--format', '{{.Host.Arch}}']) is not None
+
+    def _capture(self, args):
+        """
+        Run the container tool and return its stdout, or None if it failed
+        """
+        return self.engine.capture(args)
+
+    def _load_local_images(self):
+        """
+        List local images once so stage lookups don't need a container tool call each
+        """
+        images = {}
+        output = self._capture(['images', '--no-trunc', '--format', '{{.Repository}}:{{.Tag}} {{.ID}}'])
+        for line in (output or '').splitlines():
+            parts = line.split()
+            if len(parts) != 2 or '<none>' in parts[0]:
+                continue
+            images[parts[0]] = _image_id(parts[1])
+        self._images = images
+
+    def image_tags(self):
+        """
+        List the local images afresh and return the names pointing at each, by image ID
+        """
+        with self._lock:
+            self._load_local_images()
+            tags = {}
+            for name, image_id in self._images.items():
+                tags.setdefault(image_id, []).append(name)
+        return tags
+
+    def resolve_image(self, reference):
+        """
+        Return the local image ID for reference, or None if it is not present locally
+        """
+        with self._lock:
+            if self._images is None:
+                self._load_local_images()
+            for name in image_names(reference):
+                if name in self._images:
+                    return self._images[name]
+        output = self._capture(['image', 'inspect', '--format', '{{.Id}}', reference])
+        if output is None or not output.strip():
+            return None
+        image_id = _image_id(output.strip())
+        with self._lock:
+            self._images[reference] = image_id
+        return image_id
+
+    def image_sizes(self, ids):
+        """
+        Return the size in bytes of each local image in ids, by image ID
+        """
+        sizes = {}
+        ids = sorted(ids)
+        template = ['image', 'inspect', '--format', '{{.Id}} {{.Size}}']
+        output = self._capture(template + ids) if ids else ''
+        if output is None:
+            # one of them is gone: ask for each image on its own
+            output = ''.join(self._capture(template + [image_id]) or '' for image_id in ids)
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                sizes[_image_id(parts[0])] = int(parts[1])
+        return sizes
+
+    def resolve_base(self, reference, platform=None):
+        """
+        Return the image ID of a base image, pulling it first if it is not present locally
+
+        With a platform (os/arch[/variant]) the local image is only used if it is
+        for that platform, since one tag holds a single architecture locally.
+        """
+        if platform is not None:
+            return self._resolve_platform_base(reference, platform)
+        image_id = self.resolve_image(reference)
+        if image_id is None:
+            # pull the base up front so stage keys use its digest rather than a moving tag
+            self.pull(reference)
+            image_id = self.resolve_image(reference) or reference
+        return image_id
+
+    def _resolve_platform_base(self, reference, platform):
+        template = '{{.Id}} {{.Os}}/{{.Architecture}}'
+        wanted = '/'.join(platform.split('/')[:2])
+        output = self._capture(['image', 'inspect', '--format', template, reference])
+        if output is None or output.split()[1:] != [wanted]:
+            self.pull(reference, platform)
+            output = self._capture(['image', 'inspect', '--format', template, reference])
+        if output is None or output.split()[1:] != [wanted]:
+            logging.error('Could not get {} for {}'.format(reference, platform))
+            return None
+        return _image_id(output.split()[0])
+
+    def image_digest(self, reference):
+        """
+        Return the registry digest (sha256:...) of a local image, or None if it has none
+        """
+        output = self._capture(['image', 'inspect', '--format', '{{.Digest}}', reference])
+        digest = (output or '').strip()
+        return digest if digest.startswith('sha256:') else None
+
+    def resolve_pinned(self, base):
+        """
+        Return the image ID of a base pinned in a lock file without resolving its tag.
+
+        The pinned image is used if it is present locally; otherwise it is pulled
+        by digest. Returns None if neither is possible.
+        """
+        output = self._capture(['image', 'inspect', '--format', '{{.Id}}', base['id']])
+        if output is not None and _image_id(output.strip()) == base['id']:
+            return base['id']
+        if base.get('digest'):
+            reference = '{}@{}'.format(_repository(base['reference']), base['digest'])
+            if self.pull(reference) == 0:
+                return base['id']
+        return None
+
+    def stage_key(self, module, parent_id, buildargs):
+        context = hash_context(module.working_dir, context_files(module), self.digests)
+        self.digests.save()
+        return stage_key(parent_id, module.containerfile_path, context, used_buildargs(module, buildargs))
+
+    def build_stage(self, module, parent, parent_id, tag, buildargs, key=None, platform=None):
+        """
+        Build one module on top of parent and tag the result.
+
+        Args:
+            module: FabModule to build
+            parent: image reference to build from
+            parent_id: resolved image ID of parent, used for the cache key
+            tag: tag of the resulting stage image
+            buildargs: dict of build args passed to the container tool
+            key: precomputed stage cache key
+            platform: platform (os/arch) to build for, the container tool's default if None
+
+        Returns:
+            The ID of the stage image, or None if the build failed
+        """
+        start = time.monotonic()
+        if key is None:
+            key = self.stage_key(module, parent_id, buildargs)
+        span = {'module': module.name, 'cache': 'miss' if self.stage_cache else 'off'}
+        loaded = getattr(module, 'loaded', None)
+        if loaded is not None:
+            span['yaml_load_ms'] = round((loaded[1] - loaded[0]) * 1000, 3)
+        if self.stage_cache:
+            image_id = self.cache.lookup(tag, key)
+            if image_id is not None and self.resolve_image(tag) == image_id:
+                logging.info('Reusing cached {} stage ({})'.format(tag, image_id[:12]))
+                self.touch(tag)
+                if self.tracer is not None:
+                    self.tracer.span(tag, 'cache', start, **dict(span, cache='hit', image=image_id[:12]))
+                return image_id
+        podman_args = []
+        podman_args.append('--from')
+        podman_args.append(parent)
+        podman_args.append('--file')
+        podman_args.append(module.containerfile)
+        podman_args.append('--tag')
+        podman_args.append(tag)
+        if platform is not None:
+            podman_args.append('--platform')
+            podman_args.append(platform)
+        for name, value in used_buildargs(module, buildargs).items():
+            podman_args.append('--build-arg')
+            podman_args.append('{}={}'.format(name, value))
+        logging.info('Start build of {} stage'.format(tag))
+        with staged_context(module, self.context_dir) as context:
+            image_id = self.build_image(podman_args, context, tag, span)
+        if image_id is None:
+            if tag in self.cancelled:
+                logging.info('Build of {} stage cancelled'.format(tag))
+            else:
+                logging.error('Build of {} stage failed'.format(tag))
+            return None
+        self.remember(tag, key, image_id, parent_id)
+        return image_id
+
+    def build_image(self, args, cwd, label=None, span=None):
+        """
+        Run a container tool build with args and return the resulting image ID, or None on failure
+        """
+        fd, iidfile = tempfile.mkstemp(prefix='fab-iid-')
+        os.close(fd)
+        try:
+            rc = self.run(['build'] + args + ['--iidfile', iidfile], cwd, label, span if span is not None else {})
+            with open(iidfile, 'r') as f:
+                image_id = _image_id(f.read().strip())
+        finally:
+            os.unlink(iidfile)
+        if rc != 0 or not image_id:
+            logging.debug('build exited with {}'.format(rc))
+            return None
+        return image_id
+
+    def remember(self, tag, key, image_id, parent_id=None):
+        """
+        Record that tag now points at image_id, built with cache key on parent_id
+        """
+        with self._lock:
+            self.cache.record(tag, key, image_id, parent_id)
+            self.cache.save()
+            if self._images is not None:
+                self._images[tag] = image_id
+
+    def touch(self, tag):
+        """
+        Record that the stage tag was just reused
+        """
+        with self._lock:
+            self.cache.touch(tag)
+            self.cache.save()
+
+    def tag(self, source, target):
+        return self.run(['tag', source, target]) == 0
+
+    def create_manifest(self, name, images):
+        """
+        Create (or replace) the manifest list name holding the local images
+
+        Returns:
+            True if the manifest list was created with every image
+        """
+        if self.run(['manifest', 'exists', name]) == 0 and self.run(['manifest', 'rm', name]) != 0:
+            return False
+        if self.run(['manifest', 'create', name]) != 0:
+            return False
+        for image in images:
+            # local images without a registry are stored under localhost/
+            local = image if '/' in image else 'localhost/' + image
+            if self.run(['manifest', 'add', name, 'containers-storage:{}'.format(local)]) != 0:
+                logging.error('Could not add {} to manifest list {}'.format(image, name))
+                return False
+        logging.info('Created manifest list {} with {} images'.format(name, len(images)))
+        return True
+
+
+def used_buildargs(module, buildargs):
+    """
+    Return the build args passed to a module's stage
+
+    The module's per-include values take precedence over buildargs, and only
+    args the module declares and its Containerfile reads with ARG are kept.
+    """
+    values = dict(buildargs)
+    values.update(getattr(module, 'var_values', None) or {})
+    used = module.containerfile_args()
+    return {name: str(values[name]) for name in module.declared_buildargs() if name in used and name in values}
+
+
+def report_buildargs(fabfiles):
+    """
+    Log a warning for every declared-but-unset or set-but-undeclared buildarg of fabfiles
+    """
+    seen = set()
+    for fabfile in fabfiles:
+        for warning in fabfile.check_buildargs():
+            if warning not in seen:
+                seen.add(warning)
+                logging.warning(warning)
+
+
+def _image_id(value):
+    if value.startswith('sha256:'):
+        return value[len('sha256:'):]
+    return value
+
+
+def _repository(reference):
+    """
+    Strip the tag or digest from an image reference
+    """
+    name = reference.split('@', 1)[0]
+    head, _, last = name.rpartition('/')
+    if ':' in last:
+        last = last.split(':', 1)[0]
+    return '{}/{}'.format(head, last) if head else last
+
+
+def image_names(reference):
+    """
+    Names a reference may be listed under by the container tool
+    """
+    names = [reference]
+    last = reference.rsplit('/', 1)[-1]
+    if '@' not in reference and ':' not in last:
+        names.append(reference + ':latest')
+    if '/' not in reference:
+        names += ['localhost/' + name for name in list(names)]
+        names += ['docker.io/library/' + name for name in list(names) if not name.startswith('localhost/')]
+    return names
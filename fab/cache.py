@@ -0,0 +1,225 @@
+"""
+Content-addressed stage cache for Fabfile builds.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+from .config import CACHE_DIR
+
+# Files modified this recently are hashed but not memoized
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def hash_file(path, algorithm='sha256'):
+    """Return the hex digest of a file's contents."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _walk(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), directory)
+
+
+def hash_context(directory, files=None, digests=None):
+    """
+    Hash a build context directory.
+
+    Every file contributes its relative path, executable bit and contents, so
+    renames, mode changes and edits all produce a new digest.
+
+    Args:
+        directory: the context directory
+        files: relative paths of the files to hash, every file in directory if None
+        digests: DigestCache to look up unchanged files in
+    """
+    digest = hashlib.sha256()
+    directory = str(directory)
+    for relpath in (_walk(directory) if files is None else files):
+        path = os.path.join(directory, relpath)
+        digest.update(relpath.encode('utf-8') + b'\0')
+        stat = os.lstat(path)
+        if os.path.islink(path):
+            digest.update(b'link\0' + os.readlink(path).encode('utf-8') + b'\0')
+            continue
+        digest.update(b'x\0' if stat.st_mode & 0o111 else b'-\0')
+        content = digests.digest(path, stat) if digests is not None else hash_file(path)
+        digest.update(content.encode('ascii') + b'\0')
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """
+    File content digests keyed by path, trusted while the file's inode, mtime and size are unchanged
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path or os.path.join(CACHE_DIR, 'digests.json'))
+        self.entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable digest cache {}: {}'.format(self.path, err))
+            self.entries = {}
+
+    def digest(self, path, stat=None):
+        """
+        Return the sha256 hex digest of the file at path, hashing it only if it changed
+        """
+        path = os.path.abspath(path)
+        stat = stat if stat is not None else os.stat(path)
+        signature = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == signature:
+            return entry[3]
+        digest = hash_file(path)
+        # a file written within the mtime granularity of being hashed could change again unnoticed
+        if time.time_ns() - stat.st_mtime_ns > RACY_WINDOW_NS:
+            with self._lock:
+                self.entries[path] = signature + [digest]
+                self._dirty = True
+        return digest
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix='.digests-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self._dirty = False
+
+
+def stage_key(parent, containerfile, context, buildargs):
+    """
+    Compute the cache key of a single build stage.
+
+    Args:
+        parent: resolved image ID (or reference) the stage builds from
+        containerfile: path to the stage's Containerfile
+        context: digest of the stage's build context
+        buildargs: dict of the build args that affect this stage
+    """
+    material = {
+        'parent': parent,
+        'containerfile': hash_file(containerfile),
+        'context': context,
+        'buildargs': sorted(buildargs.items()),
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# path -> (mtime_ns, size, entries) of stage indexes already read by this process
+_LOADED = {}
+
+
+class StageCache:
+    """
+    On-disk index mapping stage tags to the cache key and image ID they were built with
+
+    Every entry also records when the stage was last built or reused (``used``),
+    the image it was built on (``parent``) and the images the tag pointed at
+    before (``superseded``), for ``fab gc``.
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path or os.path.join(CACHE_DIR, 'stages.json'))
+        self.entries = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+            loaded = _LOADED.get(self.path)
+            if loaded is None or loaded[:2] != (stat.st_mtime_ns, stat.st_size):
+                with open(self.path, 'r') as f:
+                    loaded = _LOADED[self.path] = (stat.st_mtime_ns, stat.st_size, json.load(f))
+            self.entries = {tag: dict(entry) for tag, entry in loaded[2].items()}
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable stage cache {}: {}'.format(self.path, err))
+            self.entries = {}
+
+    def lookup(self, tag, key):
+        """Return the image ID recorded for tag if it was built with key, else None."""
+        entry = self.entries.get(tag)
+        if entry is None or entry.get('key') != key:
+            return None
+        return entry.get('id')
+
+    def record(self, tag, key, image_id, parent=None):
+        previous = self.entries.get(tag, {})
+        superseded = [old for old in previous.get('superseded', []) if old != image_id]
+        if previous.get('id') not in (None, image_id):
+            superseded.append(previous['id'])
+        entry = {'key': key, 'id': image_id, 'used': time.time()}
+        if parent is not None or previous.get('parent') is not None:
+            entry['parent'] = parent if parent is not None else previous['parent']
+        if superseded:
+            entry['superseded'] = superseded
+        self.entries[tag] = entry
+        self._dirty = True
+
+    def touch(self, tag):
+        """Mark the stage tag as used now."""
+        if tag in self.entries:
+            self.entries[tag]['used'] = time.time()
+            self._dirty = True
+
+    def drop_superseded(self, image_ids):
+        """Stop tracking the old images image_ids, once they were removed."""
+        for entry in self.entries.values():
+            superseded = [image_id for image_id in entry.get('superseded', []) if image_id not in image_ids]
+            if superseded != entry.get('superseded', []):
+                if superseded:
+                    entry['superseded'] = superseded
+                else:
+                    del entry['superseded']
+                self._dirty = True
+
+    def forget(self, tag):
+        """Drop the entry of tag, e.g. once its image was removed."""
+        if self.entries.pop(tag, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix='.stages-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._dirty = False
@@ -0,0 +1,178 @@
+"""
+Module catalog: an on-disk index of the modules under a directory.
+"""
+
+import os
+import copy
+import json
+import hashlib
+import logging
+import pathlib
+import tempfile
+import yaml
+from .config import CATALOG_INDEX_NAME as INDEX_NAME
+from .module import FabModule, load_yaml
+
+INDEX_VERSION = 1
+
+
+class CatalogError(Exception):
+    """Exception raised when a catalog index cannot be used."""
+    pass
+
+
+class Catalog:
+    """
+    Index of the modules under a directory, keyed by their metadata name.
+
+    Every entry keeps the module's parsed definition together with the size,
+    mtime and hash of its YAML, so a lookup only re-reads a module whose file
+    changed and only re-parses it if its content did.
+    """
+
+    def __init__(self, root, index_path=None):
+        self.root = pathlib.Path(root)
+        self.index_path = pathlib.Path(index_path) if index_path else self.root / INDEX_NAME
+        self.modules = {}
+        self._dirty = False
+
+    @classmethod
+    def open(cls, path):
+        """
+        Load the catalog index at path (a catalog directory or an index file)
+        """
+        path = pathlib.Path(path)
+        catalog = cls(path) if path.is_dir() else cls(path.parent, path)
+        catalog.load()
+        return catalog
+
+    def load(self):
+        """
+        Read the index file, raising CatalogError if it is missing or unusable
+        """
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError) as err:
+            raise CatalogError('Cannot read catalog index {}: {}'.format(self.index_path, err))
+        if index.get('version') != INDEX_VERSION:
+            raise CatalogError('Unsupported catalog index version in {}'.format(self.index_path))
+        self.root = self.index_path.parent / index['root']
+        self.modules = index['modules']
+
+    def _path(self, entry):
+        return self.root / entry['path']
+
+    def _entry(self, path, previous=None):
+        """
+        Return the index entry for the module YAML at path, reusing previous if it is still current
+        """
+        stat = os.stat(path)
+        if previous is not None and previous['mtime_ns'] == stat.st_mtime_ns and previous['size'] == stat.st_size:
+            return previous
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if previous is not None and previous['sha256'] == digest:
+            entry = dict(previous)
+        else:
+            try:
+                definition = load_yaml(data)
+            except yaml.YAMLError as err:
+                logging.warning('Skipping {}: {}'.format(path, err))
+                return None
+            if not isinstance(definition, dict) or 'from' in definition:
+                # not a module (a Fabfile, or unrelated YAML)
+                return None
+            name = definition.get('metadata', {}).get('name')
+            if not name:
+                logging.debug('Skipping {}: no metadata name'.format(path))
+                return None
+            entry = {
+                'name': name,
+                'path': os.path.relpath(path, self.root),
+                'sha256': digest,
+                'containerfile': definition.get('containerfile', 'Containerfile'),
+                'buildargs': definition.get('buildargs', []),
+                'definition': definition,
+            }
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        if entry != previous:
+            self._dirty = True
+        return entry
+
+    def index(self):
+        """
+        Scan the catalog directory and refresh the index, re-parsing only changed modules
+
+        Returns:
+            The number of modules in the index
+        """
+        previous = {entry['path']: entry for entry in self.modules.values()}
+        modules = {}
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not name.endswith(('.yaml', '.yml')):
+                    continue
+                path = os.path.join(root, name)
+                entry = self._entry(path, previous.get(os.path.relpath(path, self.root)))
+                if entry is None:
+                    continue
+                if entry['name'] in modules:
+                    logging.warning('Module {} in {} shadowed by {}'.format(
+                        entry['name'], entry['path'], modules[entry['name']]['path']))
+                    continue
+                modules[entry['name']] = entry
+        if set(modules) != set(self.modules):
+            self._dirty = True
+        self.modules = modules
+        return len(modules)
+
+    def lookup(self, name):
+        """
+        Return the up to date index entry for module name, or None if the catalog has no such module
+        """
+        entry = self.modules.get(name)
+        if entry is None:
+            return None
+        try:
+            current = self._entry(self._path(entry), entry)
+        except OSError as err:
+            logging.warning('Module {} listed in {} is gone: {}'.format(name, self.index_path, err))
+            return None
+        if current is None or current['name'] != name:
+            return None
+        self.modules[name] = current
+        return current
+
+    def module(self, name, **kwargs):
+        """
+        Return a FabModule for name built from the index, or None if the catalog has no such module
+        """
+        entry = self.lookup(name)
+        if entry is None:
+            return None
+        return FabModule(source=str(self._path(entry)), definition=copy.deepcopy(entry['definition']), **kwargs)
+
+    def save(self):
+        """
+        Write the index back if anything changed
+        """
+        if not self._dirty:
+            return
+        index = {
+            'version': INDEX_VERSION,
+            'root': os.path.relpath(self.root, self.index_path.parent),
+            'modules': self.modules,
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.index_path.parent, prefix='.fab-catalog-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.index_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._dirty = False
@@ -4,13 +4,51 @@ Command-line interface for FAB.
 """
 
 import argparse
+import glob
+import os
 import sys
-from .config import __version__, APP_DESCRIPTION
-from .kickstart import FabKickstart
-from .fabfile import FabFile
+from .config import __version__, APP_DESCRIPTION, CATALOG_INDEX_NAME, GC_MAX_IMAGES, LOG_TAIL_LINES, \
+    PODMAN_SOCKET, PULL_JOBS, SOCKET_PATH
 
+# Subcommand modules are imported in their branch of main(), so each command
+# only loads what it uses (no yaml or pykickstart for `fab version`).
 
-def main() -> int:
+
+def _strip_option(argv, option):
+    """Remove every occurrence of option and its value from argv."""
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            stripped.append(arg)
+    return stripped
+
+
+def _size(text):
+    """argparse type for sizes such as 500M or 20G."""
+    from .gc import parse_size
+    try:
+        return parse_size(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _print_gc(summary, dry_run=False):
+    """Print the outcome of a stage image collection."""
+    from .gc import format_size
+    verb = "Would remove" if dry_run else "Removed"
+    for tag in summary['removed']:
+        print(f"{verb} {tag}")
+    print(f"{verb} {len(summary['removed'])} stage tags ({format_size(summary['freed'])}) and "
+          f"{summary['stale']} superseded images; kept {summary['kept']} stage images "
+          f"({format_size(summary['kept_size'])})")
+
+
+def main(argv=None) -> int:
     """Main entry point for the fab CLI."""
     parser = argparse.ArgumentParser(
         description=APP_DESCRIPTION,
@@ -22,10 +60,20 @@ Examples:
   fab version --show-commands   Show version and valid commands
   fab kickstart file.ks         Execute a Kickstart file
   fab kickstart file.ks --dry-run  Validate a Kickstart file
+  fab build Fabfile             Build the image defined by a Fabfile
+  fab build A B C --jobs 4      Build several Fabfiles sharing common stages
+  fab gc --max-size 20G         Remove the least recently used stage images
+  fab serve --jobs 4            Run a daemon for `fab --remote` clients
+  fab --remote SOCKET build F   Run a command in a running `fab serve` daemon
 """,
     )
 
     parser.add_argument("--version", action="version", version=f"fab {__version__}")
+    parser.add_argument(
+        "--remote",
+        metavar="SOCKET",
+        help="Run the command in the `fab serve` daemon listening on SOCKET",
+    )
 
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
@@ -43,7 +91,9 @@ Examples:
     )
 
     # Arguments for kickstart file execution
-    kickstart_parser.add_argument("file", nargs="?", help="Path to the Kickstart file")
+    kickstart_parser.add_argument(
+        "file", nargs="*",
+        help="Path to the Kickstart file; with --dry-run, several files, glob patterns or directories")
     kickstart_parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -54,19 +104,268 @@ Examples:
         action="store_true",
         help="Continue execution even if unknown commands are present (print warnings only)",
     )
+    kickstart_parser.add_argument(
+        "--root",
+        default="/",
+        help="Apply the Kickstart to the system rooted at this directory (default: /)",
+    )
+    kickstart_parser.add_argument(
+        "--per-command",
+        action="store_true",
+        help="Run groupadd/useradd for every entry instead of editing the account databases in one pass",
+    )
+    kickstart_parser.add_argument(
+        "--password-rounds",
+        type=int,
+        help="SHA-512 crypt rounds used to hash plaintext passwords (default: 5000)",
+    )
+    kickstart_parser.add_argument(
+        "--hash-workers",
+        type=int,
+        help="Number of processes hashing plaintext passwords (default: number of CPUs)",
+    )
+    kickstart_parser.add_argument(
+        "--package-manager",
+        default="dnf",
+        help="Command installing the %%packages selection in one transaction (default: dnf)",
+    )
+    kickstart_parser.add_argument(
+        "--package-cache",
+        help="Package download cache directory, e.g. a cache mount shared by builds "
+             "(default: packages/ in the fab cache directory)",
+    )
+    kickstart_parser.add_argument(
+        "--metadata-max-age",
+        type=int,
+        help="Seconds repository metadata in the package cache is used without a refresh (default: 21600)",
+    )
+    kickstart_parser.add_argument(
+        "--script-timeout",
+        type=int,
+        help="Seconds each %%pre/%%post script may run before it is killed (default: 1800)",
+    )
+    kickstart_parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Execute every step, ignoring and not writing the journal in the target root",
+    )
+    kickstart_parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Processes validating several files with --dry-run (default: number of CPUs)",
+    )
+    kickstart_parser.add_argument(
+        "--report",
+        help="Write the results of validating several files to this JSON (or JUnit for .xml) report",
+    )
+    kickstart_parser.add_argument(
+        "--report-format",
+        choices=["json", "junit"],
+        help="Format of --report (default: from its extension)",
+    )
+    kickstart_parser.add_argument(
+        "--emit-containerfile",
+        nargs="?",
+        const="-",
+        metavar="PATH",
+        help="Compile the Kickstart to Containerfile instructions instead of executing it: to standard output, "
+             "to PATH, or as a fab module if PATH is a directory",
+    )
 
     # Build command
     build_parser = subparsers.add_parser("build", help="Build a container using a fabfile")
-    build_parser.add_argument("fabfile", help="Path to the fabfile")
+    build_parser.add_argument("fabfile", nargs="+", help="Path to the fabfile (several build as one matrix)")
     build_parser.add_argument("--container-tool", help="Path to the container tool", default="/usr/bin/podman")
     build_parser.add_argument("--container-tool-extra-args", help="Extra arguments for the container tool", default="")
+    build_parser.add_argument(
+        "--no-stage-cache",
+        action="store_true",
+        help="Rebuild every stage even if an image with a matching cache key exists",
+    )
+    build_parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        help="Number of stages to build concurrently once image chains diverge (default: 1, or one per --platform)",
+    )
+    build_parser.add_argument(
+        "--pull-jobs",
+        type=int,
+        default=PULL_JOBS,
+        help=f"Number of base and module images pulled concurrently when the build starts (default: {PULL_JOBS})",
+    )
+    build_parser.add_argument(
+        "--fuse",
+        action="store_true",
+        help="Compile each image's modules into one multi-stage Containerfile and build it in a single invocation",
+    )
+    build_parser.add_argument(
+        "--fuse-stage-tags",
+        action="store_true",
+        help="With --fuse, also tag every intermediate <name>-stage-<module> image",
+    )
+    build_parser.add_argument(
+        "--platform",
+        help="Comma separated platforms (e.g. linux/amd64,linux/arm64) to build concurrently into a manifest list",
+    )
+    build_parser.add_argument(
+        "--api",
+        metavar="SOCKET",
+        help=f"Talk to the Podman REST API on SOCKET (usually {PODMAN_SOCKET}) instead of running the container tool",
+    )
+    build_parser.add_argument(
+        "--node",
+        action="append",
+        metavar="ENDPOINT[,capacity=N]",
+        help="Build on this container engine (a connection name or a --url URL); repeat to build on a farm",
+    )
+    build_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reuse the stages recorded in <fabfile>.lock whose inputs are unchanged, even without a stage cache",
+    )
+    build_parser.add_argument(
+        "--locked",
+        action="store_true",
+        help="Build from the base images pinned in <fabfile>.lock instead of resolving their tags",
+    )
+    output_group = build_parser.add_mutually_exclusive_group()
+    output_group.add_argument(
+        "--progress",
+        action="store_true",
+        help="Print one status line per stage instead of the container tool output",
+    )
+    output_group.add_argument(
+        "--quiet", "-q",
+        action="store_true",
+        help="Only print the output of failed stages",
+    )
+    build_parser.add_argument(
+        "--catalog",
+        action="append",
+        default=[],
+        help="Module catalog (directory or index file) to resolve includes by module name; can be repeated",
+    )
+    build_parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use only cached copies of remote module sources",
+    )
+    build_parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Write a Chrome trace (Perfetto) of the build's stages to FILE and print a summary table",
+    )
+    build_parser.add_argument("--log-dir", help="Directory for per-stage compressed logs (default: ~/.cache/fab/logs)")
+    build_parser.add_argument(
+        "--log-lines",
+        type=int,
+        default=LOG_TAIL_LINES,
+        help=f"Number of trailing lines shown for a failed stage (default: {LOG_TAIL_LINES})",
+    )
 
-    args = parser.parse_args()
+    build_parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="Remove the least recently used stage images after the build, keeping the ones it used",
+    )
+    build_parser.add_argument(
+        "--gc-max-images",
+        type=int,
+        default=GC_MAX_IMAGES,
+        help=f"With --gc, the number of stage images to keep (default: {GC_MAX_IMAGES})",
+    )
+    build_parser.add_argument("--gc-max-size", type=_size, help="With --gc, the disk space stage images may use")
+
+    # Garbage collection command
+    gc_parser = subparsers.add_parser("gc", help="Remove stage images, least recently used first")
+    gc_parser.add_argument("fabfile", nargs="*", help="Fabfiles whose locked stages are kept as well")
+    gc_parser.add_argument("--container-tool", help="Path to the container tool", default="/usr/bin/podman")
+    gc_parser.add_argument("--container-tool-extra-args", help="Extra arguments for the container tool", default="")
+    gc_parser.add_argument(
+        "--max-images",
+        type=int,
+        default=GC_MAX_IMAGES,
+        help=f"Number of stage images to keep (default: {GC_MAX_IMAGES})",
+    )
+    gc_parser.add_argument(
+        "--max-size",
+        type=_size,
+        help="Disk space the layers of the stage images may use, e.g. 20G (default: no limit)",
+    )
+    gc_parser.add_argument("--dry-run", action="store_true", help="Only print what would be removed")
+
+    # Catalog command
+    catalog_parser = subparsers.add_parser("catalog", help="Manage module catalogs")
+    catalog_subparsers = catalog_parser.add_subparsers(dest="catalog_command", help="Catalog commands")
+    catalog_index_parser = catalog_subparsers.add_parser(
+        "index", help="Scan a directory of modules and write its catalog index"
+    )
+    catalog_index_parser.add_argument("directory", help="Catalog directory")
+    catalog_index_parser.add_argument("--output", help=f"Index file (default: <directory>/{CATALOG_INDEX_NAME})")
+    catalog_list_parser = catalog_subparsers.add_parser("list", help="List the modules in a catalog index")
+    catalog_list_parser.add_argument("catalog", help="Catalog directory or index file")
+
+    # Bench command
+    bench_parser = subparsers.add_parser("bench", help="Benchmark fab offline with a stub container tool")
+    bench_parser.add_argument(
+        "--suite",
+        action="append",
+        choices=["startup", "plan", "build", "logs", "kickstart", "crypt"],
+        help="Suite to run; can be repeated (default: all)",
+    )
+    bench_parser.add_argument("--output", "-o", help="Write the results as JSON to this file")
+    bench_parser.add_argument("--baseline", help="JSON results to compare with; regressions make fab bench fail")
+    bench_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative change against the baseline that counts as a regression (default: 0.2)",
+    )
+    bench_parser.add_argument("--modules", type=int, default=15,
+                              help="Modules in the synthetic Fabfile (default: 15)")
+    bench_parser.add_argument("--buildargs", type=int, default=10, help="Build args per module (default: 10)")
+    bench_parser.add_argument("--users", type=int, default=1000,
+                              help="Users and groups in the kickstart (default: 1000)")
+    bench_parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=0.05,
+        help="Seconds the stub container tool spends on each build (default: 0.05)",
+    )
+    bench_parser.add_argument("--stub-lines", type=int, default=200, help="Output lines per stub build (default: 200)")
+    bench_parser.add_argument("--log-mb", type=int, default=64,
+                              help="MB of output for the log streaming suite (default: 64)")
+
+    # Serve command
+    serve_parser = subparsers.add_parser("serve", help="Run kickstart and build jobs for `fab --remote` clients")
+    serve_parser.add_argument("--socket", default=SOCKET_PATH,
+                              help=f"Unix socket to listen on (default: {SOCKET_PATH})")
+    serve_parser.add_argument(
+        "--jobs", "-j",
+        type=int,
+        default=1,
+        help="Number of jobs run at the same time, the others wait in a queue (default: 1)",
+    )
+
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
 
     if not args.command:
         parser.print_help()
         return 0
 
+    if args.remote and args.command != "serve":
+        from .server import FabClient, ServerError
+        try:
+            return FabClient(args.remote).run(_strip_option(argv, "--remote"))
+        except ServerError as e:
+            print(f"Error: {e}")
+            return 1
+        except KeyboardInterrupt:
+            # closing the connection cancels the job
+            return 130
+
     if args.command == "version":
         print(f"fab version {__version__}")
         if hasattr(args, 'show_commands') and args.show_commands:
@@ -80,14 +379,162 @@ Examples:
         if not args.file:
             kickstart_parser.print_help()
             return 0
-        ks = FabKickstart(args.file, args.dry_run, args.ignore_unknown)
+        if len(args.file) > 1 or args.report or os.path.isdir(args.file[0]) or glob.has_magic(args.file[0]):
+            if not args.dry_run or args.emit_containerfile:
+                print("Error: several Kickstart files can only be validated, with --dry-run")
+                return 1
+            from .ksvalidate import validate_kickstarts
+            return validate_kickstarts(args.file, args.jobs, args.report, args.report_format, args.ignore_unknown)
+        from .kickstart import FabKickstart
+        ks = FabKickstart(args.file[0], args.dry_run, args.ignore_unknown, args.root, not args.per_command,
+                          args.password_rounds, args.hash_workers, args.package_manager, args.package_cache,
+                          args.metadata_max_age, args.script_timeout, not args.no_journal, args.emit_containerfile)
         return ks.handle_kickstart()
 
     elif args.command == "build":
-        fab = FabFile(args.fabfile, args.container_tool, args.container_tool_extra_args)
-        if not fab.build():
+        if args.fuse and (args.resume or args.locked or args.platform):
+            print("Error: --resume, --locked and --platform cannot be combined with --fuse")
+            return 1
+        if args.node and (args.fuse or args.resume or args.locked or args.platform):
+            print("Error: --node cannot be combined with --fuse, --resume, --locked or --platform")
+            return 1
+        if args.api and (args.fuse or args.node):
+            print("Error: --api cannot be combined with --fuse or --node")
+            return 1
+        if args.gc and args.node:
+            print("Error: --gc cannot be combined with --node")
+            return 1
+        platforms = [platform.strip() for platform in (args.platform or "").split(",") if platform.strip()]
+        jobs = args.jobs or max(1, len(platforms))
+        from .fabfile import FabFile
+        from .sources import SourceCache, SourceError
+        from .builder import StageBuilder
+        from .logstream import LogConsole, PROGRESS, QUIET, VERBOSE
+        tracer = None
+        if args.trace:
+            from .trace import Tracer
+            tracer = Tracer()
+        mode = PROGRESS if args.progress else QUIET if args.quiet else VERBOSE
+        concurrent = jobs > 1 or len(platforms) > 1 or len(args.node or []) > 1
+        engine = None
+        if args.api:
+            from .engine import ApiEngine
+            engine = ApiEngine(args.api)
+        builder = StageBuilder(args.container_tool, args.container_tool_extra_args,
+                               stage_cache=not args.no_stage_cache,
+                               console=LogConsole(mode, prefix=concurrent),
+                               log_dir=args.log_dir, log_tail=args.log_lines, tracer=tracer, engine=engine)
+        sources = SourceCache(offline=args.offline)
+        images = []
+        for source in args.fabfile:
+            try:
+                fab = FabFile(source, args.container_tool, args.container_tool_extra_args,
+                              stage_cache=not args.no_stage_cache, catalogs=args.catalog, sources=sources)
+            except SourceError as e:
+                print(f"Error: {e}")
+                return 1
+            images += fab.images()
+        used = []
+        if args.fuse:
+            from .fuse import build_fused
+            success = build_fused(images, builder, jobs, args.fuse_stage_tags)
+        elif args.node:
+            from .farm import BuildHost, FarmBuild
+            try:
+                hosts = [BuildHost.parse(spec, args.container_tool, args.container_tool_extra_args,
+                                         stage_cache=not args.no_stage_cache, console=builder.console,
+                                         log_dir=builder.log_dir, log_tail=args.log_lines, tracer=tracer,
+                                         digests=builder.digests, cache_dir=builder.cache.path.parent)
+                         for spec in args.node]
+            except ValueError as e:
+                print(f"Error: {e}")
+                return 1
+            farm = FarmBuild(images, hosts)
+            success = farm.build()
+            print(farm.summary())
+        else:
+            from .lock import FabLock, LockError
+            from .matrix import MatrixBuild
+            try:
+                locks = {source: FabLock.for_fabfile(source) for source in args.fabfile}
+            except LockError as e:
+                print(f"Error: {e}")
+                return 1
+            build = MatrixBuild(images, builder, jobs, locks, args.resume, args.locked, platforms, args.pull_jobs)
+            success = build.build()
+            used = [tag for node in build.tree.stages() for tag in node.tags]
+        if tracer is not None:
+            tracer.loads(images)
+            tracer.write(args.trace)
+            print(tracer.summary())
+            print(f"Trace written to {args.trace}")
+        if args.gc:
+            from .gc import collect_stages
+            _print_gc(collect_stages(builder, args.gc_max_images, args.gc_max_size, args.fabfile, used))
+        if not success:
             return 1
 
+    elif args.command == "gc":
+        from .builder import StageBuilder
+        from .gc import collect_stages
+        builder = StageBuilder(args.container_tool, args.container_tool_extra_args)
+        _print_gc(collect_stages(builder, args.max_images, args.max_size, args.fabfile, dry_run=args.dry_run),
+                  args.dry_run)
+
+    elif args.command == "bench":
+        import json
+        from .bench import SUITES, BenchSuite, compare, format_results, write_results
+        suite = BenchSuite(args.modules, args.buildargs, args.users, args.stub_latency, args.stub_lines, args.log_mb)
+        results = suite.run(args.suite or SUITES)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print(format_results(results, baseline))
+        if args.output:
+            write_results(results, args.output)
+            print(f"Results written to {args.output}")
+        if baseline is not None:
+            regressions = compare(results, baseline, args.threshold)
+            if regressions:
+                print(f"Regressions beyond {args.threshold:.0%}:")
+                for regression in regressions:
+                    print(f"  {regression}")
+                return 1
+
+    elif args.command == "serve":
+        from .server import FabServer, ServerError
+        server = FabServer(args.socket, args.jobs)
+        print(f"Listening on {server.socket_path} ({args.jobs} concurrent jobs)", flush=True)
+        try:
+            server.serve_forever()
+        except ServerError as e:
+            print(f"Error: {e}")
+            return 1
+
+    elif args.command == "catalog":
+        from .catalog import Catalog, CatalogError
+        if args.catalog_command == "index":
+            catalog = Catalog(args.directory, args.output)
+            try:
+                # start from the existing index so unchanged modules are not parsed again
+                catalog.load()
+            except CatalogError:
+                pass
+            count = catalog.index()
+            catalog.save()
+            print(f"Indexed {count} modules into {catalog.index_path}")
+        elif args.catalog_command == "list":
+            try:
+                catalog = Catalog.open(args.catalog)
+            except CatalogError as e:
+                print(f"Error: {e}")
+                return 1
+            for name, entry in sorted(catalog.modules.items()):
+                print(f"  {name:<25} {entry['path']}")
+        else:
+            catalog_parser.print_help()
+
     return 0
 
 
@@ -3,8 +3,15 @@ Kickstart command execution functionality.
 """
 
 import subprocess
+import tempfile
+import shlex
+import time
 import os
 
+from .accounts import AccountDatabase, AccountError
+from .config import PACKAGE_CACHE_DIR, PACKAGE_METADATA_MAX_AGE, SCRIPT_TIMEOUT
+from .sha512crypt import hash_passwords, sha512_crypt
+
 
 class KickstartRootError(Exception):
     """Exception raised when a command requires root privileges."""
@@ -17,9 +24,11 @@ class KickstartError(Exception):
 
 
 class KickstartCommandExecutor:
-    def __init__(self, command_name: str, command_obj: object):
+    def __init__(self, command_name: str, command_obj: object, root: str = '/', password_rounds: int = None):
         self.command_name = command_name
         self.command_obj = command_obj
+        self.root = root
+        self.password_rounds = password_rounds
         try:
             execute_method = getattr(self, f"execute_{self.command_name}")
             print(f'Executing {self.command_name} command: {self.command_obj.__str__().strip()}')
@@ -35,6 +44,12 @@ class KickstartCommandExecutor:
         if os.geteuid() != 0:
             raise KickstartRootError("Must be root")
 
+    def _root_args(self) -> list:
+        """Extra shadow-utils arguments to operate on the target root."""
+        if self.root in (None, '', '/'):
+            return []
+        return ['--root', str(self.root)]
+
     def execute_group(self):
         # check if the user is root
         self._check_root()
@@ -43,12 +58,7 @@ class KickstartCommandExecutor:
         gid = getattr(self.command_obj, 'gid')
         print(f'Creating group {name} with gid {gid}')
 
-        # if gid is not None, create the group with the given gid
-        if gid is not None:
-            # use subprocess.run to create the group with the given gid and merge stderr and stdout
-            result = subprocess.run(f'groupadd -g {gid} {name}', shell=True, capture_output=True)
-        else:
-            result = subprocess.run(f'groupadd {name}', shell=True, capture_output=True)
+        result = subprocess.run(group_command(self.command_obj, self._root_args()), capture_output=True)
         if result.returncode != 0:
             raise KickstartError(f"Failed to create group {name}: {result.stderr}")
 
@@ -58,54 +68,302 @@ class KickstartCommandExecutor:
         # check if the user is root
         self._check_root()
 
-        # get the name, password, and group attributes from the command_obj
         name = getattr(self.command_obj, 'name', None)
-        homedir = getattr(self.command_obj, 'homedir', None)
-        iscrypted = getattr(self.command_obj, 'isCrypted', None)
-        password = getattr(self.command_obj, 'password', None)
-        shell = getattr(self.command_obj, 'shell', None)
-        uid = getattr(self.command_obj, 'uid', None)
-        lock = getattr(self.command_obj, 'lock', None)
-        gecos = getattr(self.command_obj, 'gecos', None)
-        gid = getattr(self.command_obj, 'gid', None)
-        groups = getattr(self.command_obj, 'groups', None)
-
         print(f'Creating user {name}')
-        # create the user with the given attributes
-        # construct the command string and do not include parameters that are None
-
-        # Build the useradd command, only including options if their values are not None
-        command_parts = ['useradd']
-        if homedir is not None and homedir != '':
-            command_parts += ['--home-dir', str(homedir)]
-        if password is not None:
-            if not iscrypted:
-                # generate an encrypted password usable by useradd using mkpasswd
-                encrypted_password = subprocess.run(
-                    f'mkpasswd -m SHA-512 {password}', shell=True, capture_output=True).stdout.decode('utf-8').strip()
-                command_parts += ['--password', encrypted_password]
-            else:
-                command_parts += ['--password', str(password)]
-        if shell is not None and shell != '':
-            command_parts += ['--shell', str(shell)]
-        if uid is not None:
-            command_parts += ['--uid', str(uid)]
-        if lock is not None and lock:
-            # TODO: handle locked account
-            pass
-        if gecos is not None and gecos != '':
-            command_parts += ['--comment', str(gecos)]
-        if gid is not None:
-            command_parts += ['--gid', str(gid)]
-        if groups is not None and len(groups) > 0:
-            command_parts += ['--groups', ','.join(groups)]
-        command_parts.append(str(name))
-        command_string = ' '.join(command_parts)
+        command_parts = user_command(self.command_obj, self._root_args(), self.password_rounds)
+        command_string = shlex.join(command_parts)
 
         print(f'Executing command: {command_string}')
 
-        result = subprocess.run(command_string, shell=True, capture_output=True)
+        result = subprocess.run(command_parts, capture_output=True)
         if result.returncode != 0:
             raise KickstartError(f"Failed to create user {name}: {result.stderr}")
 
+        if getattr(self.command_obj, 'lock', False):
+            result = subprocess.run(['usermod'] + self._root_args() + ['--lock', str(name)], capture_output=True)
+            if result.returncode != 0:
+                raise KickstartError(f"Failed to lock user {name}: {result.stderr}")
+
         return True
+
+
+def group_command(command_obj: object, root_args: list = ()) -> list:
+    """Return the groupadd command line creating a kickstart group entry."""
+    name = getattr(command_obj, 'name')
+    gid = getattr(command_obj, 'gid', None)
+    # if gid is not None, create the group with the given gid
+    if gid is not None:
+        return ['groupadd'] + list(root_args) + ['-g', str(gid), name]
+    return ['groupadd'] + list(root_args) + [name]
+
+
+def user_command(command_obj: object, root_args: list = (), password_rounds: int = None, salt: str = None) -> list:
+    """
+    Return the useradd command line creating a kickstart user entry
+
+    Plaintext passwords are hashed with salt, or a random salt if it is None.
+    """
+    # get the name, password, and group attributes from the command_obj
+    name = getattr(command_obj, 'name', None)
+    homedir = getattr(command_obj, 'homedir', None)
+    iscrypted = getattr(command_obj, 'isCrypted', None)
+    password = getattr(command_obj, 'password', None)
+    shell = getattr(command_obj, 'shell', None)
+    uid = getattr(command_obj, 'uid', None)
+    gecos = getattr(command_obj, 'gecos', None)
+    gid = getattr(command_obj, 'gid', None)
+    groups = getattr(command_obj, 'groups', None)
+
+    # Build the useradd command, only including options if their values are not None
+    command_parts = ['useradd'] + list(root_args)
+    if homedir is not None and homedir != '':
+        command_parts += ['--home-dir', str(homedir)]
+    if password:
+        if not iscrypted:
+            # hash in-process so the plaintext never shows up on a command line
+            encrypted_password = sha512_crypt(password, salt=salt, rounds=password_rounds)
+            command_parts += ['--password', encrypted_password]
+        else:
+            command_parts += ['--password', str(password)]
+    if shell is not None and shell != '':
+        command_parts += ['--shell', str(shell)]
+    if uid is not None:
+        command_parts += ['--uid', str(uid)]
+    # useradd cannot lock the account; it is locked with usermod --lock afterwards
+    if gecos is not None and gecos != '':
+        command_parts += ['--comment', str(gecos)]
+    if gid is not None:
+        command_parts += ['--gid', str(gid)]
+    if groups is not None and len(groups) > 0:
+        command_parts += ['--groups', ','.join(groups)]
+    command_parts.append(str(name))
+    return command_parts
+
+
+class BulkAccountExecutor:
+    """
+    Applies all kickstart group and user entries without spawning groupadd/useradd.
+
+    The account databases under root are read once, every entry is applied in
+    memory and each changed file is written back once, atomically.
+    """
+
+    def __init__(self, root: str = '/', password_rounds: int = None, hash_workers: int = None):
+        self.root = root
+        self.password_rounds = password_rounds
+        self.hash_workers = hash_workers
+        self.groups = []
+        self.users = []
+
+    def add(self, command_name: str, command_obj: object):
+        if command_name == 'group':
+            self.groups.append(command_obj)
+        elif command_name == 'user':
+            self.users.append(command_obj)
+        else:
+            raise KickstartError(f"Command '{command_name}' is not handled by the bulk executor")
+
+    def execute(self):
+        if self.root in (None, '', '/') and os.geteuid() != 0:
+            raise KickstartRootError("Must be root")
+        database = AccountDatabase(self.root)
+
+        # hash every plaintext password up front, spread over all cores
+        plaintext = [obj for obj in self.users
+                     if getattr(obj, 'password', None) and not getattr(obj, 'isCrypted', None)]
+        hashed = dict(zip(map(id, plaintext), hash_passwords(
+            [obj.password for obj in plaintext], self.password_rounds, self.hash_workers)))
+        try:
+            for obj in self.groups:
+                name = getattr(obj, 'name')
+                gid = getattr(obj, 'gid', None)
+                print(f'Creating group {name} with gid {gid}')
+                database.add_group(name, gid)
+            for obj in self.users:
+                name = getattr(obj, 'name', None)
+                password = hashed.get(id(obj), getattr(obj, 'password', None) or None)
+                print(f'Creating user {name}')
+                database.add_user(
+                    name,
+                    uid=getattr(obj, 'uid', None),
+                    gid=getattr(obj, 'gid', None),
+                    groups=getattr(obj, 'groups', None) or [],
+                    homedir=getattr(obj, 'homedir', None) or None,
+                    shell=getattr(obj, 'shell', None) or None,
+                    gecos=getattr(obj, 'gecos', None) or '',
+                    password=password,
+                    lock=bool(getattr(obj, 'lock', False)),
+                )
+        except AccountError as e:
+            raise KickstartError(f"Failed to create {name}: {e}")
+        database.commit()
+        print(f'Created {len(self.groups)} groups and {len(self.users)} users')
+        return True
+
+
+class PackagesExecutor:
+    """
+    Installs the kickstart %packages selection as a single package manager transaction.
+
+    Packages, groups and environments are resolved together and excluded
+    packages are passed as excludes. Downloads are kept in cache_dir, which
+    can be shared between builds (e.g. a cache mount), and repository metadata
+    is not refreshed while the last successful transaction using that cache is
+    younger than metadata_max_age seconds.
+    """
+
+    # pykickstart group include levels (required, default, all) as dnf package types
+    GROUP_PACKAGE_TYPES = ('mandatory', 'mandatory,default', 'mandatory,default,optional')
+
+    STAMP = '.fab-metadata'
+
+    def __init__(self, packages: object, root: str = '/', package_manager: str = 'dnf',
+                 cache_dir: str = None, metadata_max_age: int = None):
+        self.packages = packages
+        self.root = root
+        self.package_manager = shlex.split(package_manager)
+        self.cache_dir = cache_dir or PACKAGE_CACHE_DIR
+        self.metadata_max_age = PACKAGE_METADATA_MAX_AGE if metadata_max_age is None else metadata_max_age
+
+    def specs(self) -> list:
+        """Return the package, group and environment specs to install."""
+        specs = []
+        environment = getattr(self.packages, 'environment', None)
+        if environment:
+            specs.append(f'@^{environment}')
+        specs += [f'@{group.name}' for group in getattr(self.packages, 'groupList', [])]
+        specs += list(getattr(self.packages, 'packageList', []))
+        return specs
+
+    def metadata_fresh(self) -> bool:
+        try:
+            age = time.time() - os.stat(os.path.join(self.cache_dir, self.STAMP)).st_mtime
+        except FileNotFoundError:
+            return False
+        return 0 <= age < self.metadata_max_age
+
+    def command(self, fresh: bool = None) -> list:
+        """
+        Return the package manager command line of the transaction
+
+        fresh tells whether the cached metadata can be used without a refresh;
+        it is looked up in cache_dir if None.
+        """
+        packages = self.packages
+        command = self.package_manager + ['install', '-y']
+        if self.root not in (None, '', '/'):
+            command += ['--installroot', str(self.root)]
+        command += [f'--setopt=cachedir={self.cache_dir}', '--setopt=keepcache=True']
+        if self.metadata_fresh() if fresh is None else fresh:
+            command.append('--setopt=*.metadata_expire=-1')
+        if getattr(packages, 'excludeDocs', False):
+            command.append('--setopt=tsflags=nodocs')
+        if getattr(packages, 'excludeWeakdeps', False):
+            command.append('--setopt=install_weak_deps=False')
+        if getattr(packages, 'multiLib', False):
+            command.append('--setopt=multilib_policy=all')
+        if getattr(packages, 'handleMissing', 0):
+            command.append('--setopt=strict=False')
+        if getattr(packages, 'handleBroken', 0):
+            command.append('--skip-broken')
+        if getattr(packages, 'timeout', None) is not None:
+            command.append(f'--setopt=timeout={packages.timeout}')
+        if getattr(packages, 'retries', None) is not None:
+            command.append(f'--setopt=retries={packages.retries}')
+        groups = getattr(packages, 'groupList', [])
+        if groups:
+            # the package types apply to the whole transaction, so the widest selection wins
+            include = max(group.include for group in groups)
+            if include != 1:
+                command.append(f'--setopt=group_package_types={self.GROUP_PACKAGE_TYPES[include]}')
+        command += [f'--exclude={name}' for name in getattr(packages, 'excludedList', [])]
+        return command + ['--'] + self.specs()
+
+    def execute(self):
+        excluded_groups = getattr(self.packages, 'excludedGroupList', [])
+        if excluded_groups:
+            print(f"Warning: excluding groups is not supported, ignoring {', '.join(g.name for g in excluded_groups)}")
+        specs = self.specs()
+        if not specs:
+            print('No packages to install')
+            return True
+        if self.root in (None, '', '/') and os.geteuid() != 0:
+            raise KickstartRootError("Must be root")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        refreshed = not self.metadata_fresh()
+        command = self.command()
+        print(f'Installing {len(specs)} packages and groups in one transaction: {shlex.join(command)}')
+        try:
+            result = subprocess.run(command)
+        except OSError as e:
+            raise KickstartError(f"Failed to run {self.package_manager[0]}: {e}")
+        if result.returncode != 0:
+            raise KickstartError(f"Package installation failed with exit code {result.returncode}")
+        if refreshed:
+            # the metadata in the cache is now current, so the next transactions can skip refreshing it
+            stamp = os.path.join(self.cache_dir, self.STAMP)
+            with open(stamp, 'a'):
+                pass
+            os.utime(stamp)
+        return True
+
+
+class ScriptExecutor:
+    """
+    Runs one kickstart %pre or %post script with a timeout, capturing its output.
+
+    Scripts run in the target root through chroot unless they are %pre or
+    --nochroot scripts, which run on the host with FAB_ROOT set to the target
+    root. The combined output is printed and, with --log, written to the log
+    file (inside the target root for chroot scripts).
+    """
+
+    # exit status reported for a script killed at its timeout, as timeout(1) does
+    TIMEOUT_STATUS = 124
+
+    def __init__(self, script: object, root: str = '/', timeout: int = None):
+        self.script = script
+        self.root = root or '/'
+        self.timeout = SCRIPT_TIMEOUT if timeout is None else timeout
+
+    @property
+    def in_chroot(self) -> bool:
+        return bool(getattr(self.script, 'inChroot', False)) and self.root != '/'
+
+    def execute(self) -> int:
+        """Run the script and return its exit status."""
+        interpreter = getattr(self.script, 'interp', None) or '/bin/sh'
+        directory = os.path.join(self.root, 'tmp') if self.in_chroot else None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix='fab-script-', suffix='.sh', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.script.script)
+            if self.in_chroot:
+                command = ['chroot', self.root, interpreter, '/' + os.path.relpath(path, self.root)]
+            else:
+                command = [interpreter, path]
+            env = dict(os.environ, FAB_ROOT=str(self.root))
+            try:
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                        cwd='/', timeout=self.timeout or None)
+                status, output = result.returncode, result.stdout
+            except subprocess.TimeoutExpired as e:
+                print(f'Script from line {self.script.lineno} timed out after {self.timeout}s')
+                status, output = self.TIMEOUT_STATUS, e.output
+            except OSError as e:
+                raise KickstartError(f"Failed to run script from line {self.script.lineno}: {e}")
+        finally:
+            os.unlink(path)
+        output = (output or b'').decode(errors='replace')
+        for line in output.splitlines():
+            print(f'  {line}')
+        logfile = getattr(self.script, 'logfile', None)
+        if logfile:
+            if self.in_chroot:
+                logfile = os.path.join(self.root, logfile.lstrip('/'))
+            os.makedirs(os.path.dirname(os.path.abspath(logfile)), exist_ok=True)
+            with open(logfile, 'a') as f:
+                f.write(output)
+        return status
@@ -2,6 +2,8 @@
 Configuration settings for FAB.
 """
 
+import os
+
 # Version information
 __version__ = "0.1.0"
 
@@ -9,3 +11,34 @@ __version__ = "0.1.0"
 APP_NAME = "FAB"
 APP_DESCRIPTION = "Fast Assembler for BootC"
 APP_LONG_DESCRIPTION = "A command-line interface tool for assembling BootC code."
+
+# Local state (stage cache index, etc.)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "fab")
+
+# Catalog index file name inside a catalog directory
+CATALOG_INDEX_NAME = "fab-catalog.json"
+
+# Number of trailing lines kept in memory per stage for failure summaries
+LOG_TAIL_LINES = 50
+
+# Unix socket of the `fab serve` daemon
+SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR", CACHE_DIR), "fab.sock")
+
+# Podman REST API socket used by `fab build --api`
+PODMAN_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/run"), "podman", "podman.sock")
+
+# Persistent download cache of the kickstart %packages transaction
+PACKAGE_CACHE_DIR = os.path.join(CACHE_DIR, "packages")
+
+# Seconds the package manager's repository metadata in PACKAGE_CACHE_DIR is used without a refresh
+PACKAGE_METADATA_MAX_AGE = 6 * 3600
+
+# Seconds each kickstart %pre/%post script may run before it is killed
+SCRIPT_TIMEOUT = 30 * 60
+
+# Images pulled at the same time before and while a build runs
+PULL_JOBS = 4
+
+# Stage images `fab gc` keeps by default, least recently used ones are removed first
+GC_MAX_IMAGES = 200
@@ -0,0 +1,194 @@
+"""
+Per-module build contexts: the files a module's Containerfile actually reads.
+"""
+
+import os
+import re
+import glob
+import json
+import shutil
+import logging
+import tempfile
+import contextlib
+
+# Ignore files the container tool applies to a build context
+IGNORE_FILES = ('.containerignore', '.dockerignore')
+
+REMOTE_SOURCE = re.compile(r'^(https?|git)://|^git@')
+
+
+def instructions(text):
+    """
+    Split a Containerfile into logical instructions.
+
+    Yields (keyword, lines) where keyword is the upper-cased instruction or None for
+    comments and blank lines, and lines are the physical lines it spans.
+    """
+    pending = []
+    for line in text.splitlines():
+        if not pending:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                yield None, [line]
+                continue
+        pending.append(line)
+        if line.rstrip().endswith('\\'):
+            continue
+        yield pending[0].split(None, 1)[0].upper(), pending
+        pending = []
+    if pending:
+        yield pending[0].split(None, 1)[0].upper(), pending
+
+
+def copy_sources(arguments):
+    """Return the source operands of a COPY/ADD argument string (flags and destination removed)."""
+    arguments = arguments.strip()
+    if arguments.startswith('['):
+        try:
+            return json.loads(arguments)[:-1]
+        except ValueError:
+            pass
+    return [word for word in arguments.split() if not word.startswith('--')][:-1]
+
+
+def _mount_options(mount):
+    options = {}
+    for option in mount.split(','):
+        name, _, value = option.partition('=')
+        options[name] = value
+    return options
+
+
+def containerfile_sources(path):
+    """
+    Return the context paths the Containerfile at path reads with COPY, ADD and bind mounts
+
+    Returns None if it may read the whole context: a source is '.', uses a
+    variable, or a bind mount has no source.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    sources = []
+    for keyword, lines in instructions(text):
+        if keyword not in ('COPY', 'ADD', 'RUN'):
+            continue
+        joined = ' '.join(line.rstrip().rstrip('\\') for line in lines)
+        if keyword == 'RUN':
+            for mount in re.findall(r'--mount=(\S+)', joined):
+                options = _mount_options(mount)
+                if options.get('type') != 'bind' or 'from' in options:
+                    continue
+                sources.append(options.get('source', options.get('src', '.')) or '.')
+            continue
+        if re.search(r'--from=\S+', joined) or '<<' in joined:
+            # another stage or image, or a heredoc: nothing from the context
+            continue
+        sources += [source for source in copy_sources(joined.split(None, 1)[1])
+                    if not (keyword == 'ADD' and REMOTE_SOURCE.match(source))]
+    for source in sources:
+        if '$' in source or os.path.normpath(source.lstrip('/')) in ('.', ''):
+            return None
+    return sources
+
+
+def containerfile_images(path):
+    """
+    Return the images the Containerfile at path pulls with FROM besides its first one
+
+    The first FROM is replaced by the parent stage (``--from``). Stage names,
+    ``scratch`` and references using variables are left out.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    images = []
+    stages = set()
+    first = True
+    for keyword, lines in instructions(text):
+        if keyword != 'FROM':
+            continue
+        words = [word for word in ' '.join(line.rstrip().rstrip('\\') for line in lines).split()[1:]
+                 if not word.startswith('--')]
+        if not words:
+            continue
+        reference = words[0]
+        if len(words) >= 3 and words[1].upper() == 'AS':
+            stages.add(words[2].lower())
+        if first:
+            first = False
+            continue
+        if '$' in reference or reference == 'scratch' or reference.lower() in stages:
+            continue
+        if reference not in images:
+            images.append(reference)
+    return images
+
+
+def _expand(directory, pattern):
+    """Yield the files below directory matched by a context path or glob pattern."""
+    pattern = os.path.normpath(pattern.lstrip('/'))
+    for match in sorted(glob.glob(os.path.join(glob.escape(directory), pattern))):
+        if os.path.isdir(match) and not os.path.islink(match):
+            for root, dirs, files in os.walk(match):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.relpath(os.path.join(root, name), directory)
+        elif os.path.lexists(match):
+            yield os.path.relpath(match, directory)
+
+
+def context_files(module):
+    """
+    Return the sorted relative paths of the files a module's build needs from its directory
+
+    The module's ``context`` list is used if it has one, otherwise the sources
+    of its Containerfile. The Containerfile and any ignore file are always
+    included. Returns None if the build needs the whole directory.
+    """
+    directory = str(module.working_dir)
+    patterns = module.definition.get('context')
+    if patterns is None:
+        patterns = containerfile_sources(module.containerfile_path)
+        if patterns is None:
+            return None
+    files = {os.path.normpath(module.containerfile)}
+    files.update(name for name in IGNORE_FILES if os.path.exists(os.path.join(directory, name)))
+    for pattern in patterns:
+        files.update(path for path in _expand(directory, pattern) if not path.startswith('..'))
+    return sorted(files)
+
+
+def _link(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+@contextlib.contextmanager
+def staged_context(module, parent=None, files=None):
+    """
+    Yield a build context directory for module holding only its context files
+
+    The files are hard linked (copied across file systems) into a temporary
+    directory below parent. Yields the module directory itself if the build
+    needs all of it.
+    """
+    files = context_files(module) if files is None else files
+    if files is None:
+        yield module.working_dir
+        return
+    if parent is not None:
+        os.makedirs(parent, exist_ok=True)
+    staged = tempfile.mkdtemp(prefix='fab-context-', dir=parent)
+    try:
+        directory = str(module.working_dir)
+        for relative in files:
+            _link(os.path.join(directory, relative), os.path.join(staged, relative))
+        logging.debug('Staged {} context files of {} in {}'.format(len(files), module.name, staged))
+        yield staged
+    finally:
+        shutil.rmtree(staged, ignore_errors=True)
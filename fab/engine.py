@@ -0,0 +1,418 @@
+"""
+Container engine backends: the container tool CLI, or the Podman REST API over its Unix socket.
+
+Both run the subset of container tool commands fab issues (build, pull, tag,
+images, image inspect, info and manifest), so StageBuilder does not care which
+one it talks to.
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import socket
+import logging
+import tarfile
+import argparse
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from .logstream import stream
+
+API_VERSION = 'v4.0.0'
+
+# Exit code of the container tool when the error is in the engine itself
+ENGINE_ERROR = 125
+
+# Placeholders of the --format templates fab uses, and the inspect fields they read
+TEMPLATE_FIELDS = {'Id': 'Id', 'ID': 'Id', 'Digest': 'Digest', 'Os': 'Os', 'Architecture': 'Architecture',
+                   'Size': 'Size'}
+
+
+class EngineError(Exception):
+    """Exception raised when an engine cannot run a command."""
+    pass
+
+
+class CliEngine:
+    """
+    Runs the container tool binary, one process per command
+    """
+
+    def __init__(self, container_tool='/usr/bin/podman', tool_args=""):
+        self.container_tool = container_tool
+        self.tool_args = tool_args
+        self.name = os.path.basename(container_tool)
+
+    def run(self, args, cwd, log, console, started=None):
+        """
+        Run a command, streaming its output into log and console, and return its exit code
+
+        started is called with the process once it runs, so it can be terminated.
+        """
+        command = [self.container_tool] + self.tool_args.split() + args
+        logging.debug('{}'.format(command))
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+        if started is not None:
+            started(process)
+        return stream(process, log, console)
+
+    def capture(self, args):
+        """
+        Run a command and return its stdout, or None if it failed
+        """
+        command = [self.container_tool] + self.tool_args.split() + args
+        logging.debug('{}'.format(command))
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode('utf-8')
+
+
+class _UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to a Unix socket, reused across requests
+    """
+
+    def __init__(self, path, size=8):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _UnixConnection(self.path)
+
+    def put(self, connection, response):
+        """Return a connection whose response was read to the end, unless the server closes it."""
+        if response.will_close:
+            connection.close()
+            return
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+class _Request:
+    """A running API request; terminate() aborts it by shutting down its connection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.returncode = None
+        self.terminated = False
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.terminated = True
+        if self.connection.sock is not None:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _messages(response):
+    """Yield the JSON objects of a streamed API response."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        data = response.read1(64 * 1024)
+        if not data:
+            break
+        buffer += data.decode('utf-8', 'replace')
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            try:
+                message, end = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+            buffer = buffer[end:]
+            yield message
+
+
+def _tar_stream(directory, extra=None):
+    """
+    Yield a tar archive of directory in chunks, written by a thread so it is never held in memory
+
+    extra maps archive names to files outside directory to add as well.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with os.fdopen(write_fd, 'wb') as f:
+            try:
+                with tarfile.open(fileobj=f, mode='w|') as tar:
+                    tar.add(directory, arcname='.')
+                    for name, path in (extra or {}).items():
+                        tar.add(path, arcname=name)
+            except (OSError, BrokenPipeError) as err:
+                logging.debug('Build context stream stopped: {}'.format(err))
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    with os.fdopen(read_fd, 'rb') as f:
+        for chunk in iter(lambda: f.read(256 * 1024), b''):
+            yield chunk
+    writer.join()
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog='build', add_help=False)
+    parser.add_argument('--from', dest='base')
+    parser.add_argument('--file', default='Containerfile')
+    parser.add_argument('--tag', action='append', default=[])
+    parser.add_argument('--build-arg', action='append', default=[])
+    parser.add_argument('--platform')
+    parser.add_argument('--target')
+    parser.add_argument('--iidfile')
+    parser.add_argument('--build-context', action='append', default=[])
+    parser.add_argument('context', nargs='?', default='.')
+    return parser
+
+
+class ApiEngine:
+    """
+    Talks to the Podman (libpod) REST API over its Unix socket.
+
+    Requests share a pool of keep-alive connections, build contexts are
+    streamed as tar archives and results are read from the structured JSON
+    progress messages: their output lines go to the stage log, the image ID to
+    the --iidfile and layer cache hits are counted on the log.
+    """
+
+    def __init__(self, socket_path, pool_size=8):
+        self.socket_path = socket_path
+        self.name = 'podman-api'
+        self.pool = ConnectionPool(socket_path, pool_size)
+        self._parser = _build_parser()
+
+    def _url(self, path, **params):
+        query = urllib.parse.urlencode([(name, value) for name, value in params.items() if value is not None],
+                                       doseq=True)
+        return '/{}/libpod{}{}'.format(API_VERSION, path, '?' + query if query else '')
+
+    def _request(self, method, path, body=None, headers=None, started=None, **params):
+        """
+        Send a request and return (status, connection, response, request)
+
+        The caller reads the response and hands the connection back to the pool.
+        """
+        url = self._url(path, **params)
+        logging.debug('{} {}'.format(method, url))
+        streamed = body is not None and not isinstance(body, (bytes, str))
+        # a pooled connection may have been closed by the server meanwhile; retry those once on a new one
+        for attempt in range(2):
+            connection = self.pool.get() if attempt == 0 else _UnixConnection(self.socket_path)
+            reused = connection.sock is not None
+            request = _Request(connection)
+            if started is not None:
+                started(request)
+            try:
+                connection.request(method, url, body=body, headers=headers or {}, encode_chunked=streamed)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException) as err:
+                connection.close()
+                if reused and not streamed and not request.terminated:
+                    continue
+                raise EngineError('Podman API at {}: {}'.format(self.socket_path, err))
+            return response.status, connection, response, request
+
+    def _call(self, method, path, body=None, **params):
+        """
+        Send a request and return (status, decoded JSON body or None)
+        """
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        status, connection, response, _ = self._request(
+            method, path, body, {'Content-Type': 'application/json'} if body else None, **params)
+        data = response.read()
+        self.pool.put(connection, response)
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, None
+
+    def _stream(self, method, path, log, console, started=None, body=None, headers=None, **params):
+        """
+        Send a request whose response is a JSON message stream, feeding its output to log
+
+        Returns:
+            Tuple of (exit code, last 'aux' or 'id' value seen)
+        """
+        console.started(log.name)
+        start = time.monotonic()
+        try:
+            status, connection, response, request = self._request(method, path, body, headers, started, **params)
+        except EngineError as err:
+            log.feed('Error: {}\n'.format(err).encode('utf-8'))
+            return self._finish(log, console, ENGINE_ERROR, start), None
+        result = None
+        error = status >= 400
+        try:
+            for message in _messages(response):
+                text = message.get('stream') or ''
+                if message.get('error'):
+                    error = True
+                    text = 'Error: {}\n'.format(message['error'])
+                if text:
+                    if re.search(r'^--> Using cache', text, re.MULTILINE):
+                        log.cache_hits = (log.cache_hits or 0) + 1
+                    for line in log.feed(text.encode('utf-8')):
+                        console.line(log.name, line)
+                aux = message.get('aux')
+                if isinstance(aux, dict) and aux.get('ID'):
+                    result = aux['ID']
+                elif message.get('id') and not message.get('stream'):
+                    result = message['id']
+            self.pool.put(connection, response)
+        except (OSError, http.client.HTTPException) as err:
+            connection.close()
+            log.feed('Error: {}\n'.format(err).encode('utf-8'))
+            error = True
+        rc = request.returncode = self._finish(log, console, 1 if error or request.terminated else 0, start)
+        return rc, result
+
+    def _finish(self, log, console, rc, start):
+        for line in log.close():
+            console.line(log.name, line)
+        log.returncode = rc
+        log.elapsed = time.monotonic() - start
+        console.finished(log, rc, log.elapsed)
+        return rc
+
+    def run(self, args, cwd, log, console, started=None):
+        """
+        Run a container tool command through the API and return its exit code
+        """
+        command, args = args[0], args[1:]
+        if command == 'build':
+            return self._build(args, cwd, log, console, started)
+        if command == 'pull':
+            platform = args[args.index('--platform') + 1].split('/') if '--platform' in args else []
+            rc, _ = self._stream('POST', '/images/pull', log, console, started, reference=args[-1],
+                                 os=platform[0] if platform else None, arch=platform[1] if platform else None,
+                                 variant=platform[2] if len(platform) > 2 else None)
+            return rc
+        if command == 'tag':
+            repository, _, tag = args[1].rpartition(':')
+            if not repository or '/' in tag:
+                repository, tag = args[1], 'latest'
+            status, _ = self._call('POST', '/images/{}/tag'.format(urllib.parse.quote(args[0], safe='')),
+                                   repo=repository, tag=tag)
+            return 0 if status < 300 else 1
+        if command == 'manifest':
+            return self._manifest(args)
+        if command == 'rmi':
+            rc = 0
+            for name in args:
+                status, _ = self._call('DELETE', '/images/{}'.format(urllib.parse.quote(name, safe='')))
+                rc = rc or (0 if status < 300 else 1)
+            return rc
+        raise EngineError('The Podman API backend does not support "{}"'.format(command))
+
+    def _build(self, args, cwd, log, console, started):
+        options, unknown = self._parser.parse_known_args(args)
+        if unknown or options.build_context:
+            raise EngineError('The Podman API backend cannot build with {}'.format(
+                ' '.join(unknown) or '--build-context'))
+        context = os.path.join(cwd or '.', options.context)
+        containerfile = os.path.join(cwd or '.', options.file)
+        extra = {}
+        dockerfile = os.path.relpath(containerfile, context)
+        if dockerfile.startswith('..'):
+            # a Containerfile outside the context travels in the archive under a private name
+            dockerfile = '.fab.Containerfile'
+            extra[dockerfile] = containerfile
+        buildargs = dict(arg.split('=', 1) for arg in options.build_arg)
+        platform = options.platform
+        log.cache_hits = 0
+        rc, image_id = self._stream(
+            'POST', '/build', log, console, started, body=_tar_stream(context, extra),
+            headers={'Content-Type': 'application/x-tar'}, dockerfile=dockerfile, t=options.tag,
+            buildargs=json.dumps(buildargs) if buildargs else None, platform=platform, target=options.target,
+            **{'from': options.base})
+        if rc == 0 and options.iidfile and image_id:
+            with open(options.iidfile, 'w') as f:
+                f.write(image_id)
+        return rc if image_id or rc else 1
+
+    def _manifest(self, args):
+        action, name = args[0], args[1]
+        quoted = urllib.parse.quote(name, safe='')
+        if action == 'exists':
+            status, _ = self._call('GET', '/manifests/{}/exists'.format(quoted))
+        elif action == 'rm':
+            status, _ = self._call('DELETE', '/manifests/{}'.format(quoted))
+        elif action == 'create':
+            status, _ = self._call('POST', '/manifests', name=name)
+        elif action == 'add':
+            status, _ = self._call('POST', '/manifests/{}/add'.format(quoted), body={'images': [args[2]]})
+        else:
+            raise EngineError('The Podman API backend does not support "manifest {}"'.format(action))
+        return 0 if status < 300 else 1
+
+    def _render(self, template, fields):
+        def field(match):
+            name = TEMPLATE_FIELDS.get(match.group(1))
+            if name is None:
+                raise EngineError('Unsupported format field {}'.format(match.group(0)))
+            return str(fields.get(name, ''))
+        return re.sub(r'\{\{\s*\.(\w+)\s*\}\}', field, template)
+
+    def capture(self, args):
+        """
+        Run a container tool query through the API and return its would-be stdout, or None if it failed
+        """
+        template = args[args.index('--format') + 1] if '--format' in args else None
+        try:
+            if args[0] == 'images':
+                status, images = self._call('GET', '/images/json')
+                if status >= 300:
+                    return None
+                lines = []
+                for image in images or []:
+                    for name in image.get('RepoTags') or image.get('Names') or []:
+                        lines.append('{} {}'.format(name, image['Id']))
+                return ''.join(line + '\n' for line in lines)
+            if args[:2] == ['image', 'inspect']:
+                names = [name for name in args[2:] if name != '--format' and name != template]
+                lines = []
+                for name in names:
+                    status, image = self._call('GET', '/images/{}/json'.format(urllib.parse.quote(name, safe='')))
+                    if status >= 300 or not image:
+                        return None
+                    lines.append(self._render(template or '{{.Id}}', image) + '\n')
+                return ''.join(lines)
+            if args[0] == 'info':
+                status, _ = self._call('GET', '/info')
+                return '' if status < 300 else None
+        except EngineError as err:
+            logging.debug('{}'.format(err))
+            return None
+        raise EngineError('The Podman API backend does not support "{}"'.format(' '.join(args[:2])))
+
+    def close(self):
+        self.pool.close()
@@ -1,7 +1,10 @@
-import yaml
+import os
 import logging
-import subprocess
-from .module import FabModule
+from .module import FabModule, load_yaml
+from .catalog import Catalog
+from .sources import SourceCache, is_remote
+from .builder import StageBuilder
+from .matrix import MatrixBuild
 
 
 class FabFile:
@@ -9,13 +12,20 @@ class FabFile:
     Fabfile definition
     """
 
-    def __init__(self, source, container_tool='/usr/bin/podman', tool_args=""):
+    def __init__(self, source, container_tool='/usr/bin/podman', tool_args="", stage_cache=True, definition=None,
+                 catalogs=None, sources=None):
         self.source = source
         self.name = source
         self.container_tool = container_tool
         self.tool_args = tool_args
+        self.stage_cache = stage_cache
+        self.catalogs = list(catalogs or [])
+        self.sources = sources
         self.includes = []
-        self._read()
+        if definition is None:
+            self._read()
+        else:
+            self.definition = definition
         logging.debug('Read Fabfile: {}'.format(self.definition))
         if not self._validate():
             raise Exception('Fabfile not valid')
@@ -24,7 +34,7 @@ class FabFile:
 
     def _read(self):
         f = open(self.source, 'r')
-        self.definition = yaml.load(f, Loader=yaml.Loader)
+        self.definition = load_yaml(f)
         f.close()
 
     def _validate(self):
@@ -59,62 +69,156 @@ class FabFile:
         else:
             self.definition['buildargs'] = []
 
+        if 'catalog' in self.definition:
+            if isinstance(self.definition['catalog'], str):
+                self.definition['catalog'] = [self.definition['catalog']]
+            if not isinstance(self.definition['catalog'], list):
+                logging.error("'catalog' is not a string or a list")
+                is_valid = False
+
+        if 'matrix' in self.definition:
+            if not isinstance(self.definition['matrix'], list):
+                logging.error("'matrix' is not a list")
+                is_valid = False
+            elif not all(isinstance(variant, dict) for variant in self.definition['matrix']):
+                logging.error("'matrix' entries must be mappings")
+                is_valid = False
+
         return (is_valid)
 
+    def buildargs(self):
+        """
+        Return the global buildargs as a dict
+        """
+        buildargs = {}
+        for arg in self.definition['buildargs']:
+            for key in arg:
+                buildargs[key] = arg[key]
+        return buildargs
+
+    def check_buildargs(self):
+        """
+        Return warnings about buildargs that are declared but unset, or set but undeclared
+
+        Looks at the image itself, so call it on the images a matrix Fabfile expands into.
+        """
+        warnings = []
+        buildargs = self.buildargs()
+        declared = set()
+        for module in self.includes:
+            names = module.declared_buildargs()
+            declared.update(names)
+            values = getattr(module, 'var_values', None) or {}
+            read = module.containerfile_args()
+            for name in names:
+                if name not in read:
+                    warnings.append("Module {} declares build arg {} but its Containerfile has no ARG {}".format(
+                        module.name, name, name))
+                elif name not in values and name not in buildargs:
+                    warnings.append('Module {} declares build arg {} but {} does not set it'.format(
+                        module.name, name, self.name))
+            for name in values:
+                if name not in names:
+                    warnings.append('Build arg {} is set for module {}, which does not declare it'.format(
+                        name, module.name))
+        for name in buildargs:
+            if name not in declared:
+                warnings.append('Build arg {} is set in {} but no included module declares it'.format(name, self.name))
+        return warnings
+
+    def images(self):
+        """
+        Expand the Fabfile into the images it defines.
+
+        Without a 'matrix' key this is the Fabfile itself. Otherwise every matrix entry
+        is an image named after its 'name', with its 'include' list appended to the
+        Fabfile's and its 'buildargs' overriding the Fabfile's.
+        """
+        if 'matrix' not in self.definition:
+            return [self]
+        images = []
+        for index, variant in enumerate(self.definition['matrix']):
+            definition = dict(self.definition)
+            del definition['matrix']
+            # hand over the catalogs already opened for this Fabfile
+            definition.pop('catalog', None)
+            definition['metadata'] = dict(self.definition['metadata'])
+            definition['metadata']['name'] = variant.get('name', '{}-{}'.format(self.name, index))
+            definition['include'] = self.definition['include'] + variant.get('include', [])
+            buildargs = self.buildargs()
+            for arg in variant.get('buildargs', []):
+                for key in arg:
+                    buildargs[key] = arg[key]
+            definition['buildargs'] = [{key: value} for key, value in buildargs.items()]
+            images.append(FabFile(self.source, self.container_tool, self.tool_args, self.stage_cache,
+                                  definition=definition, catalogs=self._catalogs, sources=self.sources))
+        return images
+
+    def _open_catalogs(self):
+        catalogs = []
+        for path in self.definition.get('catalog', []) + self.catalogs:
+            if isinstance(path, Catalog):
+                catalogs.append(path)
+            else:
+                catalogs.append(Catalog.open(path))
+        return catalogs
+
+    def _module(self, source, catalogs, var_values, fetched):
+        """
+        Load an include: a module YAML path, a fetched remote source or the name of a module in a catalog
+        """
+        if source in fetched:
+            return FabModule(source=fetched[source], var_values=var_values, origin=source)
+        if catalogs and not os.path.isfile(source):
+            for catalog in catalogs:
+                module = catalog.module(source, var_values=var_values)
+                if module is not None:
+                    logging.debug('Found module {} in catalog {}'.format(source, catalog.root))
+                    return module
+        return FabModule(source=source, var_values=var_values)
+
     def _load_includes(self):
+        catalogs = self._catalogs = self._open_catalogs()
+        includes = []
         for include in self.definition['include']:
             if isinstance(include, str):
                 _include = include
                 _var_values = {}
             elif isinstance(include, dict):
                 _include = include['include']
+                _var_values = {}
                 if 'buildargs' in include.keys():
                     for item in include['buildargs']:
                         for key in item:
                             _var_values[key] = item[key]
                 else:
                     logging.debug('No "buildargs" set for {}'.format(include))
-                    _var_values = {}
+            includes.append((_include, _var_values))
+
+        # fetch every remote module at once rather than one include at a time
+        remote = [source for source, _ in includes if is_remote(source)]
+        fetched = {}
+        if remote:
+            if self.sources is None:
+                self.sources = SourceCache()
+            fetched = self.sources.fetch_all(remote)
+
+        for _include, _var_values in includes:
             logging.debug('Add new module {} with buildargs {}'.format(_include, _var_values))
-            self.includes.append(FabModule(source=_include, var_values=_var_values))
-
-    def _run(self, command, args, cwd):
-        logging.debug('{} {}'.format(command, args))
-        process = subprocess.Popen([command] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
-        while True:
-            output = process.stdout.readline().rstrip().decode('utf-8')
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print('    {}'.format(output.strip()))
-        rc = process.poll()
-        return rc
-
-    def build(self):
-        previous_container_image = self.definition['from']
-        print(len(self.includes))
-        for module in self.includes:
-            tag = '{}-stage-{}'.format(
-                self.name,
-                module.name)
-            podman_args = self.tool_args.split()
-            podman_args.append('build')
-            podman_args.append('--from')
-            podman_args.append(previous_container_image)
-            podman_args.append('--file')
-            podman_args.append(module.containerfile)
-            podman_args.append('--tag')
-            podman_args.append(tag)
-            for arg in self.definition['buildargs']:
-                for key in arg:
-                    podman_args.append('--build-arg')
-                    podman_args.append('{}={}'.format(key, arg[key]))
-            logging.debug('podman command: {}'.format(podman_args))
-            logging.info('Start build of {} stage'.format(tag))
-            self._run(self.container_tool, podman_args, module.working_dir)
-            previous_container_image = tag
-        podman_args = self.tool_args.split()
-        podman_args.append('tag')
-        podman_args.append(previous_container_image)
-        podman_args.append(self.name)
-        self._run(self.container_tool, podman_args, None)
+            self.includes.append(self._module(_include, catalogs, _var_values, fetched))
+        for catalog in catalogs:
+            try:
+                catalog.save()
+            except OSError as err:
+                logging.debug('Could not update catalog index {}: {}'.format(catalog.index_path, err))
+
+    def build(self, jobs=1, builder=None):
+        """
+        Build the image (or every matrix image) defined by the Fabfile
+
+        Returns:
+            True if every stage and final tag succeeded
+        """
+        if builder is None:
+            builder = StageBuilder(self.container_tool, self.tool_args, self.stage_cache)
+        return MatrixBuild(self.images(), builder, jobs).build()
@@ -0,0 +1,241 @@
+"""
+Build farm: schedule the stage chains of a matrix build across several container engines.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import concurrent.futures
+from .builder import StageBuilder, report_buildargs
+from .cache import StageCache
+from .config import CACHE_DIR
+from .matrix import MatrixBuild
+
+
+class HostError(Exception):
+    """Exception raised when a build host stops answering."""
+    pass
+
+
+class BuildHost:
+    """
+    One container engine of the farm, reached through the container tool's --connection or --url
+    """
+
+    def __init__(self, name, builder, capacity=1):
+        self.name = name
+        self.builder = builder
+        self.capacity = max(1, capacity)
+        self.active = 0
+        self.down = False
+        self.built = 0
+        self.cached = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    @classmethod
+    def parse(cls, spec, container_tool='/usr/bin/podman', tool_args="", **kwargs):
+        """
+        Create a host from ENDPOINT[,capacity=N]
+
+        ENDPOINT is a URL (passed with --url) or the name of a system connection
+        (passed with --connection). Other keyword arguments go to its StageBuilder,
+        which keeps its own stage cache.
+        """
+        endpoint, *options = spec.split(',')
+        capacity = 1
+        for option in options:
+            name, _, value = option.partition('=')
+            if name != 'capacity' or not value.isdigit():
+                raise ValueError('Unknown build node option {!r} in {!r}'.format(option, spec))
+            capacity = int(value)
+        flag = '--url' if '://' in endpoint else '--connection'
+        directory = os.path.join(kwargs.pop('cache_dir', None) or CACHE_DIR, 'nodes',
+                                 re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint))
+        builder = StageBuilder(container_tool, '{} {} {}'.format(tool_args, flag, endpoint).strip(),
+                               cache=StageCache(os.path.join(directory, 'stages.json')), **kwargs)
+        return cls(endpoint, builder, capacity)
+
+    @property
+    def free(self):
+        return not self.down and self.active < self.capacity
+
+
+class FarmBuild(MatrixBuild):
+    """
+    Build a set of images on a pool of build hosts.
+
+    Stage chains are placed as a whole: a stage runs on the host holding its
+    parent stage image, and chains starting at a base image go to the free host
+    that already holds their first stage, then the base image, then the least
+    loaded one. When a host stops answering its stages are retried elsewhere,
+    rebuilding the ancestors the new host is missing.
+    """
+
+    def __init__(self, fabfiles, hosts):
+        super().__init__(fabfiles, hosts[0].builder, jobs=sum(host.capacity for host in hosts))
+        self.hosts = hosts
+        # (node, host) -> image ID of the node on that host
+        self.built = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+        self.elapsed = 0.0
+
+    def _node_lock(self, node, host):
+        with self._guard:
+            return self._locks.setdefault((id(node), host.name), threading.Lock())
+
+    def _count(self, host, field, amount=1):
+        with self._guard:
+            setattr(host, field, getattr(host, field) + amount)
+
+    def _check(self, host):
+        if not host.builder.available():
+            raise HostError('Build node {} is not answering'.format(host.name))
+
+    def _ensure(self, node, host):
+        """
+        Return the ID of node's image on host, building it and any missing ancestors there
+
+        Returns None if a stage failed to build, raises HostError if host failed.
+        """
+        with self._node_lock(node, host):
+            if (id(node), host.name) in self.built:
+                return self.built[(id(node), host.name)]
+            builder = host.builder
+            if node.module is None:
+                image_id = builder.resolve_image(node.base)
+                if image_id is None:
+                    builder.pull(node.base)
+                    image_id = builder.resolve_image(node.base)
+                if image_id is None:
+                    self._check(host)
+                    logging.error('Could not pull {} on {}'.format(node.base, host.name))
+                    return None
+            else:
+                parent_id = self._ensure(node.parent, host)
+                if parent_id is None:
+                    return None
+                # the base image ID is the one on this host: hosts may hold different copies of a tag
+                parent = parent_id if node.parent.module is None else node.parent.tags[0]
+                tag = node.tags[0]
+                key = builder.stage_key(node.module, parent_id, node.buildargs)
+                log = builder.logs.get(tag)
+                image_id = builder.build_stage(node.module, parent, parent_id, tag, node.buildargs, key=key)
+                if image_id is None:
+                    self._check(host)
+                    self._count(host, 'failed')
+                    return None
+                self._count(host, 'cached' if builder.logs.get(tag) is log else 'built')
+                for alias in node.tags[1:]:
+                    if builder.resolve_image(alias) != image_id and not builder.tag(tag, alias):
+                        return None
+                    builder.remember(alias, key, image_id, parent_id)
+            for image in node.images:
+                logging.info('Tagging {} as {} on {}'.format(node.reference, image, host.name))
+                if not builder.tag(image_id if node.module is None else node.tags[0], image):
+                    return None
+            self.built[(id(node), host.name)] = image_id
+            return image_id
+
+    def _run(self, node, host):
+        start = time.monotonic()
+        try:
+            return self._ensure(node, host)
+        finally:
+            self._count(host, 'busy', time.monotonic() - start)
+
+    def _holds(self, host, reference, image_id=None):
+        found = host.builder.resolve_image(reference)
+        return found is not None and (image_id is None or found == image_id)
+
+    def _place(self, node):
+        """
+        Pick the host to build node on, or None if the host it should go to is busy
+        """
+        parent = node.parent
+        if parent.module is not None:
+            owners = [host for host in self.hosts if not host.down and (id(parent), host.name) in self.built]
+            if owners:
+                return owners[0] if owners[0].free else None
+        candidates = [host for host in self.hosts if host.free]
+        if not candidates:
+            return None
+        tag = node.tags[0]
+
+        def affinity(host):
+            entry = host.builder.cache.entries.get(tag)
+            return (entry is not None and self._holds(host, tag, entry.get('id')),
+                    parent.module is None and self._holds(host, parent.base),
+                    -host.active / host.capacity)
+        return max(candidates, key=affinity)
+
+    def build(self):
+        report_buildargs(self.images)
+        start = time.monotonic()
+        success = True
+        ready = []
+        for root in self.tree.roots.values():
+            ready += root.children.values()
+            if root.images:
+                # images without modules are the base image retagged
+                ready.append(root)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running = {}
+            while ready or running:
+                waiting = []
+                for node in ready:
+                    if all(host.down for host in self.hosts):
+                        logging.error('No build node left for {}'.format(node.tags[0] if node.tags else node.base))
+                        success = False
+                        continue
+                    host = self._place(node) if node.module is not None else next(
+                        (host for host in self.hosts if host.free), None)
+                    if host is None:
+                        waiting.append(node)
+                        continue
+                    host.active += 1
+                    running[pool.submit(self._run, node, host)] = (node, host)
+                ready = waiting
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node, host = running.pop(future)
+                    host.active -= 1
+                    try:
+                        image_id = future.result()
+                    except HostError as err:
+                        logging.warning('{}, retrying its stages on the other nodes'.format(err))
+                        host.down = True
+                        ready.append(node)
+                        continue
+                    except Exception as err:
+                        logging.error('Build on {} failed: {}'.format(host.name, err))
+                        image_id = None
+                    if image_id is not None:
+                        if node.module is not None:
+                            ready += node.children.values()
+                    else:
+                        if node.module is not None:
+                            logging.error('Skipping {} stages depending on {}'.format(
+                                sum(1 for _ in node.walk()) - 1, node.tags[0]))
+                        success = False
+        self.elapsed = time.monotonic() - start
+        return success
+
+    def summary(self):
+        """
+        Return a table of the work done by every build host
+        """
+        header = '{:<32} {:>8} {:>6} {:>6} {:>6} {:>8} {:>7} {:<6}'.format(
+            'Node', 'Capacity', 'Built', 'Cached', 'Failed', 'Busy', 'Util', 'Status')
+        lines = [header, '-' * len(header)]
+        for host in self.hosts:
+            utilization = host.busy / (self.elapsed * host.capacity) if self.elapsed else 0.0
+            lines.append('{:<32} {:>8} {:>6} {:>6} {:>6} {:>7.1f}s {:>6.0%} {:<6}'.format(
+                host.name[:32], host.capacity, host.built, host.cached, host.failed, host.busy, utilization,
+                'down' if host.down else 'up'))
+        return '\n'.join(lines)
@@ -0,0 +1,224 @@
+"""
+Stage fusion: compile a Fabfile's include chain into one multi-stage Containerfile.
+"""
+
+import os
+import re
+import logging
+import time
+import tempfile
+import contextlib
+import concurrent.futures
+from .builder import report_buildargs, used_buildargs
+from .context import REMOTE_SOURCE, copy_sources, instructions, staged_context
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar.zst', '.gz', '.xz')
+
+
+class FusionError(Exception):
+    """Exception raised when a module cannot be rendered as a fused stage."""
+    pass
+
+
+def render_module(index, module, parent):
+    """
+    Render one module's Containerfile as fused stages.
+
+    The module's first FROM is replaced by parent, its last stage is named
+    ``stage<index>`` and its internal stages are namespaced so they cannot collide
+    with other modules. Instructions reading from the build context are pointed at
+    the ``module<index>`` additional build context.
+
+    Returns:
+        Tuple of (global ARG lines declared before the first FROM, stage lines)
+    """
+    with open(module.containerfile_path, 'r') as f:
+        parsed = list(instructions(f.read()))
+    context = 'module{}'.format(index)
+    froms = [lines for keyword, lines in parsed if keyword == 'FROM']
+    if not froms:
+        raise FusionError('No FROM instruction in {}'.format(module.containerfile_path))
+
+    # map the module's own stage names (and indexes) to namespaced ones
+    names = {}
+    for number, lines in enumerate(froms):
+        words = ' '.join(line.rstrip('\\') for line in lines).split()
+        new = 'stage{}'.format(index) if number == len(froms) - 1 else 'stage{}-{}'.format(index, number)
+        names[str(number)] = new
+        if len(words) >= 4 and words[-2].upper() == 'AS':
+            names[words[-1].lower()] = new
+
+    global_args = []
+    body = ['# module {} ({})'.format(module.name, module.containerfile_path)]
+    seen_from = 0
+    for keyword, lines in parsed:
+        if keyword is None:
+            if seen_from:
+                body += lines
+            continue
+        if not seen_from and keyword == 'ARG':
+            global_args.append('\n'.join(lines))
+            continue
+        if keyword == 'FROM':
+            words = ' '.join(line.rstrip('\\') for line in lines).split()
+            flags = [word for word in words[1:] if word.startswith('--')]
+            image = [word for word in words[1:] if not word.startswith('--')][0]
+            image = parent if seen_from == 0 else names.get(image.lower(), image)
+            body.append(' '.join(['FROM'] + flags + [image, 'AS', names[str(seen_from)]]))
+            seen_from += 1
+            continue
+        first = lines[0]
+        if keyword in ('COPY', 'ADD'):
+            match = re.search(r'--from=(\S+)', first)
+            if match:
+                source = match.group(1)
+                first = first.replace(match.group(0), '--from={}'.format(names.get(source.lower(), source)), 1)
+            else:
+                sources = copy_sources(' '.join(line.rstrip('\\') for line in lines).split(None, 1)[1])
+                remote = [src for src in sources if REMOTE_SOURCE.match(src)]
+                if keyword == 'ADD' and remote:
+                    if len(remote) != len(sources):
+                        raise FusionError('Cannot fuse ADD mixing remote and local sources in {}'.format(
+                            module.containerfile_path))
+                else:
+                    if keyword == 'ADD' and any(src.endswith(ARCHIVE_SUFFIXES) for src in sources):
+                        raise FusionError('Cannot fuse ADD of a local archive in {}'.format(module.containerfile_path))
+                    # ADD of plain local files behaves like COPY, which can read another context
+                    first = re.sub(r'^(\s*)(COPY|ADD)\b', r'\1COPY --from={}'.format(context), first, count=1,
+                                   flags=re.IGNORECASE)
+        elif keyword == 'RUN':
+            def bind_from(match):
+                mount = match.group(0)
+                if 'type=bind' not in mount or 'from=' in mount:
+                    return mount
+                return '{},from={}'.format(mount, context)
+            first = re.sub(r'--mount=\S+', bind_from, first)
+        body.append(first)
+        body += lines[1:]
+    return global_args, body
+
+
+def render_containerfile(fabfile):
+    """
+    Render the include chain of fabfile as one multi-stage Containerfile.
+
+    Returns:
+        Tuple of (Containerfile text, dict of additional build context names to directories)
+    """
+    global_args = []
+    declared = set()
+    stages = []
+    contexts = {}
+    parent = fabfile.definition['from']
+    for index, module in enumerate(fabfile.includes):
+        args, body = render_module(index, module, parent)
+        for line in args:
+            name = line.split(None, 1)[1].split('=', 1)[0].strip()
+            if name not in declared:
+                declared.add(name)
+                global_args.append(line)
+        stages += [''] + body
+        contexts['module{}'.format(index)] = os.path.abspath(module.working_dir)
+        parent = 'stage{}'.format(index)
+    header = ['# Generated by fab from {}'.format(fabfile.source)]
+    if not fabfile.includes:
+        stages = ['', 'FROM {}'.format(parent)]
+    return '\n'.join(header + global_args + stages) + '\n', contexts
+
+
+def fused_buildargs(fabfile):
+    """
+    Return the build args of a fused build: the union of every module's scoped build args
+
+    Build args apply to the whole fused Containerfile, so modules that get
+    different values for the same arg cannot be fused.
+    """
+    buildargs = {}
+    for module in fabfile.includes:
+        for name, value in used_buildargs(module, fabfile.buildargs()).items():
+            if buildargs.setdefault(name, value) != value:
+                raise FusionError('Modules of {} set build arg {} to different values'.format(fabfile.name, name))
+    return buildargs
+
+
+class FusedBuild:
+    """
+    Build a Fabfile's whole include chain with a single container tool invocation
+    """
+
+    def __init__(self, fabfile, builder, stage_tags=False):
+        self.fabfile = fabfile
+        self.builder = builder
+        self.stage_tags = stage_tags
+
+    def _key(self, parent_id):
+        key = parent_id
+        buildargs = self.fabfile.buildargs()
+        for module in self.fabfile.includes:
+            key = self.builder.stage_key(module, key, buildargs)
+        return key
+
+    def build(self):
+        fabfile = self.fabfile
+        try:
+            containerfile, contexts = render_containerfile(fabfile)
+            buildargs = fused_buildargs(fabfile)
+        except (FusionError, OSError) as err:
+            logging.error('Cannot fuse {}: {}'.format(fabfile.name, err))
+            return False
+        key = self._key(self.builder.resolve_base(fabfile.definition['from']))
+        start = time.monotonic()
+        span = {'modules': len(fabfile.includes), 'cache': 'miss' if self.builder.stage_cache else 'off'}
+        if self.builder.stage_cache and not self.stage_tags:
+            image_id = self.builder.cache.lookup(fabfile.name, key)
+            if image_id is not None and self.builder.resolve_image(fabfile.name) == image_id:
+                logging.info('Reusing cached fused build of {} ({})'.format(fabfile.name, image_id[:12]))
+                if self.builder.tracer is not None:
+                    self.builder.tracer.span(fabfile.name, 'cache', start, **dict(span, cache='hit'))
+                return True
+
+        with tempfile.TemporaryDirectory(prefix='fab-fuse-') as workdir, contextlib.ExitStack() as staged:
+            path = os.path.join(workdir, 'Containerfile')
+            with open(path, 'w') as f:
+                f.write(containerfile)
+            logging.debug('Fused Containerfile for {}:\n{}'.format(fabfile.name, containerfile))
+            args = ['--file', path]
+            for index, module in enumerate(fabfile.includes):
+                contexts['module{}'.format(index)] = os.path.abspath(
+                    staged.enter_context(staged_context(module, self.builder.context_dir)))
+            for name, directory in contexts.items():
+                args += ['--build-context', '{}={}'.format(name, directory)]
+            for name, value in buildargs.items():
+                args += ['--build-arg', '{}={}'.format(name, value)]
+            logging.info('Start fused build of {} ({} stages)'.format(fabfile.name, len(fabfile.includes)))
+            # the generated file reads everything through named contexts, so the main context stays empty
+            context = os.path.join(workdir, 'context')
+            os.mkdir(context)
+            image_id = self.builder.build_image(args + ['--tag', fabfile.name, context], workdir, fabfile.name, span)
+            if image_id is None:
+                logging.error('Fused build of {} failed'.format(fabfile.name))
+                return False
+            self.builder.remember(fabfile.name, key, image_id)
+
+            if self.stage_tags:
+                # every stage is in the layer cache now, so these only commit and tag
+                for index, module in enumerate(fabfile.includes):
+                    tag = '{}-stage-{}'.format(fabfile.name, module.name)
+                    target = ['--target', 'stage{}'.format(index), '--tag', tag, context]
+                    if self.builder.build_image(args + target, workdir, tag, {'cache': 'layers'}) is None:
+                        logging.error('Could not tag {} stage'.format(tag))
+                        return False
+        return True
+
+
+def build_fused(fabfiles, builder, jobs=1, stage_tags=False):
+    """
+    Fuse and build every Fabfile, up to jobs at a time
+
+    Returns:
+        True if every build succeeded
+    """
+    report_buildargs(fabfiles)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = pool.map(lambda fabfile: FusedBuild(fabfile, builder, stage_tags).build(), fabfiles)
+        return all(list(results))
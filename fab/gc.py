@@ -0,0 +1,188 @@
+"""
+Garbage collection of stage images: least recently used first, down to an image count or disk budget.
+"""
+
+import os
+import re
+import logging
+from .builder import image_names
+from .lock import FabLock, LockError, known_locks
+
+# Stage images are tagged <name>-stage-<module>; other cache entries (fused images) are final images
+STAGE_MARK = '-stage-'
+
+SIZE_UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+              'KI': 1024, 'MI': 1024 ** 2, 'GI': 1024 ** 3, 'TI': 1024 ** 4}
+
+
+def parse_size(text):
+    """
+    Return the number of bytes in a size such as 500M, 20G, 1.5GiB or 1048576
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]I?)?B?\s*$', str(text), re.IGNORECASE)
+    if match is None:
+        raise ValueError('Invalid size {!r}'.format(text))
+    return int(float(match.group(1)) * SIZE_UNITS[(match.group(2) or '').upper()])
+
+
+def format_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return '{:.1f}{}'.format(size, unit) if unit != 'B' else '{}B'.format(int(size))
+        size /= 1000
+    return '{:.1f}TB'.format(size)
+
+
+class StageImage:
+    """
+    One stage image in the stage cache: its ID and the stage tags pointing at it
+    """
+
+    def __init__(self, image_id):
+        self.id = image_id
+        self.tags = []
+        self.used = 0.0
+        self.parent = None
+        # bytes of its own layers, on top of its parent
+        self.size = 0
+        # names of the image that are not stage tags, such as the final image of a Fabfile
+        self.others = []
+
+
+class StageCollector:
+    """
+    Remove the stage images fab created, least recently used first, until they fit a budget.
+
+    The budget is a number of stage images (max_images) and/or the disk space
+    their own layers use (max_size, bytes). Stage images recorded in a lock file
+    (the ones builds registered, plus locks) and the ones tagged protect are
+    never removed, and neither is a stage another kept stage is built on or
+    one that other names still point at: removing its stage tags would only
+    untag it. Images a stage tag pointed at before it was rebuilt are removed
+    first.
+    """
+
+    def __init__(self, builder, max_images=None, max_size=None, locks=(), protect=()):
+        self.builder = builder
+        self.cache = builder.cache
+        self.max_images = max_images
+        self.max_size = max_size
+        self.locks = list(locks)
+        self.protect = set(protect)
+
+    def _protected(self):
+        ids = set()
+        locks = list(self.locks)
+        for path in known_locks(str(self.cache.path.parent)):
+            lock = FabLock(path)
+            try:
+                lock.load()
+            except LockError as err:
+                logging.warning('{}; its stages are not protected'.format(err))
+                continue
+            locks.append(lock)
+        for lock in locks:
+            ids |= lock.image_ids()
+        for tag in self.protect:
+            entry = self.cache.entries.get(tag)
+            if entry is not None:
+                ids.add(entry['id'])
+        return ids
+
+    def images(self):
+        """
+        Return the stage images still present, by ID, and forget the cache entries whose image is gone
+        """
+        listed = self.builder.image_tags()
+        images = {}
+        for tag, entry in sorted(self.cache.entries.items()):
+            if STAGE_MARK not in tag:
+                continue
+            if self.builder.resolve_image(tag) != entry['id']:
+                logging.debug('Forgetting {}: its image is gone'.format(tag))
+                self.cache.forget(tag)
+                continue
+            image = images.setdefault(entry['id'], StageImage(entry['id']))
+            image.tags.append(tag)
+            image.used = max(image.used, entry.get('used', 0.0))
+            image.parent = entry.get('parent') or image.parent
+        sizes = self.builder.image_sizes(set(images) | {image.parent for image in images.values() if image.parent})
+        for image in images.values():
+            image.size = max(0, sizes.get(image.id, 0) - sizes.get(image.parent, 0))
+            stage_names = {name for tag in image.tags for name in image_names(tag)}
+            image.others = sorted(set(listed.get(image.id, [])) - stage_names)
+        return images
+
+    def _superseded(self, current, protected):
+        stale = set()
+        for entry in self.cache.entries.values():
+            stale.update(entry.get('superseded', []))
+        return sorted(stale - set(current) - protected)
+
+    def _over_budget(self, kept):
+        if self.max_images is not None and len(kept) > self.max_images:
+            return True
+        return self.max_size is not None and sum(image.size for image in kept.values()) > self.max_size
+
+    def collect(self, dry_run=False):
+        """
+        Remove stage images until the budget is met
+
+        Returns:
+            dict with the removed tags, the freed bytes, the kept images and their size,
+            and the number of old images removed
+        """
+        protected = self._protected()
+        kept = self.images()
+        removed = []
+        freed = 0
+        stale = 0
+        pending = self._superseded(kept, protected)
+        while pending:
+            # an old image can only go once the old images built on it are gone
+            failed = [image_id for image_id in pending if not dry_run and self.builder.run(['rmi', image_id]) != 0]
+            stale += len(pending) - len(failed)
+            if len(failed) == len(pending):
+                break
+            pending = failed
+        if not dry_run:
+            self.cache.drop_superseded(set(self._superseded(kept, protected)) - set(pending))
+        while self._over_budget(kept):
+            parents = {image.parent for image in kept.values()}
+            candidates = [image for image in kept.values()
+                          if image.id not in protected and image.id not in parents and not image.others]
+            if not candidates:
+                logging.warning('Cannot meet the stage image budget: the {} remaining stage images are protected, '
+                                'have stages built on them or are tagged as other images too'.format(len(kept)))
+                break
+            image = min(candidates, key=lambda candidate: candidate.used)
+            logging.info('Removing {} ({}, {})'.format(', '.join(image.tags), image.id[:12], format_size(image.size)))
+            if not dry_run and self.builder.run(['rmi'] + image.tags) != 0:
+                logging.warning('Could not remove {}'.format(', '.join(image.tags)))
+                protected.add(image.id)
+                continue
+            del kept[image.id]
+            removed += image.tags
+            freed += image.size
+            if not dry_run:
+                for tag in image.tags:
+                    self.cache.forget(tag)
+        if not dry_run:
+            self.cache.save()
+        return {'removed': removed, 'freed': freed, 'kept': len(kept),
+                'kept_size': sum(image.size for image in kept.values()), 'stale': stale}
+
+
+def collect_stages(builder, max_images=None, max_size=None, fabfiles=(), protect=(), dry_run=False):
+    """
+    Run a StageCollector protecting the lock files of fabfiles (paths) as well, and return its summary
+    """
+    locks = []
+    for source in fabfiles:
+        try:
+            locks.append(FabLock.for_fabfile(source))
+        except LockError as err:
+            logging.warning('{}; its stages are not protected'.format(err))
+    if not os.path.exists(builder.cache.path):
+        return {'removed': [], 'freed': 0, 'kept': 0, 'kept_size': 0, 'stale': 0}
+    return StageCollector(builder, max_images, max_size, locks, protect).collect(dry_run)
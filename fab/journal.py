@@ -0,0 +1,70 @@
+"""
+Kickstart execution journal: the steps already applied to a root, so reruns skip them.
+"""
+
+import os
+import json
+import time
+import hashlib
+
+# Location of the journal below the target root
+JOURNAL_PATH = os.path.join('var', 'lib', 'fab', 'kickstart.journal')
+
+
+def step_hash(kind, text, occurrence=0):
+    """
+    Return the content hash of a step: its kind, its Kickstart text and which
+    identical step of the file it is
+    """
+    digest = hashlib.sha256()
+    digest.update('{}\0{}\0{}'.format(kind, occurrence, text).encode())
+    return digest.hexdigest()
+
+
+class KickstartJournal:
+    """
+    Append-only record of the Kickstart steps executed in a root.
+
+    Every executed command, package transaction and script is written as one
+    JSON line with its content hash, exit status and duration, flushed to disk
+    before the next step starts, so a run that fails partway keeps the record
+    of everything before the failure. Steps whose hash has a successful entry
+    are skipped on later runs.
+    """
+
+    def __init__(self, root='/'):
+        self.path = os.path.join(root or '/', JOURNAL_PATH)
+        self.applied = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupted run
+                        continue
+                    if entry.get('status') == 0:
+                        self.applied.add(entry.get('hash'))
+        except FileNotFoundError:
+            pass
+
+    def done(self, digest):
+        """Return True if the step with content hash digest already succeeded."""
+        return digest in self.applied
+
+    def record(self, kind, name, digest, status, duration, **extra):
+        """
+        Append the result of one step
+        """
+        entry = dict(extra, kind=kind, name=name, hash=digest, status=status, duration=round(duration, 6),
+                     time=time.time())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if status == 0:
+            self.applied.add(digest)
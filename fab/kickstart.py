@@ -3,10 +3,16 @@ Kickstart file processing functionality.
 """
 
 import os
+import sys
+import time
+import contextlib
+import shlex
 import logging
 
 from .os_detection import detect_os_handler
-from .commands import KickstartCommandExecutor
+from .commands import (BulkAccountExecutor, KickstartCommandExecutor, KickstartError as CommandError,
+                       PackagesExecutor, ScriptExecutor)
+from .journal import KickstartJournal, step_hash
 
 # Whitelist of valid kickstart commands in execution order
 VALID_COMMANDS = {
@@ -38,20 +44,57 @@ VALID_COMMANDS = {
     "%pre": "Pre-installation script section",
 }
 
+# Section headers accepted without being listed above
+SECTION_MARKERS = ("%packages", "%pre", "%post", "%traceback")
+
 
 class FabKickstart:
     def __init__(self,
                  file_path: str,
                  dry_run: bool = False,
-                 ignore_unknown: bool = False):
+                 ignore_unknown: bool = False,
+                 root: str = "/",
+                 bulk: bool = True,
+                 password_rounds: int = None,
+                 hash_workers: int = None,
+                 package_manager: str = "dnf",
+                 package_cache: str = None,
+                 metadata_max_age: int = None,
+                 script_timeout: int = None,
+                 journal: bool = True,
+                 emit: str = None):
         """
         Initialize the Kickstart executor.
 
         Args:
             dry_run: If True, only validate, do not execute
             ignore_unknown: If True, continue even if unknown commands are present
+            root: Root directory of the system the Kickstart is applied to
+            bulk: If True, apply group and user commands in one pass over the account
+                  databases instead of running groupadd/useradd for each entry
+            password_rounds: SHA-512 crypt rounds for plaintext passwords (glibc default if None)
+            hash_workers: Processes used to hash passwords (all cores if None)
+            package_manager: Command installing the %packages selection (dnf compatible)
+            package_cache: Download cache directory shared by package transactions
+            metadata_max_age: Seconds repository metadata in package_cache is used without a refresh
+            script_timeout: Seconds each %pre/%post script may run (SCRIPT_TIMEOUT if None)
+            journal: If True, record executed steps in the root's journal and skip the ones
+                     it lists as already applied
+            emit: Instead of executing, compile the Kickstart to a Containerfile written to
+                  this path ('-' for standard output), or to a fab module if it is a directory
         """
         self.file_path = file_path
+        self.root = root
+        self.bulk = bulk
+        self.password_rounds = password_rounds
+        self.hash_workers = hash_workers
+        self.package_manager = package_manager
+        self.package_cache = package_cache
+        self.metadata_max_age = metadata_max_age
+        self.script_timeout = script_timeout
+        self.journal = KickstartJournal(root) if journal else None
+        self._occurrences = {}
+        self.emit = emit
         # self.handler = handler
         # self.parser = parser
         self.dry_run = dry_run
@@ -64,63 +107,90 @@ class FabKickstart:
         Execute the Kickstart file.
         """
 
-    def validate_kickstart_commands(self) -> tuple[bool, list[str]]:
-        """
-        Validate kickstart commands against the whitelist.
-        Only validates actual kickstart commands, not script content within sections.
-
-        Returns:
-            Tuple of (is_valid, list_of_violations)
-        """
-        violations = []
-        lines = self.content.split("\n")
-
-        in_script_section = False
+    def _hash(self, kind, obj):
+        text = str(obj).strip()
+        occurrence = self._occurrences.get((kind, text), 0)
+        self._occurrences[(kind, text)] = occurrence + 1
+        return step_hash(kind, text, occurrence)
 
-        for line_num, line in enumerate(lines, 1):
-            line = line.strip()
+    def _applied(self, kind, name, digest):
+        if self.journal is not None and self.journal.done(digest):
+            print(f"Skipping {kind} {name}: already applied")
+            return True
+        return False
 
-            # Skip comments and empty lines
-            if not line or line.startswith("#"):
-                continue
+    def _record(self, kind, name, digest, status, duration):
+        if self.journal is not None:
+            self.journal.record(kind, name, digest, status, duration)
 
-            # Check for section markers
-            if line.startswith("%"):
-                if line in ["%packages", "%pre", "%post", "%traceback", "%end"]:
-                    if line == "%end":
-                        in_script_section = False
-                    else:
-                        in_script_section = True
-                    continue
-
-            # Skip lines within script sections (let pykickstart handle validation)
-            if in_script_section:
-                continue
-
-            # Extract command (first word on the line)
-            parts = line.split()
-            if not parts:
-                continue
-
-            command = parts[0].lower()
-
-            # Check if command is in whitelist
-            if command not in VALID_COMMANDS:
-                violations.append(
-                    f"Line {line_num}: Warning: Unknown command '{command}' - not in valid list"
-                )
+    def _step(self, kind, name, obj, action):
+        """
+        Run action for a Kickstart step unless the journal lists it as applied
 
-        return len(violations) == 0, violations
+        action returns the step's exit status or raises on failure; both are journaled.
+        """
+        digest = self._hash(kind, obj)
+        if self._applied(kind, name, digest):
+            return 0
+        start = time.monotonic()
+        try:
+            status = action()
+        except Exception:
+            self._record(kind, name, digest, 1, time.monotonic() - start)
+            raise
+        self._record(kind, name, digest, status, time.monotonic() - start)
+        return status
+
+    def _run_command(self, command, obj):
+        KickstartCommandExecutor(command, obj, self.root, self.password_rounds)
+        return 0
+
+    def _run_packages(self, packages):
+        packages.execute()
+        return 0
+
+    def _run_script(self, script):
+        from pykickstart.constants import KS_SCRIPT_PRE
+        kind = '%pre' if script.type == KS_SCRIPT_PRE else '%post'
+        name = f"from line {script.lineno}"
+        status = self._step(kind, name, script, ScriptExecutor(script, self.root, self.script_timeout).execute)
+        if status != 0:
+            if script.errorOnFail:
+                raise CommandError(f"{kind} script {name} failed with exit status {status}")
+            print(f"Warning: {kind} script {name} failed with exit status {status}")
+
+    def _emit(self, plan, stdout) -> int:
+        from .kscompile import ContainerfileCompiler
+        compiler = ContainerfileCompiler(self.handler, plan, self.file_path, password_rounds=self.password_rounds)
+        if self.emit == '-':
+            stdout.write(compiler.containerfile())
+        elif os.path.isdir(self.emit) or self.emit.endswith(os.sep):
+            name = os.path.splitext(os.path.basename(self.file_path))[0]
+            print(f"Wrote module {compiler.write_module(self.emit, name)}")
+        else:
+            with open(self.emit, 'w') as f:
+                f.write(compiler.containerfile())
+            print(f"Wrote {self.emit}")
+        return 0
 
     def handle_kickstart(self) -> int:
         """Handle kickstart command execution.
         Returns:
             int: Exit code (0 for success, 1 for error)
         """
+        if self.emit == '-':
+            # keep standard output for the Containerfile
+            stdout = sys.stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                return self._handle_kickstart(stdout)
+        return self._handle_kickstart(sys.stdout)
+
+    def _handle_kickstart(self, stdout) -> int:
         try:
             # Import pykickstart here to avoid import errors if not installed
-            from pykickstart.parser import KickstartParser
+            from pykickstart.constants import KS_SCRIPT_POST, KS_SCRIPT_PRE
             from pykickstart.errors import KickstartError
+            from .ksparser import KickstartPlanParser
 
             # Check if file exists
             if not os.path.exists(self.file_path):
@@ -136,51 +206,77 @@ class FabKickstart:
                 print(f"Error: {e}")
                 return 1
 
-            # Read the kickstart file content
-            with open(self.file_path, "r") as f:
-                self.content = f.read()
-
-            # Parse the kickstart file first to validate kickstart commands
-            self.handler = HandlerClass()
-            self.parser = KickstartParser(self.handler)
+            # Parse, validate against our whitelist and plan execution in one pass
+            self.parser = KickstartPlanParser(self.handler, VALID_COMMANDS, SECTION_MARKERS)
 
             try:
-                self.parser.readKickstartFromString(self.content)
-                print(f"Successfully parsed Kickstart file: {self.file_path}")
+                plan = self.parser.readKickstartStream(self.file_path)
+                print(f"Successfully parsed Kickstart file: {self.file_path} ({plan.line_count} lines)")
             except KickstartError as e:
                 print(f"Error parsing Kickstart file: {e}")
+                for violation in self.parser.plan.violations:
+                    print(f"  {violation}")
                 return 1
 
-            # Now validate against our whitelist (only kickstart commands, not script content)
-            is_valid, violations = self.validate_kickstart_commands()
-            if not is_valid:
+            if plan.violations:
                 print("Warning: Kickstart file contains unknown commands:")
-                for violation in violations:
+                for violation in plan.violations:
                     print(f"  {violation}")
                 if not self.ignore_unknown:
                     return 1
             else:
                 print("Kickstart contains only valid commands")
 
+            if self.emit is not None:
+                return self._emit(plan, stdout)
+
+            packages = None
+            if getattr(self.handler.packages, 'seen', False):
+                packages = PackagesExecutor(self.handler.packages, self.root, self.package_manager,
+                                            self.package_cache, self.metadata_max_age)
+
             if self.dry_run:
+                if packages is not None and packages.specs():
+                    print(f"Package transaction: {shlex.join(packages.command())}")
                 print("Dry run mode: Kickstart file is valid and ready for execution.")
                 return 0
 
             # Command execution
-            print("Executing Kickstart file...")
-
-            commands = []
-            for command in VALID_COMMANDS:
-                if hasattr(self.handler, command):
-                    commands.append(getattr(self.handler, command))
-
-            print(commands)
-
-            for command in VALID_COMMANDS:
-                if hasattr(self.handler, command):
-                    command_obj = getattr(self.handler, command)
-                    for obj in command_obj.dataList():
-                        KickstartCommandExecutor(command, obj)
+            print(f"Executing Kickstart file ({len(plan)} commands)...")
+            scripts = self.handler.scripts
+
+            for script in scripts:
+                if script.type == KS_SCRIPT_PRE:
+                    self._run_script(script)
+
+            # packages first: they provide the shells and system groups accounts refer to
+            if packages is not None and packages.specs():
+                self._step("%packages", "transaction", self.handler.packages, lambda: self._run_packages(packages))
+
+            accounts = None
+            pending = []
+            if self.bulk:
+                accounts = BulkAccountExecutor(self.root, self.password_rounds, self.hash_workers)
+            for command, obj in plan.steps():
+                name = getattr(obj, 'name', '')
+                if accounts is not None and command in ("group", "user"):
+                    digest = self._hash(command, obj)
+                    if not self._applied(command, name, digest):
+                        accounts.add(command, obj)
+                        pending.append((command, name, digest))
+                else:
+                    self._step(command, name, obj, lambda: self._run_command(command, obj))
+            if pending:
+                # the account databases are written in one atomic commit: all entries apply or none
+                start = time.monotonic()
+                accounts.execute()
+                duration = (time.monotonic() - start) / len(pending)
+                for command, name, digest in pending:
+                    self._record(command, name, digest, 0, duration)
+
+            for script in scripts:
+                if script.type == KS_SCRIPT_POST:
+                    self._run_script(script)
 
             return 0
 
@@ -0,0 +1,137 @@
+"""
+Kickstart-to-Containerfile compiler: the supported Kickstart commands as plain
+Containerfile instructions, so applying a Kickstart needs neither the fab image
+nor a Python runtime in the build.
+"""
+
+import os
+import shlex
+
+from .commands import PackagesExecutor, group_command, user_command
+from .sha512crypt import derive_salt
+
+# Base image of a compiled Containerfile; fab replaces it with --from when it is built as a module
+BASE_IMAGE = 'registry.fedoraproject.org/fedora-bootc:latest'
+
+# Cache mount keeping package downloads across builds
+PACKAGE_CACHE_MOUNT = '/var/cache/fab-packages'
+
+HEREDOC = 'FAB_SCRIPT'
+
+
+def _run(commands, mount=None):
+    """Return a RUN instruction chaining commands (lists of words) with &&."""
+    lines = [shlex.join(command) for command in commands]
+    prefix = 'RUN ' if mount is None else 'RUN --mount={} '.format(mount)
+    return prefix + ' && \\\n    '.join(lines)
+
+
+def _script(script):
+    """Return a RUN instruction feeding a %pre/%post script to its interpreter through a heredoc."""
+    body = script.script if script.script.endswith('\n') else script.script + '\n'
+    delimiter = HEREDOC
+    while delimiter in body.splitlines():
+        delimiter += '_'
+    command = shlex.join([script.interp or '/bin/sh'])
+    if not script.inChroot:
+        # the build container is the target root
+        command = 'FAB_ROOT=/ ' + command
+    command += " <<'{}'".format(delimiter)
+    if script.logfile:
+        command += ' >> {} 2>&1'.format(shlex.quote(script.logfile))
+    if not script.errorOnFail:
+        command += ' || true'
+    return 'RUN {}\n{}{}'.format(command, body, delimiter)
+
+
+class ContainerfileCompiler:
+    """
+    Compiles a parsed Kickstart into Containerfile instructions.
+
+    Steps are emitted in dependency order, which also puts the steps that change
+    least first: %pre scripts, the %packages transaction, groups, users, then
+    %post scripts. Groups and users each become a single RUN layer, so editing a
+    user does not invalidate the package layer or the group layer. Each script
+    is its own layer. Plaintext passwords are hashed at compile time, with a
+    salt derived from the Kickstart and the user name so that compiling the
+    same Kickstart again gives the same Containerfile and keeps the layer cache.
+    """
+
+    def __init__(self, handler, plan, source=None, base_image=BASE_IMAGE, password_rounds=None):
+        self.handler = handler
+        self.plan = plan
+        self.source = source
+        self.base_image = base_image
+        self.password_rounds = password_rounds
+
+    def _scripts(self, script_type):
+        return [_script(script) for script in self.handler.scripts if script.type == script_type]
+
+    def _packages(self):
+        packages = self.handler.packages
+        if not getattr(packages, 'seen', False):
+            return []
+        executor = PackagesExecutor(packages, '/', 'dnf', PACKAGE_CACHE_MOUNT)
+        if not executor.specs():
+            return []
+        instructions = []
+        excluded = getattr(packages, 'excludedGroupList', [])
+        if excluded:
+            instructions.append('# excluding groups is not supported, ignored: {}'.format(
+                ', '.join(group.name for group in excluded)))
+        instructions.append(_run([executor.command(fresh=False)],
+                                 'type=cache,target={},sharing=locked'.format(PACKAGE_CACHE_MOUNT)))
+        return instructions
+
+    def _accounts(self):
+        groups = [group_command(obj) for _, obj in self.plan.commands.get('group', [])]
+        users = []
+        source = b''
+        if self.source is not None:
+            with open(self.source, 'rb') as f:
+                source = f.read()
+        for _, obj in self.plan.commands.get('user', []):
+            users.append(user_command(obj, password_rounds=self.password_rounds,
+                                      salt=derive_salt(source, str(obj.name))))
+            if getattr(obj, 'lock', False):
+                users.append(['usermod', '--lock', str(obj.name)])
+        return [_run(commands) for commands in (groups, users) if commands]
+
+    def instructions(self):
+        """Return the compiled instructions, without the FROM line."""
+        from pykickstart.constants import KS_SCRIPT_POST, KS_SCRIPT_PRE
+        return self._scripts(KS_SCRIPT_PRE) + self._packages() + self._accounts() + self._scripts(KS_SCRIPT_POST)
+
+    def containerfile(self):
+        """Return the compiled Containerfile text."""
+        header = ['# Generated by fab kickstart --emit-containerfile{}'.format(
+            ' from {}'.format(os.path.basename(self.source)) if self.source else '')]
+        return '\n\n'.join(header + ['FROM {}'.format(self.base_image)] + self.instructions()) + '\n'
+
+    def module_definition(self, name, containerfile):
+        """Return the fab module definition for a compiled Containerfile file name."""
+        return {
+            'metadata': {
+                'name': name,
+                'description': 'Kickstart {} compiled to a Containerfile'.format(
+                    os.path.basename(self.source) if self.source else name),
+            },
+            'containerfile': containerfile,
+        }
+
+    def write_module(self, directory, name):
+        """
+        Write the Containerfile and the module definition importing it into directory
+
+        Returns the path of the module definition.
+        """
+        import yaml
+        os.makedirs(directory, exist_ok=True)
+        containerfile = '{}.Containerfile'.format(name)
+        with open(os.path.join(directory, containerfile), 'w') as f:
+            f.write(self.containerfile())
+        path = os.path.join(directory, '{}.yaml'.format(name))
+        with open(path, 'w') as f:
+            f.write('---\n')
+            yaml.safe_dump(self.module_definition(name, containerfile), f, sort_keys=False)
+        return path
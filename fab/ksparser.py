@@ -0,0 +1,143 @@
+"""
+Single-pass Kickstart front-end: streams a file through pykickstart while
+checking it against the command whitelist and collecting an execution plan.
+"""
+
+import os
+import itertools
+
+from pykickstart.parser import KickstartParser, Packages, PutBackIterator
+
+# Data lists pykickstart scans for duplicate names on every entry it parses
+NAMED_LISTS = {'group': 'groupList', 'user': 'userList'}
+
+
+class NamedDataList(list):
+    """
+    Data list with a name index, so pykickstart's per-entry duplicate check
+    (``data in dataList()``) is a set lookup instead of a scan of every entry
+    parsed so far.
+    """
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self.names = {obj.name for obj in self}
+
+    def append(self, obj):
+        super().append(obj)
+        self.names.add(obj.name)
+
+    def __contains__(self, obj):
+        return getattr(obj, 'name', None) in self.names
+
+
+class KickstartPlan:
+    """
+    Result of one pass over a Kickstart file.
+
+    Attributes:
+        commands: whitelisted command name -> list of (line number, parsed object),
+                  in whitelist (execution) order
+        violations: diagnostics for commands and sections not in the whitelist
+        line_count: number of lines read from the top-level file
+    """
+
+    def __init__(self, whitelist):
+        self.commands = {command: [] for command in whitelist if not command.startswith('%')}
+        self.violations = []
+        self.line_count = 0
+
+    def steps(self):
+        """
+        Yield (command name, parsed object) in execution order
+        """
+        for command, entries in self.commands.items():
+            for _, obj in entries:
+                yield command, obj
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.commands.values())
+
+
+class KickstartPlanParser(KickstartParser):
+    """
+    KickstartParser that validates and plans while it parses.
+
+    Every command pykickstart dispatches and every section header it opens is
+    checked against the whitelist as it is seen, with its line number, and the
+    objects of whitelisted commands are recorded in a KickstartPlan, so nothing
+    has to re-read the file or walk the handler afterwards.
+    """
+
+    def __init__(self, handler, whitelist, sections=(), **kwargs):
+        # set before the base class registers its sections
+        self.whitelist = whitelist
+        self.section_markers = set(sections)
+        self.plan = KickstartPlan(whitelist)
+        super().__init__(handler, **kwargs)
+        self._index_names()
+
+    def _index_names(self):
+        for command, attribute in NAMED_LISTS.items():
+            command_obj = getattr(self.handler, command, None)
+            if command_obj is not None:
+                setattr(command_obj, attribute, NamedDataList(getattr(command_obj, attribute)))
+
+    def reset(self):
+        """
+        Forget the previous file, so one parser and handler can check many files
+
+        Only the commands the previous file used are re-created, which is much
+        cheaper than a new handler.
+        """
+        handler = self.handler
+        for name, command_obj in list(handler.commands.items()):
+            if getattr(command_obj, 'seen', False):
+                handler.resetCommand(name)
+        handler.certificates = []
+        handler.scripts = []
+        handler.packages = Packages()
+        handler._null_section_strings = []
+        self._index_names()
+        self.plan = KickstartPlan(self.whitelist)
+
+    def _check(self, lineno, name):
+        if name not in self.whitelist and name not in self.section_markers:
+            self.plan.violations.append(f"Line {lineno}: Warning: Unknown command '{name}' - not in valid list")
+
+    def registerSection(self, obj):
+        header = obj.handleHeader
+
+        def handle_header(lineno, args):
+            self._check(lineno, args[0])
+            return header(lineno, args)
+
+        obj.handleHeader = handle_header
+        super().registerSection(obj)
+
+    def handleCommand(self, lineno, args):
+        command = args[0].lower()
+        self._check(lineno, command)
+        obj = super().handleCommand(lineno, args)
+        if command in self.plan.commands:
+            self.plan.commands[command].append((lineno, obj))
+        return obj
+
+    def _count(self, lines):
+        for line in lines:
+            self.plan.line_count += 1
+            yield line
+
+    def readKickstartStream(self, path):
+        """
+        Parse the Kickstart file at path line by line, without loading it into memory
+
+        Returns:
+            The KickstartPlan built while parsing
+        """
+        self._reset()
+        self.currentdir[self._includeDepth] = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            # the trailing "" marks the end of input, as readKickstartFromString does
+            self._stateMachine(PutBackIterator(itertools.chain(self._count(f), [''])))
+        return self.plan
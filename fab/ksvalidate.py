@@ -0,0 +1,156 @@
+"""
+Bulk Kickstart validation: many files checked on a process pool, with JSON or JUnit reports.
+"""
+
+import os
+import glob
+import json
+import time
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+
+# Extensions of the files found when a directory is given
+KICKSTART_EXTENSIONS = ('.ks', '.cfg')
+
+# Parser of the current worker process, set up once by _init_worker
+_parser = None
+
+
+def expand_paths(patterns):
+    """
+    Return the Kickstart files named by files, glob patterns and directories, in order and without duplicates
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = []
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                matches += [os.path.join(root, name) for name in sorted(files)
+                            if name.endswith(KICKSTART_EXTENSIONS)]
+        elif glob.has_magic(pattern):
+            matches = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+        else:
+            # missing files are reported by validate_file
+            matches = [pattern]
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _init_worker():
+    """Import pykickstart and create the handler and parser this process reuses for every file."""
+    global _parser
+    from .kickstart import SECTION_MARKERS, VALID_COMMANDS
+    from .ksparser import KickstartPlanParser
+    from .os_detection import detect_os_handler
+    _parser = KickstartPlanParser(detect_os_handler()(), VALID_COMMANDS, SECTION_MARKERS)
+
+
+def validate_file(path):
+    """
+    Parse and check one Kickstart file with this process's parser
+
+    Returns a result dict: file, lines, commands, violations, error and duration.
+    """
+    from pykickstart.errors import KickstartError
+    start = time.monotonic()
+    result = {'file': path, 'lines': 0, 'commands': 0, 'violations': [], 'error': None}
+    if not os.path.isfile(path):
+        result['error'] = 'Kickstart file not found'
+    else:
+        _parser.reset()
+        try:
+            plan = _parser.readKickstartStream(path)
+            result['commands'] = len(plan)
+        except KickstartError as e:
+            result['error'] = str(e)
+        except (OSError, UnicodeDecodeError) as e:
+            result['error'] = 'Cannot read file: {}'.format(e)
+        result['lines'] = _parser.plan.line_count
+        result['violations'] = list(_parser.plan.violations)
+    result['duration'] = time.monotonic() - start
+    return result
+
+
+def validate_files(paths, workers=None):
+    """
+    Validate the Kickstart files at paths on a pool of processes (workers, all cores if None)
+
+    Every worker sets up pykickstart and its handler once and checks its share
+    of the files with it. Returns the results of validate_file in path order.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        _init_worker()
+        return [validate_file(path) for path in paths]
+    # large chunks keep the inter-process traffic low; several per worker balance the load
+    chunksize = max(1, len(paths) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        return list(pool.map(validate_file, paths, chunksize=chunksize))
+
+
+def failed(result, ignore_unknown=False):
+    """Return True if a result fails validation: a parse error, or unknown commands unless ignored."""
+    return result['error'] is not None or (bool(result['violations']) and not ignore_unknown)
+
+
+def report_format(path, requested=None):
+    """Return the report format for path: requested, or junit for .xml files and json otherwise."""
+    if requested is not None:
+        return requested
+    return 'junit' if path.endswith('.xml') else 'json'
+
+
+def write_report(results, path, fmt='json', ignore_unknown=False, elapsed=None):
+    """
+    Write the aggregated results to path as JSON or as a JUnit XML test suite
+    """
+    failures = sum(1 for result in results if result['error'] is None and failed(result, ignore_unknown))
+    errors = sum(1 for result in results if result['error'] is not None)
+    elapsed = sum(result['duration'] for result in results) if elapsed is None else elapsed
+    if fmt == 'json':
+        with open(path, 'w') as f:
+            json.dump({'files': len(results), 'failures': failures, 'errors': errors, 'duration': elapsed,
+                       'results': results}, f, indent=2)
+            f.write('\n')
+        return
+    suite = ElementTree.Element('testsuite', name='fab kickstart', tests=str(len(results)),
+                                failures=str(failures), errors=str(errors), time='{:.3f}'.format(elapsed))
+    for result in results:
+        case = ElementTree.SubElement(suite, 'testcase', classname='kickstart', name=result['file'],
+                                      time='{:.3f}'.format(result['duration']))
+        if result['error'] is not None:
+            ElementTree.SubElement(case, 'error', message=result['error']).text = '\n'.join(result['violations'])
+        elif failed(result, ignore_unknown):
+            ElementTree.SubElement(case, 'failure', message='{} unknown commands'.format(
+                len(result['violations']))).text = '\n'.join(result['violations'])
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def validate_kickstarts(patterns, workers=None, report=None, fmt=None, ignore_unknown=False):
+    """
+    Validate every Kickstart file named by patterns, print a summary and write the report
+
+    Returns:
+        int: Exit code (0 if every file is valid, 1 otherwise)
+    """
+    paths = expand_paths(patterns)
+    if not paths:
+        print("Error: no Kickstart files found")
+        return 1
+    start = time.monotonic()
+    results = validate_files(paths, workers)
+    elapsed = time.monotonic() - start
+    bad = [result for result in results if failed(result, ignore_unknown)]
+    for result in bad:
+        print(f"{result['file']}: {result['error'] or 'unknown commands'}")
+        for violation in result['violations']:
+            print(f"  {violation}")
+    print(f"Validated {len(results)} Kickstart files in {elapsed:.2f}s: {len(results) - len(bad)} valid, "
+          f"{len(bad)} invalid")
+    if report is not None:
+        write_report(results, report, report_format(report, fmt), ignore_unknown, elapsed)
+        print(f"Wrote report {report}")
+    return 1 if bad else 0
@@ -0,0 +1,156 @@
+"""
+Fabfile lock files: pinned base images and the stages last built from a Fabfile.
+"""
+
+import os
+import json
+import logging
+import tempfile
+import threading
+
+LOCK_VERSION = 1
+LOCK_SUFFIX = '.lock'
+
+# Index of the lock files written by builds, kept in the cache directory for `fab gc`
+LOCK_INDEX = 'locks.json'
+
+
+class LockError(Exception):
+    """Exception raised when a lock file cannot be used."""
+    pass
+
+
+class FabLock:
+    """
+    The ``<Fabfile>.lock`` next to a Fabfile.
+
+    For every image the Fabfile defines it records the base image the build
+    started from (reference, local image ID and registry digest) and, for each
+    stage, the cache key of its inputs and the image ID it produced. Stages are
+    recorded as they finish, so the lock of a failed build still lists every
+    stage before the failure.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.images = {}
+        self._positions = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_fabfile(cls, source):
+        """
+        Load the lock file of the Fabfile at source, or start an empty one
+        """
+        lock = cls(source + LOCK_SUFFIX)
+        lock.load()
+        return lock
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            raise LockError('Cannot read lock file {}: {}'.format(self.path, err))
+        if data.get('version') != LOCK_VERSION:
+            raise LockError('Unsupported lock file version in {}'.format(self.path))
+        for name, image in data.get('images', {}).items():
+            self.images[name] = {'base': image.get('base'),
+                                 'stages': {stage['tag']: stage for stage in image.get('stages', [])}}
+            self._positions[name] = {stage['tag']: index for index, stage in enumerate(image.get('stages', []))}
+
+    def _image(self, name):
+        if name not in self.images:
+            self.images[name] = {'base': None, 'stages': {}}
+            self._positions[name] = {}
+        return self.images[name]
+
+    def base(self, image):
+        """Return the pinned base of image: dict with reference, id and digest, or None."""
+        return self.images.get(image, {}).get('base')
+
+    def pin(self, image, reference, image_id, digest=None):
+        with self._lock:
+            base = {'reference': reference, 'id': image_id, 'digest': digest}
+            entry = self._image(image)
+            if entry['base'] != base:
+                entry['base'] = base
+                self._dirty = True
+
+    def image_ids(self):
+        """Return the IDs of every stage image the lock records."""
+        return {stage['id'] for entry in self.images.values() for stage in entry['stages'].values()
+                if stage.get('id')}
+
+    def stage(self, image, tag):
+        """Return the recorded stage entry for tag in image, or None."""
+        return self.images.get(image, {}).get('stages', {}).get(tag)
+
+    def record(self, image, position, module, tag, key, image_id):
+        """
+        Record that stage tag (the position-th stage of image) was built from inputs key as image_id
+        """
+        with self._lock:
+            stage = {'tag': tag, 'module': module, 'key': key, 'id': image_id}
+            entry = self._image(image)
+            self._positions[image][tag] = position
+            if entry['stages'].get(tag) != stage:
+                entry['stages'][tag] = stage
+                self._dirty = True
+
+    def save(self):
+        """
+        Write the lock file if anything changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            images = {}
+            for name, entry in self.images.items():
+                positions = self._positions.get(name, {})
+                stages = sorted(entry['stages'].values(), key=lambda stage: positions.get(stage['tag'], 0))
+                images[name] = {'base': entry['base'], 'stages': stages}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.fab-lock-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'version': LOCK_VERSION, 'images': images}, f, indent=2, sort_keys=True)
+                    f.write('\n')
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            logging.debug('Wrote {}'.format(self.path))
+            self._dirty = False
+
+
+def register_locks(directory, paths):
+    """
+    Add lock file paths to the index in directory, dropping lock files that no longer exist
+    """
+    index = os.path.join(directory, LOCK_INDEX)
+    known = set(known_locks(directory)) | {os.path.abspath(path) for path in paths}
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.fab-locks-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sorted(path for path in known if os.path.exists(path)), f, indent=2)
+        os.replace(tmp, index)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def known_locks(directory):
+    """Return the lock files in the index in directory."""
+    try:
+        with open(os.path.join(directory, LOCK_INDEX), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as err:
+        logging.warning('Ignoring unreadable lock index in {}: {}'.format(directory, err))
+        return []
@@ -0,0 +1,157 @@
+"""
+Streaming of container tool output to the console and to per-stage log files.
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import selectors
+import threading
+import collections
+from .config import LOG_TAIL_LINES as DEFAULT_TAIL
+
+CHUNK_SIZE = 64 * 1024
+
+VERBOSE = 'verbose'
+PROGRESS = 'progress'
+QUIET = 'quiet'
+
+
+class StageLog:
+    """
+    Output of a single container tool invocation.
+
+    The raw byte stream is written to a gzip file (if a directory is given) while
+    only the last ``tail`` decoded lines are kept in memory.
+    """
+
+    def __init__(self, name, directory=None, tail=DEFAULT_TAIL):
+        self.name = name
+        self.lines = collections.deque(maxlen=tail)
+        self.line_count = 0
+        self.byte_count = 0
+        self.returncode = None
+        self.elapsed = None
+        # resource usage of the process (and the children it waited for), from wait4
+        self.rusage = None
+        # layer cache hits, when the engine reports them
+        self.cache_hits = None
+        self.path = None
+        self._partial = b''
+        self._file = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.log.gz')
+            # favour throughput over ratio, build logs compress well anyway
+            self._file = gzip.open(self.path, 'wb', compresslevel=1)
+
+    def feed(self, data):
+        """
+        Consume a chunk of raw output and return the lines it completed
+        """
+        self.byte_count += len(data)
+        if self._file is not None:
+            self._file.write(data)
+        *complete, self._partial = (self._partial + data).split(b'\n')
+        return self._add(complete)
+
+    def close(self):
+        """
+        Flush any unterminated last line and close the log file, returning the flushed lines
+        """
+        lines = self._add([self._partial]) if self._partial else []
+        self._partial = b''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return lines
+
+    def _add(self, raw_lines):
+        lines = [line.decode('utf-8', 'replace').rstrip() for line in raw_lines]
+        self.line_count += len(lines)
+        self.lines.extend(lines)
+        return lines
+
+
+class LogConsole:
+    """
+    Serializes output of concurrent stages onto the terminal.
+
+    Modes:
+        verbose: every output line (prefixed with its stage when prefix is set)
+        progress: one line when a stage starts and one when it finishes
+        quiet: only the summary of failed stages
+    """
+
+    def __init__(self, mode=VERBOSE, prefix=False, stream=None):
+        self.mode = mode
+        self.prefix = prefix
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+        stream = self.stream or sys.stdout
+        with self._lock:
+            stream.write(text + '\n')
+            stream.flush()
+
+    def line(self, name, text):
+        if self.mode != VERBOSE or not text.strip():
+            return
+        if self.prefix:
+            self._write('    [{}] {}'.format(name, text.strip()))
+        else:
+            self._write('    {}'.format(text.strip()))
+
+    def started(self, name):
+        if self.mode == PROGRESS:
+            self._write('==> {} started'.format(name))
+
+    def finished(self, log, rc, elapsed):
+        if self.mode == PROGRESS or (rc != 0 and self.mode == QUIET):
+            self._write('==> {} {} in {:.1f}s ({} lines){}'.format(
+                log.name, 'done' if rc == 0 else 'failed with exit code {}'.format(rc), elapsed,
+                log.line_count, ', log: {}'.format(log.path) if log.path else ''))
+        if rc != 0 and self.mode != VERBOSE and log.lines:
+            # lines were not shown while streaming, print the tail as one block
+            self._write('\n'.join(['    Last {} lines of {}:'.format(len(log.lines), log.name)] +
+                                  ['    | {}'.format(line) for line in log.lines]))
+
+
+def stream(process, log, console):
+    """
+    Pump a process' stdout into log and console until it exits.
+
+    The pipe is only read when the selector reports data, in large chunks, so a
+    chatty process costs neither per-line syscalls nor polling.
+
+    Returns:
+        The process' exit code
+    """
+    console.started(log.name)
+    start = time.monotonic()
+    fd = process.stdout.fileno()
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    try:
+        eof = False
+        while not eof:
+            for _ in selector.select():
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    eof = True
+                    break
+                for line in log.feed(data):
+                    console.line(log.name, line)
+    finally:
+        selector.close()
+        process.stdout.close()
+        for line in log.close():
+            console.line(log.name, line)
+    _, status, log.rusage = os.wait4(process.pid, 0)
+    rc = process.returncode = log.returncode = os.waitstatus_to_exitcode(status)
+    log.elapsed = time.monotonic() - start
+    console.finished(log, rc, log.elapsed)
+    return rc
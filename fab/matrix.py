@@ -0,0 +1,406 @@
+"""
+Shared-prefix scheduling of stage chains across many images.
+"""
+
+import copy
+import time
+import logging
+import threading
+import concurrent.futures
+from .builder import report_buildargs, used_buildargs
+from .config import PULL_JOBS
+from .context import containerfile_images
+from .lock import register_locks
+
+# Registry of images that only exist locally and are never pulled
+LOCAL_REGISTRY = 'localhost/'
+
+
+class StageNode:
+    """
+    One stage in the prefix tree: a module built on top of its parent node
+    """
+
+    def __init__(self, parent, module=None, buildargs=None, base=None, platform=None):
+        self.parent = parent
+        self.module = module
+        self.buildargs = buildargs or {}
+        self.base = base
+        self.platform = parent.platform if parent is not None else platform
+        self.children = {}
+        self.tags = []
+        self.images = []
+        # (fabfile, stage tag, position in its chain) of every image chain through this node
+        self.owners = []
+        self.image_id = None
+
+    @property
+    def reference(self):
+        """Image reference the children of this node build from."""
+        if self.module is None:
+            return self.base
+        return self.tags[0]
+
+    @property
+    def build_from(self):
+        """Image the children of this node are built with; a resolved base is pinned by ID."""
+        if self.module is None and self.image_id is not None:
+            return self.image_id
+        return self.reference
+
+    def child(self, module, buildargs):
+        """
+        Return the child node for module, creating it if this is the first image using it.
+
+        Stages are shared when they build the same Containerfile from the same
+        parent with the same values for the build args it declares.
+        """
+        identity = (str(module.containerfile_path), tuple(sorted(used_buildargs(module, buildargs).items())))
+        if identity not in self.children:
+            self.children[identity] = StageNode(self, module, buildargs)
+        return self.children[identity]
+
+    def walk(self):
+        yield self
+        for child in self.children.values():
+            yield from child.walk()
+
+    @property
+    def manifests(self):
+        """Names of the manifest lists the images built through this node belong to."""
+        return {fabfile.manifest for fabfile, _, _ in self.owners if getattr(fabfile, 'manifest', None)}
+
+
+def platform_suffix(platform):
+    """Return the tag suffix for a platform, e.g. linux/arm64/v8 -> arm64-v8."""
+    return '-'.join(platform.split('/')[1:]) or platform
+
+
+def platform_images(fabfiles, platforms):
+    """
+    Expand every image into one image per platform
+
+    The image for platform is named ``<name>-<arch>`` and remembers the
+    original name as the manifest list it belongs to.
+    """
+    images = []
+    for fabfile in fabfiles:
+        for platform in platforms:
+            image = copy.copy(fabfile)
+            image.name = '{}-{}'.format(fabfile.name, platform_suffix(platform))
+            image.platform = platform
+            image.manifest = fabfile.name
+            images.append(image)
+    return images
+
+
+class StageTree:
+    """
+    Prefix tree of the stage chains of a set of images.
+
+    Every image contributes its chain ``from`` -> ``include[0]`` -> ``include[1]`` ...;
+    chains sharing a prefix share the nodes for it, so each common stage is built once.
+    """
+
+    def __init__(self, fabfiles):
+        self.roots = {}
+        for fabfile in fabfiles:
+            self.add(fabfile)
+
+    def add(self, fabfile):
+        base = fabfile.definition['from']
+        platform = getattr(fabfile, 'platform', None)
+        if (base, platform) not in self.roots:
+            self.roots[(base, platform)] = StageNode(None, base=base, platform=platform)
+        node = self.roots[(base, platform)]
+        node.owners.append((fabfile, None, None))
+        buildargs = fabfile.buildargs()
+        for position, module in enumerate(fabfile.includes):
+            node = node.child(module, buildargs)
+            tag = '{}-stage-{}'.format(fabfile.name, module.name)
+            node.tags.append(tag)
+            node.owners.append((fabfile, tag, position))
+        node.images.append(fabfile.name)
+
+    def stages(self):
+        """All stage nodes, parents before children."""
+        for root in self.roots.values():
+            for node in root.walk():
+                if node.module is not None:
+                    yield node
+
+
+class MatrixBuild:
+    """
+    Build a set of images, sharing common stage prefixes and running branches in parallel
+
+    With locks (Fabfile source -> FabLock) the base image and every finished
+    stage are recorded in each Fabfile's lock. ``resume`` reuses locked stages
+    whose inputs are unchanged and whose image still exists, and ``locked``
+    builds from the pinned base images instead of resolving their tags.
+
+    With platforms every image is built once per platform as ``<name>-<arch>``,
+    all architectures sharing the jobs limit, and ``<name>`` becomes a manifest
+    list of them. When a platform fails, the other platforms of that image are
+    cancelled.
+
+    Every distinct base image, and every other image the module Containerfiles
+    name in FROM, is fetched once, up to pull_jobs at a time, as soon as the
+    build starts. Stages start as soon as their own base is ready, while the
+    other pulls go on; a stage using a prefetched image waits for it first.
+    """
+
+    def __init__(self, fabfiles, builder, jobs=1, locks=None, resume=False, locked=False, platforms=None,
+                 pull_jobs=PULL_JOBS):
+        self.images = fabfiles
+        self.platforms = list(platforms or [])
+        if self.platforms:
+            fabfiles = platform_images(fabfiles, self.platforms)
+        self.fabfiles = fabfiles
+        self.builder = builder
+        self.jobs = max(1, jobs)
+        self.locks = locks or {}
+        self.resume = resume
+        self.locked = locked
+        self.tree = StageTree(fabfiles)
+        # manifest lists that can no longer be completed
+        self.failed = set()
+        self.pull_jobs = max(1, pull_jobs)
+        # (reference, platform) -> future of its prefetch
+        self.prefetched = {}
+        self._images = {}
+        # a local tag holds a single architecture, so platforms of one reference are fetched in turn
+        self._references = {}
+        self._reference_guard = threading.Lock()
+
+    def _lock(self, fabfile):
+        return self.locks.get(fabfile.source)
+
+    def _resolve_root(self, root):
+        """
+        Resolve the base image of a root node and pin it in the locks of the images built on it
+        """
+        if not self.locked:
+            if root.platform is None:
+                root.image_id = self.builder.resolve_base(root.base)
+            else:
+                root.image_id = self.builder.resolve_base(root.base, root.platform)
+                if root.image_id is None:
+                    return False
+            digest = self.builder.image_digest(root.image_id) if self.locks else None
+            for fabfile, _, _ in root.owners:
+                lock = self._lock(fabfile)
+                if lock is not None:
+                    lock.pin(fabfile.name, root.base, root.image_id, digest)
+            return True
+        pins = [self._lock(fabfile).base(fabfile.name) for fabfile, _, _ in root.owners if self._lock(fabfile)]
+        pins = [pin for pin in pins if pin is not None and pin['reference'] == root.base]
+        if not pins:
+            logging.error('No pinned image for {} in the lock file; build once without --locked'.format(root.base))
+            return False
+        if any(pin['id'] != pins[0]['id'] for pin in pins):
+            logging.warning('Lock files pin {} to different images, using {}'.format(root.base, pins[0]['id'][:12]))
+        root.image_id = self.builder.resolve_pinned(pins[0])
+        if root.image_id is None:
+            logging.error('Pinned image {} for {} is not available'.format(pins[0]['id'][:12], root.base))
+            return False
+        return True
+
+    def _reference_lock(self, reference):
+        with self._reference_guard:
+            return self._references.setdefault(reference, threading.Lock())
+
+    def _resolve_root_once(self, root):
+        with self._reference_lock(root.base):
+            return self._resolve_root(root)
+
+    def _resumable(self, node, key):
+        """
+        Return the image ID recorded in a lock for node if its inputs match key and the image still exists
+        """
+        for fabfile, tag, _ in node.owners:
+            lock = self._lock(fabfile)
+            stage = lock.stage(fabfile.name, tag) if lock is not None else None
+            if stage is not None and stage['key'] == key and self.builder.resolve_image(tag) == stage['id']:
+                return stage['id']
+        return None
+
+    def _module_images(self, module):
+        path = str(module.containerfile_path)
+        if path not in self._images:
+            try:
+                self._images[path] = containerfile_images(path)
+            except OSError:
+                # reported when the stage is built
+                self._images[path] = []
+        return self._images[path]
+
+    def _prefetch_image(self, reference, platform):
+        """
+        Make sure an image a module Containerfile names is local, skipping local-only images
+        """
+        if reference.startswith(LOCAL_REGISTRY):
+            return None
+        with self._reference_lock(reference):
+            return self.builder.resolve_base(reference, platform)
+
+    def _prefetch(self, pool):
+        """
+        Submit the resolution of every root and the pull of every module image to pool
+
+        Returns a dict mapping the futures resolving roots to their root node.
+        """
+        roots = {}
+        for (base, platform), root in self.tree.roots.items():
+            future = pool.submit(self._resolve_root_once, root)
+            roots[future] = root
+            self.prefetched[(base, platform)] = future
+        for node in self.tree.stages():
+            for reference in self._module_images(node.module):
+                if (reference, node.platform) not in self.prefetched:
+                    self.prefetched[(reference, node.platform)] = pool.submit(
+                        self._prefetch_image, reference, node.platform)
+        logging.info('Prefetching {} images, {} at a time'.format(len(self.prefetched), self.pull_jobs))
+        return roots
+
+    def _wait_images(self, node):
+        for reference in self._module_images(node.module):
+            future = self.prefetched.get((reference, node.platform))
+            if future is not None:
+                # a failed pull is left for the container tool to report
+                concurrent.futures.wait([future])
+
+    def _report_pulls(self, elapsed):
+        pulls = self.builder.pulls
+        if not pulls:
+            return
+        for reference, platform, seconds, rc in sorted(pulls, key=lambda pull: -pull[2]):
+            logging.info('  {:>7.1f}s {}{}{}'.format(seconds, reference, ' ({})'.format(platform) if platform else '',
+                                                      '' if rc == 0 else ' (failed)'))
+        logging.info('Pulled {} images: {:.1f}s of pulling in a {:.1f}s build'.format(
+            len(pulls), sum(pull[2] for pull in pulls), elapsed))
+
+    def _build_node(self, node):
+        self._wait_images(node)
+        parent = node.parent
+        tag = node.tags[0]
+        key = self.builder.stage_key(node.module, parent.image_id, node.buildargs)
+        image_id = self._resumable(node, key) if self.resume else None
+        if image_id is not None:
+            logging.info('Reusing {} stage ({}) recorded in the lock file'.format(tag, image_id[:12]))
+            self.builder.touch(tag)
+        else:
+            image_id = self.builder.build_stage(node.module, parent.build_from, parent.image_id, tag,
+                                                node.buildargs, key=key, platform=node.platform)
+        if image_id is None:
+            return False
+        node.image_id = image_id
+        for fabfile, owner_tag, position in node.owners:
+            lock = self._lock(fabfile)
+            if lock is not None:
+                lock.record(fabfile.name, position, node.module.name, owner_tag, key, image_id)
+        # give every image sharing this stage its own stage tag
+        for alias in node.tags[1:]:
+            if self.builder.resolve_image(alias) != image_id:
+                if not self.builder.tag(tag, alias):
+                    return False
+            self.builder.remember(alias, key, image_id, parent.image_id)
+        return True
+
+    def _tag_images(self, node):
+        success = True
+        for image in node.images:
+            logging.info('Tagging {} as {}'.format(node.reference, image))
+            success = self.builder.tag(node.build_from, image) and success
+        return success
+
+    def _abandoned(self, node):
+        """True if every image built through node belongs to a manifest list that failed."""
+        manifests = node.manifests
+        return bool(manifests) and manifests <= self.failed
+
+    def _fail(self, node, running):
+        """
+        Record that node failed and cancel the running stages only needed by the same manifest lists
+        """
+        if not node.manifests:
+            return
+        self.failed |= node.manifests
+        for future, other in running.items():
+            if other.module is not None and self._abandoned(other) and not future.cancel():
+                self.builder.cancel(other.tags[0])
+
+    def _create_manifests(self):
+        success = True
+        for fabfile in self.images:
+            if fabfile.name in self.failed:
+                logging.error('Not creating manifest list {}: a platform failed'.format(fabfile.name))
+                success = False
+                continue
+            images = ['{}-{}'.format(fabfile.name, platform_suffix(platform)) for platform in self.platforms]
+            success = self.builder.create_manifest(fabfile.name, images) and success
+        return success
+
+    def build(self):
+        report_buildargs(self.images)
+        stages = sum(1 for _ in self.tree.stages())
+        tags = sum(len(node.tags) for node in self.tree.stages())
+        logging.info('Building {} images: {} unique stages out of {}'.format(
+            sum(len(node.images) for root in self.tree.roots.values() for node in root.walk()), stages, tags))
+        start = time.monotonic()
+        success = True
+        ready = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.pull_jobs) as pulls:
+            running = self._prefetch(pulls)
+            while ready or running:
+                while ready:
+                    node = ready.pop(0)
+                    if self._abandoned(node):
+                        continue
+                    running[pool.submit(self._build_node, node)] = node
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    if node.module is None:
+                        try:
+                            resolved = future.result()
+                        except Exception as err:
+                            logging.error('Could not resolve {}: {}'.format(node.base, err))
+                            resolved = False
+                        if not resolved:
+                            self.failed |= node.manifests
+                            success = False
+                            continue
+                        success = self._tag_images(node) and success
+                        ready += node.children.values()
+                        continue
+                    if future.cancelled() or node.tags[0] in self.builder.cancelled:
+                        success = False
+                        continue
+                    try:
+                        built = future.result()
+                    except Exception as err:
+                        logging.error('Build of {} stage failed: {}'.format(node.tags[0], err))
+                        built = False
+                    if built:
+                        if not self._tag_images(node):
+                            self.failed |= node.manifests
+                            success = False
+                        ready += node.children.values()
+                    else:
+                        logging.error('Skipping {} stages depending on {}'.format(
+                            sum(1 for _ in node.walk()) - 1, node.tags[0]))
+                        self._fail(node, running)
+                        success = False
+        self._report_pulls(time.monotonic() - start)
+        if self.platforms:
+            success = self._create_manifests() and success
+        for lock in self.locks.values():
+            lock.save()
+        if self.locks:
+            # so `fab gc` keeps the stages these lock files record
+            register_locks(str(self.builder.cache.path.parent), [lock.path for lock in self.locks.values()])
+        return success
@@ -1,9 +1,55 @@
+import os
+import copy
+import time
 import logging
 import pprint
 import yaml
 import urllib.parse
 import pathlib
 
+# libyaml's C loader is several times faster than the pure Python one
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_yaml(stream):
+    """
+    Parse a YAML document from a string, bytes or file object
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+class DefinitionCache:
+    """
+    Parsed module definitions keyed by path, re-read when the file's mtime or size changes.
+
+    A single process only benefits when it includes a module twice; the
+    ``fab serve`` daemon keeps it warm across jobs and merges back the
+    definitions its job processes parsed (``updates``).
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.updates = {}
+
+    def load(self, path):
+        """
+        Return a private copy of the definition in the YAML file at path
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(path, 'r') as f:
+                entry = (stat.st_mtime_ns, stat.st_size, load_yaml(f))
+            self.entries[path] = self.updates[path] = entry
+        return copy.deepcopy(entry[2])
+
+    def merge(self, updates):
+        self.entries.update(updates)
+
+
+DEFINITIONS = DefinitionCache()
+
 
 class FabModule():
     """
@@ -11,16 +57,25 @@ class FabModule():
     """
 
     def __init__(self, source, **kwargs):
+        start = time.monotonic()
         self.source = source
         self.name = self.source
+        definition = kwargs.pop('definition', None)
         for k in kwargs:
             setattr(self, k, kwargs[k])
         self.definition = {}
-        self._read()
+        if definition is not None:
+            # already parsed, e.g. served from a catalog index
+            self.definition = definition
+            self.working_dir = pathlib.Path(source).parents[0]
+        else:
+            self._read()
         logging.debug("Read definition for module: {}".format(self.definition))
         if not self._validate():
             logging.error('Definition YAML for {} is not valid.'.format(self.source))
             raise Exception("YAML is not valid")
+        # when the definition was read and validated, for build traces
+        self.loaded = (start, time.monotonic())
 
     def __str__(self):
         return (pprint.pformat(self.definition, indent=4))
@@ -30,12 +85,10 @@ class FabModule():
         logging.debug('Decoded source: {}'.format(parsed_source))
         if parsed_source.scheme == '' or parsed_source.scheme == 'file':
             try:
-                f = open(parsed_source.path, 'r')
-            except Exception as err:
+                self.definition = DEFINITIONS.load(parsed_source.path)
+            except OSError as err:
                 logging.error('Could not open file {}: {}'.format(parsed_source.path, err))
                 raise
-            self.definition = yaml.load(f, Loader=yaml.Loader)
-            f.close()
             self.working_dir = pathlib.Path(parsed_source.path).parents[0]
         else:
             logging.error('Unknown scheme "{}" in {}'.format(parsed_source.scheme, self.source))
@@ -66,6 +119,8 @@ class FabModule():
             logging.error("'containerfile' is not a string")
             is_valid = False
         self.containerfile = self.definition['containerfile']
+        if hasattr(self, 'working_dir'):
+            self.containerfile_path = self.working_dir / self.containerfile
 
         if 'buildargs' in self.definition:
             if not isinstance(self.definition['buildargs'], list):
@@ -74,4 +129,37 @@ class FabModule():
         else:
             self.definition['buildargs'] = []
 
+        if 'context' in self.definition:
+            context = self.definition['context']
+            if not isinstance(context, list) or not all(isinstance(path, str) for path in context):
+                logging.error("'context' is not a list of paths")
+                is_valid = False
+
         return (is_valid)
+
+    def declared_buildargs(self):
+        """
+        Return the names of the buildargs listed in the module definition
+        """
+        names = []
+        for arg in self.definition['buildargs']:
+            for name in (arg if isinstance(arg, dict) else [arg]):
+                if name not in names:
+                    names.append(str(name))
+        return names
+
+    def containerfile_args(self):
+        """
+        Return the names of the ARG instructions in the module's Containerfile
+        """
+        args = []
+        with open(self.containerfile_path, 'r') as f:
+            for line in f:
+                parts = line.split(None, 1)
+                if len(parts) < 2 or parts[0].upper() != 'ARG':
+                    continue
+                for item in parts[1].split():
+                    name = item.split('=', 1)[0]
+                    if name not in args:
+                        args.append(name)
+        return args
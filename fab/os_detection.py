@@ -4,8 +4,10 @@ OS detection and handler selection for pykickstart.
 
 import os
 import platform
+import functools
 
 
+@functools.lru_cache(maxsize=None)
 def detect_os_handler():
     """Detect the operating system and return the appropriate handler class."""
     try:
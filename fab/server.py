@@ -0,0 +1,468 @@
+"""
+`fab serve`: a daemon running kickstart and build jobs for `fab --remote` clients.
+"""
+
+import os
+import sys
+import json
+import codecs
+import errno
+import pickle
+import signal
+import socket
+import logging
+import tempfile
+import selectors
+import traceback
+import collections
+
+from .config import SOCKET_PATH
+
+CHUNK_SIZE = 64 * 1024
+
+# Bytes of unsent output a client may fall behind by before it is dropped
+CLIENT_BACKLOG = 16 * 1024 * 1024
+
+# Seconds spent on the output still owed to clients when the daemon stops
+CLOSE_TIMEOUT = 5
+
+
+class ServerError(Exception):
+    """Exception raised when the daemon cannot be reached or rejects a request."""
+    pass
+
+
+class Job:
+    """
+    A CLI invocation queued or running in the daemon
+    """
+
+    def __init__(self, job_id, argv, cwd, client):
+        self.id = job_id
+        self.argv = argv
+        self.cwd = cwd
+        self.client = client
+        self.status = 'queued'
+        self.pid = None
+        self.output = None
+        # output is read in chunks that may end inside a multibyte character
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.state_path = None
+
+    def describe(self):
+        return {'job': self.id, 'argv': self.argv, 'cwd': self.cwd, 'status': self.status}
+
+
+class Client:
+    """
+    A connected client socket, the bytes it sent that do not form a full request
+    yet and the bytes not sent to it yet
+
+    The socket is non-blocking: what it cannot take at once is kept and sent
+    when the selector reports it writable, so a slow client never stalls the
+    daemon's loop.
+    """
+
+    def __init__(self, conn, selector):
+        self.conn = conn
+        self.selector = selector
+        self.buffer = b''
+        self.outgoing = bytearray()
+        self.closed = False
+
+    def send(self, message):
+        if self.closed:
+            return
+        waiting = bool(self.outgoing)
+        self.outgoing += json.dumps(message).encode('utf-8') + b'\n'
+        if not waiting:
+            self.flush()
+
+    def flush(self):
+        """Send what the socket takes now, and watch it for writability while anything is left."""
+        try:
+            while self.outgoing:
+                self.outgoing = self.outgoing[self.conn.send(self.outgoing):]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # the client went away; its jobs are cancelled when its EOF is read
+            self.outgoing = bytearray()
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outgoing else 0)
+        if self.selector.get_key(self.conn).events != events:
+            self.selector.modify(self.conn, events, ('client', self))
+
+
+class FabServer:
+    """
+    Runs jobs from `fab --remote` clients in processes forked from a warm parent.
+
+    The parent imports the kickstart and build code once, detects the OS handler
+    once and keeps module definitions and the stage cache index in memory, so a
+    job starts without interpreter or import overhead. Each job is forked from
+    that state into its own process group, in the client's working directory,
+    with its output streamed back to the client. Definitions a job parses are
+    sent back to the parent so the next job finds them warm.
+
+    Everything runs on one selector loop in one thread, which keeps fork safe.
+
+    Protocol: one JSON object per line in both directions.
+        {"action": "run", "argv": [...], "cwd": "/dir"}
+            -> {"job": N, "event": "queued"}, {"job": N, "event": "started"},
+               {"job": N, "output": "..."}..., {"job": N, "exit": rc}
+        {"action": "cancel", "job": N} -> {"job": N, "cancelled": true|false}
+        {"action": "status"} -> {"jobs": [...]}
+    """
+
+    def __init__(self, socket_path=None, jobs=1):
+        self.socket_path = socket_path or SOCKET_PATH
+        self.jobs = max(1, jobs)
+        self.queue = collections.deque()
+        self.running = {}
+        self.next_id = 1
+        self.selector = None
+        self.listener = None
+        self.clients = []
+        self.state_dir = None
+        self._stopping = False
+
+    def warm(self):
+        """
+        Import and prime what jobs need, so forked jobs inherit it
+        """
+        from . import kickstart, ksparser, fabfile, fuse, matrix  # noqa: F401
+        from .cache import StageCache
+        from .os_detection import detect_os_handler
+        try:
+            detect_os_handler()
+        except ImportError as err:
+            logging.warning('No kickstart handler available: {}'.format(err))
+        StageCache()
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise ServerError('A fab server is already listening on {}'.format(self.socket_path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen()
+        self.listener.setblocking(False)
+
+    def serve_forever(self):
+        """
+        Accept and run jobs until SIGTERM or SIGINT
+        """
+        self.warm()
+        self._listen()
+        self.state_dir = tempfile.mkdtemp(prefix='fab-serve-')
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, ('listener', None))
+        previous = {sig: signal.signal(sig, self._stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            while not self._stopping or self.running:
+                for key, events in self.selector.select(timeout=1):
+                    kind, obj = key.data
+                    if kind == 'listener':
+                        self._accept()
+                    elif kind == 'client' and not obj.closed:
+                        if events & selectors.EVENT_WRITE:
+                            obj.flush()
+                        if events & selectors.EVENT_READ:
+                            self._read_client(obj)
+                    elif kind == 'job':
+                        self._read_job(obj)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            self.close()
+
+    def _stop(self, signum, frame):
+        logging.info('Stopping on signal {}'.format(signum))
+        self._stopping = True
+        for job in list(self.queue):
+            self._cancel(job)
+        for job in list(self.running.values()):
+            self._cancel(job)
+
+    def close(self):
+        for client in self.clients:
+            if client.outgoing:
+                # last chance for the exit codes of the final jobs
+                try:
+                    client.conn.settimeout(CLOSE_TIMEOUT)
+                    client.conn.sendall(client.outgoing)
+                except OSError:
+                    pass
+            client.conn.close()
+        self.clients = []
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+        if self.state_dir is not None:
+            os.rmdir(self.state_dir)
+            self.state_dir = None
+
+    def _accept(self):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        client = Client(conn, self.selector)
+        self.clients.append(client)
+        self.selector.register(conn, selectors.EVENT_READ, ('client', client))
+
+    def _read_client(self, client):
+        try:
+            data = client.conn.recv(CHUNK_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(client)
+            return
+        *lines, client.buffer = (client.buffer + data).split(b'\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                self._handle(client, request)
+            except (ValueError, KeyError, TypeError) as err:
+                client.send({'error': 'Bad request: {}'.format(err)})
+
+    def _disconnect(self, client):
+        self.selector.unregister(client.conn)
+        client.conn.close()
+        client.closed = True
+        client.outgoing = bytearray()
+        self.clients.remove(client)
+        # nobody is left to read the output of the client's jobs
+        for job in list(self.queue) + list(self.running.values()):
+            if job.client is client:
+                self._cancel(job)
+
+    def _handle(self, client, request):
+        action = request['action']
+        if action == 'run':
+            if self._stopping:
+                client.send({'error': 'Server is shutting down'})
+                return
+            job = Job(self.next_id, [str(arg) for arg in request['argv']], request.get('cwd') or '/', client)
+            self.next_id += 1
+            self.queue.append(job)
+            client.send({'job': job.id, 'event': 'queued'})
+            self._schedule()
+        elif action == 'cancel':
+            job = self._find(int(request['job']))
+            client.send({'job': request['job'], 'cancelled': job is not None and self._cancel(job)})
+        elif action == 'status':
+            client.send({'jobs': [job.describe() for job in list(self.running.values()) + list(self.queue)]})
+        else:
+            client.send({'error': 'Unknown action {}'.format(action)})
+
+    def _find(self, job_id):
+        for job in list(self.running.values()) + list(self.queue):
+            if job.id == job_id:
+                return job
+        return None
+
+    def _cancel(self, job):
+        if job.status == 'queued':
+            self.queue.remove(job)
+            job.status = 'cancelled'
+            job.client.send({'job': job.id, 'exit': 128 + signal.SIGTERM})
+            return True
+        if job.status == 'running':
+            job.status = 'cancelling'
+            try:
+                os.killpg(job.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            return True
+        return False
+
+    def _schedule(self):
+        while self.queue and len(self.running) < self.jobs:
+            self._start(self.queue.popleft())
+
+    def _start(self, job):
+        from .cache import StageCache
+        # re-read the stage index only if another process changed it
+        StageCache()
+        job.state_path = os.path.join(self.state_dir, '{}.state'.format(job.id))
+        read_fd, write_fd = os.pipe()
+        # do not let the child inherit (and later flush) buffered daemon output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._child(job, write_fd)
+        os.close(write_fd)
+        job.pid = pid
+        job.output = read_fd
+        job.status = 'running'
+        self.running[job.id] = job
+        self.selector.register(read_fd, selectors.EVENT_READ, ('job', job))
+        job.client.send({'job': job.id, 'event': 'started'})
+        logging.info('Job {} started: fab {}'.format(job.id, ' '.join(job.argv)))
+
+    def _child(self, job, write_fd):
+        """
+        Run the job's CLI invocation in the forked process; never returns
+        """
+        rc = 1
+        try:
+            os.setpgid(0, 0)
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            self.listener.close()
+            for client in self.clients:
+                client.conn.close()
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(write_fd, 1)
+            os.dup2(write_fd, 2)
+            os.close(write_fd)
+            sys.stdout = os.fdopen(1, 'w', buffering=1, closefd=False)
+            sys.stderr = os.fdopen(2, 'w', buffering=1, closefd=False)
+            os.chdir(job.cwd)
+            from .cli import main
+            from .module import DEFINITIONS
+            DEFINITIONS.updates = {}
+            try:
+                rc = main(job.argv) or 0
+            except SystemExit as err:
+                rc = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+            with open(job.state_path, 'wb') as f:
+                pickle.dump(DEFINITIONS.updates, f)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(rc)
+
+    def _read_job(self, job):
+        try:
+            data = os.read(job.output, CHUNK_SIZE)
+        except OSError as err:
+            if err.errno != errno.EIO:
+                raise
+            data = b''
+        if data:
+            text = job.decoder.decode(data)
+            if text:
+                job.client.send({'job': job.id, 'output': text})
+            if len(job.client.outgoing) > CLIENT_BACKLOG:
+                logging.warning('Dropping a client that fell {} bytes behind'.format(len(job.client.outgoing)))
+                self._disconnect(job.client)
+            return
+        text = job.decoder.decode(b'', final=True)
+        if text:
+            job.client.send({'job': job.id, 'output': text})
+        self.selector.unregister(job.output)
+        os.close(job.output)
+        _, status = os.waitpid(job.pid, 0)
+        rc = os.waitstatus_to_exitcode(status)
+        if rc < 0:
+            rc = 128 - rc
+        self._merge_state(job)
+        del self.running[job.id]
+        job.status = 'done'
+        job.client.send({'job': job.id, 'exit': rc})
+        logging.info('Job {} finished with exit code {}'.format(job.id, rc))
+        self._schedule()
+
+    def _merge_state(self, job):
+        from .module import DEFINITIONS
+        try:
+            with open(job.state_path, 'rb') as f:
+                DEFINITIONS.merge(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        finally:
+            try:
+                os.unlink(job.state_path)
+            except FileNotFoundError:
+                pass
+
+
+class FabClient:
+    """
+    Client side of the `fab serve` protocol
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or SOCKET_PATH
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.socket_path)
+        except OSError as err:
+            conn.close()
+            raise ServerError('Cannot connect to fab server at {}: {}'.format(self.socket_path, err))
+        return conn
+
+    def _messages(self, conn):
+        buffer = b''
+        while True:
+            data = conn.recv(CHUNK_SIZE)
+            if not data:
+                return
+            *lines, buffer = (buffer + data).split(b'\n')
+            for line in lines:
+                message = json.loads(line)
+                if 'error' in message:
+                    raise ServerError(message['error'])
+                yield message
+
+    def _request(self, request):
+        with self._connect() as conn:
+            conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            for message in self._messages(conn):
+                return message
+        raise ServerError('Connection to {} closed without a reply'.format(self.socket_path))
+
+    def run(self, argv, cwd=None, stream=None):
+        """
+        Run fab with argv in the daemon, writing its output to stream as it arrives
+
+        Returns:
+            The job's exit code
+        """
+        stream = stream or sys.stdout
+        with self._connect() as conn:
+            conn.sendall(json.dumps({'action': 'run', 'argv': list(argv),
+                                     'cwd': cwd or os.getcwd()}).encode('utf-8') + b'\n')
+            for message in self._messages(conn):
+                if 'output' in message:
+                    stream.write(message['output'])
+                    stream.flush()
+                elif 'exit' in message:
+                    return message['exit']
+        raise ServerError('Connection to {} closed before the job finished'.format(self.socket_path))
+
+    def cancel(self, job_id):
+        return self._request({'action': 'cancel', 'job': job_id}).get('cancelled', False)
+
+    def status(self):
+        return self._request({'action': 'status'})['jobs']
@@ -0,0 +1,365 @@
+"""
+Remote module sources and their local, content-addressed cache.
+
+Supported include forms:
+    https://host/modules/ssh/ssh.yaml            module YAML; its Containerfile and
+                                                 'context' files are fetched next to it
+    https://host/modules.tar.gz#ssh/ssh.yaml     archive holding the module directory
+    git+https://host/repo.git?ref=main#ssh/ssh.yaml
+    git+file:///srv/modules.git#ssh/ssh.yaml     any git transport, optional ref
+    oci://quay.io/org/modules:v1#ssh/ssh.yaml    OCI artifact, pulled with oras
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import pathlib
+import tarfile
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+import urllib.error
+import concurrent.futures
+from .config import CACHE_DIR
+from .module import load_yaml
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# Number of sources fetched at once when loading a Fabfile
+DEFAULT_JOBS = 8
+
+
+class SourceError(Exception):
+    """Exception raised when a module source cannot be fetched."""
+    pass
+
+
+def is_remote(source):
+    """Return True if source names a module served by one of the fetchers."""
+    return urllib.parse.urlparse(source).scheme in FETCHERS
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path, data):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _extract(archive, destination):
+    """Extract a tar archive, refusing members that would land outside destination."""
+    with tarfile.open(archive) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(destination, filter='data')
+            return
+        root = os.path.realpath(destination)
+        for member in tar.getmembers():
+            target = os.path.realpath(os.path.join(destination, member.name))
+            if os.path.commonpath([root, target]) != root or member.issym() or member.islnk():
+                raise SourceError('Unsafe path {} in {}'.format(member.name, archive))
+        tar.extractall(destination)
+
+
+class SourceCache:
+    """
+    Local cache of remote modules under ~/.cache/fab/sources
+
+    Downloaded files are stored once by content hash under ``blobs/`` and
+    materialized into per-content module directories under ``modules/``, so the
+    same module fetched through different URLs or revisions shares storage and a
+    directory never changes once written. HTTP responses are revalidated with
+    ETag/Last-Modified; in offline mode only what is already cached is used.
+    """
+
+    def __init__(self, root=None, offline=False, timeout=30):
+        self.root = pathlib.Path(root or os.path.join(CACHE_DIR, 'sources'))
+        self.offline = offline
+        self.timeout = timeout
+        self._fetched = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _meta_path(self, kind, key):
+        return self.root / 'meta' / kind / (_digest(key.encode('utf-8')) + '.json')
+
+    def read_meta(self, kind, key):
+        try:
+            with open(self._meta_path(kind, key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, kind, key, meta):
+        _write_atomic(self._meta_path(kind, key), json.dumps(meta, sort_keys=True).encode('utf-8'))
+
+    def blob_path(self, digest):
+        return self.root / 'blobs' / digest[:2] / digest
+
+    def store(self, data):
+        """Store data as a blob and return its digest."""
+        digest = _digest(data)
+        path = self.blob_path(digest)
+        if not path.exists():
+            _write_atomic(path, data)
+        return digest
+
+    def module_dir(self, key, populate):
+        """
+        Return the module directory for content key, calling populate(directory) to fill it the first time
+        """
+        directory = self.root / 'modules' / key
+        if directory.exists():
+            return directory
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=directory.parent, prefix='.tmp-'))
+        try:
+            populate(tmp)
+            os.rename(tmp, directory)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not directory.exists():
+                raise
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return directory
+
+    def fetch(self, source):
+        """
+        Fetch source and return the local path of its module YAML
+        """
+        parsed = urllib.parse.urlparse(source)
+        fetcher = FETCHERS.get(parsed.scheme)
+        if fetcher is None:
+            raise SourceError('Unknown scheme "{}" in {}'.format(parsed.scheme, source))
+        with self.lock(source.split('#', 1)[0]):
+            # revalidate each source once per run, however many Fabfiles include it
+            if source not in self._fetched:
+                self._fetched[source] = fetcher(self).fetch(source)
+            return self._fetched[source]
+
+    def fetch_all(self, sources, jobs=DEFAULT_JOBS):
+        """
+        Fetch several sources concurrently
+
+        Returns:
+            Dict of source to local module YAML path
+        """
+        sources = list(dict.fromkeys(sources))
+        if not sources:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(sources)))) as pool:
+            return dict(zip(sources, pool.map(self.fetch, sources)))
+
+
+class HttpFetcher:
+    """
+    Fetches modules over http(s), revalidating cached copies with conditional requests
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def download(self, url):
+        """
+        Return the digest of the blob holding url's content, downloading it only if it changed
+        """
+        meta = self.cache.read_meta('http', url)
+        if meta is not None and not self.cache.blob_path(meta['digest']).exists():
+            meta = None
+        if self.cache.offline:
+            if meta is None:
+                raise SourceError('{} is not cached and fab is offline'.format(url))
+            return meta['digest']
+        request = urllib.request.Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=self.cache.timeout) as response:
+                data = response.read()
+                headers = response.headers
+        except urllib.error.HTTPError as err:
+            if err.code == 304 and meta is not None:
+                logging.debug('{} not modified'.format(url))
+                return meta['digest']
+            raise SourceError('Cannot fetch {}: {}'.format(url, err))
+        except (urllib.error.URLError, OSError) as err:
+            if meta is not None:
+                logging.warning('Cannot revalidate {} ({}), using cached copy'.format(url, err))
+                return meta['digest']
+            raise SourceError('Cannot fetch {}: {}'.format(url, err))
+        digest = self.cache.store(data)
+        self.cache.write_meta('http', url, {
+            'digest': digest,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        })
+        return digest
+
+    def fetch(self, source):
+        url, _, fragment = source.partition('#')
+        if urllib.parse.urlparse(url).path.endswith(ARCHIVE_SUFFIXES):
+            if not fragment:
+                raise SourceError('{} is an archive, name the module YAML inside it after "#"'.format(source))
+            digest = self.download(url)
+            directory = self.cache.module_dir(digest, lambda tmp: _extract(self.cache.blob_path(digest), tmp))
+            return str(directory / fragment)
+
+        yaml_digest = self.download(url)
+        with open(self.cache.blob_path(yaml_digest), 'rb') as f:
+            definition = load_yaml(f.read()) or {}
+        name = os.path.basename(urllib.parse.urlparse(url).path)
+        files = {name: yaml_digest}
+        for relative in [definition.get('containerfile', 'Containerfile')] + list(definition.get('context', [])):
+            if os.path.isabs(relative) or '..' in pathlib.PurePosixPath(relative).parts:
+                raise SourceError('{} references {} outside of its directory'.format(url, relative))
+            files[relative] = self.download(urllib.parse.urljoin(url, relative))
+        key = _digest(json.dumps(sorted(files.items())).encode('utf-8'))
+
+        def populate(tmp):
+            for relative, digest in files.items():
+                target = tmp / relative
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(self.cache.blob_path(digest), target)
+        return str(self.cache.module_dir(key, populate) / name)
+
+
+class GitFetcher:
+    """
+    Fetches modules from git repositories through a bare mirror per repository
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _git(self, *args):
+        result = subprocess.run(['git'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise SourceError('git {} failed: {}'.format(args[0], result.stderr.decode('utf-8', 'replace').strip()))
+        return result.stdout.decode('utf-8').strip()
+
+    def _update(self, remote, mirror):
+        """
+        Clone or refresh the bare mirror of remote
+        """
+        if mirror.exists():
+            if not self.cache.offline:
+                try:
+                    self._git('--git-dir', str(mirror), 'fetch', '--quiet', '--prune', 'origin')
+                except SourceError as err:
+                    logging.warning('Cannot update {} ({}), using cached copy'.format(remote, err))
+            return
+        if self.cache.offline:
+            raise SourceError('{} is not cached and fab is offline'.format(remote))
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=mirror.parent, prefix='.tmp-')
+        try:
+            self._git('clone', '--quiet', '--mirror', remote, tmp)
+            os.rename(tmp, mirror)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def fetch(self, source):
+        url, _, path = source.partition('#')
+        if not path:
+            raise SourceError('{} does not name the module YAML inside the repository after "#"'.format(source))
+        parsed = urllib.parse.urlparse(url)
+        ref = urllib.parse.parse_qs(parsed.query).get('ref', ['HEAD'])[0]
+        scheme = parsed.scheme[len('git+'):] if parsed.scheme.startswith('git+') else parsed.scheme
+        remote = urllib.parse.urlunparse(parsed._replace(scheme=scheme, query=''))
+
+        mirror = self.cache.root / 'git' / _digest(remote.encode('utf-8'))
+        with self.cache.lock('git:' + remote):
+            self._update(remote, mirror)
+        commit = self._git('--git-dir', str(mirror), 'rev-parse', '--verify', ref + '^{commit}')
+
+        def populate(tmp):
+            archive = tmp / '.archive.tar'
+            with open(archive, 'wb') as f:
+                result = subprocess.run(['git', '--git-dir', str(mirror), 'archive', '--format=tar', commit],
+                                        stdout=f, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise SourceError('git archive failed: {}'.format(result.stderr.decode('utf-8', 'replace')))
+            _extract(archive, tmp)
+            archive.unlink()
+        # a commit's tree never changes, so the checkout is keyed on it
+        return str(self.cache.module_dir('git-' + commit, populate) / path)
+
+
+class OciFetcher:
+    """
+    Fetches modules stored as OCI artifacts, using the oras CLI
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _oras(self, *args):
+        try:
+            result = subprocess.run(['oras'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise SourceError('oras is required for oci:// module sources')
+        if result.returncode != 0:
+            raise SourceError('oras {} failed: {}'.format(args[0], result.stderr.decode('utf-8', 'replace').strip()))
+        return result.stdout.decode('utf-8').strip()
+
+    def fetch(self, source):
+        url, _, path = source.partition('#')
+        if not path:
+            raise SourceError('{} does not name the module YAML inside the artifact after "#"'.format(source))
+        reference = url[len('oci://'):]
+        meta = self.cache.read_meta('oci', reference)
+        if self.cache.offline:
+            if meta is None:
+                raise SourceError('{} is not cached and fab is offline'.format(reference))
+            digest = meta['digest']
+        else:
+            try:
+                digest = self._oras('resolve', reference)
+                self.cache.write_meta('oci', reference, {'digest': digest})
+            except SourceError as err:
+                if meta is None:
+                    raise
+                logging.warning('Cannot resolve {} ({}), using cached copy'.format(reference, err))
+                digest = meta['digest']
+        repository = reference.rsplit('@', 1)[0]
+        if ':' in repository.rsplit('/', 1)[-1]:
+            repository = repository.rsplit(':', 1)[0]
+        directory = self.cache.module_dir(
+            'oci-' + digest.replace(':', '-'),
+            lambda tmp: self._oras('pull', '--output', str(tmp), '{}@{}'.format(repository, digest)))
+        return str(directory / path)
+
+
+FETCHERS = {
+    'http': HttpFetcher,
+    'https': HttpFetcher,
+    'git': GitFetcher,
+    'git+file': GitFetcher,
+    'git+http': GitFetcher,
+    'git+https': GitFetcher,
+    'git+ssh': GitFetcher,
+    'oci': OciFetcher,
+}
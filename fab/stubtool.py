@@ -0,0 +1,107 @@
+"""
+Stand-in container tool for `fab bench`: answers the commands fab issues
+without podman or network access.
+
+State (known images) lives in the JSON file named by $FAB_STUB_STATE. Builds
+sleep $FAB_STUB_LATENCY seconds and print $FAB_STUB_LINES lines of output.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+
+LINE = 'STEP {}/{}: RUN simulated build output padded to a typical podman line length .........\n'
+
+
+def _normalize(name):
+    if '@' in name:
+        return name
+    if '/' not in name:
+        name = 'localhost/' + name
+    if ':' not in name.rsplit('/', 1)[-1]:
+        name += ':latest'
+    return name
+
+
+def _option(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def main(argv):
+    path = os.environ['FAB_STUB_STATE']
+    args = list(argv)
+    # skip global options such as --connection NAME
+    while args and args[0].startswith('-'):
+        args = args[2:] if '=' not in args[0] else args[1:]
+    if not args:
+        return 125
+    command, args = args[0], args[1:]
+    if command == 'build':
+        latency = float(os.environ.get('FAB_STUB_LATENCY', '0'))
+        lines = int(os.environ.get('FAB_STUB_LINES', '0'))
+        if latency:
+            time.sleep(latency)
+        out = sys.stdout
+        for i in range(lines):
+            out.write(LINE.format(i + 1, lines))
+        out.flush()
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                images = json.load(f)
+        except FileNotFoundError:
+            images = {}
+        rc = _command(images, command, args)
+        with open(path, 'w') as f:
+            json.dump(images, f)
+    return rc
+
+
+def _command(images, command, args):
+    if command == 'build':
+        tag = _option(args, '--tag')
+        image_id = hashlib.sha256(json.dumps([args, time.time()]).encode()).hexdigest()
+        if tag:
+            images[_normalize(tag)] = image_id
+        iidfile = _option(args, '--iidfile')
+        if iidfile:
+            with open(iidfile, 'w') as f:
+                f.write('sha256:' + image_id)
+    elif command == 'images':
+        for name, image_id in sorted(images.items()):
+            print('{} sha256:{}'.format(name, image_id))
+    elif command == 'image' and args[:1] == ['inspect']:
+        image_id = images.get(_normalize(args[-1]))
+        if image_id is None:
+            return 125
+        print('sha256:' + image_id)
+    elif command == 'pull':
+        images[_normalize(args[-1])] = hashlib.sha256(args[-1].encode()).hexdigest()
+    elif command == 'tag':
+        if _normalize(args[0]) not in images:
+            return 125
+        images[_normalize(args[1])] = images[_normalize(args[0])]
+    return 0
+
+
+def install(directory):
+    """
+    Write an executable wrapper for the stub into directory and return its path
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = os.path.join(directory, 'stub-podman')
+    with open(path, 'w') as f:
+        f.write('#!{}\nimport sys\nsys.path.insert(0, {!r})\nfrom fab.stubtool import main\n'
+                'sys.exit(main(sys.argv[1:]))\n'.format(sys.executable, package_root))
+    os.chmod(path, 0o755)
+    return path
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
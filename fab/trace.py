@@ -0,0 +1,130 @@
+"""
+Build tracing: per-stage spans exported as Chrome Trace Event JSON.
+"""
+
+import os
+import json
+import time
+import threading
+
+# Span categories shown in the summary table
+SUMMARY_CATEGORIES = ('stage', 'cache', 'pull')
+
+
+class Tracer:
+    """
+    Collects spans for the stages of a build.
+
+    Span timestamps are relative to the creation of the tracer and every thread
+    building stages gets its own track, so the exported file shows concurrent
+    stages side by side when loaded in Perfetto or chrome://tracing.
+    """
+
+    def __init__(self):
+        self.origin = time.monotonic()
+        # end of the last span, for the wall time of the whole build
+        self.end = self.origin
+        self.events = []
+        self.rows = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        ident = threading.get_ident()
+        if ident not in self._threads:
+            self._threads[ident] = len(self._threads) + 1
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': self._threads[ident],
+                                'args': {'name': 'main' if len(self._threads) == 1 else
+                                         'worker {}'.format(len(self._threads) - 1)}})
+        return self._threads[ident]
+
+    def span(self, name, category, start, end=None, **args):
+        """
+        Record a complete span from start to end (time.monotonic() values; end defaults to now)
+        """
+        end = time.monotonic() if end is None else end
+        with self._lock:
+            self.end = max(self.end, end)
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6),
+                'dur': round((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': self._tid(),
+                'args': args,
+            })
+            if category in SUMMARY_CATEGORIES:
+                self.rows.append(dict(args, name=name, category=category, wall=end - start))
+
+    def run(self, name, category, log, start, **args):
+        """
+        Record a span for a finished container tool run, with the statistics of its StageLog
+        """
+        usage = log.rusage
+        if usage is not None:
+            args['cpu_s'] = round(usage.ru_utime + usage.ru_stime, 3)
+            # ru_maxrss is in kilobytes on Linux
+            args['max_rss_kb'] = usage.ru_maxrss
+        if log.cache_hits is not None:
+            args['layer_cache_hits'] = log.cache_hits
+        args['lines'] = log.line_count
+        args['bytes'] = log.byte_count
+        args['exit_code'] = log.returncode
+        if log.path:
+            args['log'] = log.path
+        self.span(name, category, start, **args)
+
+    def loads(self, fabfiles):
+        """
+        Record a span for every module YAML the fabfiles loaded
+        """
+        seen = set()
+        for fabfile in fabfiles:
+            for module in fabfile.includes:
+                loaded = getattr(module, 'loaded', None)
+                if loaded is None or id(module) in seen:
+                    continue
+                seen.add(id(module))
+                self.span('load {}'.format(module.name), 'load', loaded[0], loaded[1], source=module.source)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """
+        Return a table of the traced stages, slowest first
+        """
+        header = '{:<40} {:<8} {:>9} {:>9} {:>10} {:>8} {:>10} {:>5}'.format(
+            'Stage', 'Cache', 'Wall', 'CPU', 'Max RSS', 'Lines', 'Bytes', 'Exit')
+        lines = [header, '-' * len(header)]
+        for row in sorted(self.rows, key=lambda row: row['wall'], reverse=True):
+            cpu = row.get('cpu_s')
+            rss = row.get('max_rss_kb')
+            lines.append('{:<40} {:<8} {:>8.1f}s {:>9} {:>10} {:>8} {:>10} {:>5}'.format(
+                row['name'][:40], row.get('cache', row['category']), row['wall'],
+                '-' if cpu is None else '{:.1f}s'.format(cpu),
+                '-' if rss is None else '{:.0f} MB'.format(rss / 1024),
+                row.get('lines', '-'), _size(row.get('bytes')), _value(row.get('exit_code'))))
+        # concurrent spans overlap, so their sum is more than the time the build took
+        stage_time = sum(row['wall'] for row in self.rows)
+        lines.append('-' * len(header))
+        lines.append('{:<40} {:<8} {:>8.1f}s'.format('Stage time ({} spans)'.format(len(self.rows)), '', stage_time))
+        lines.append('{:<40} {:<8} {:>8.1f}s'.format('Build wall time', '', self.end - self.origin))
+        return '\n'.join(lines)
+
+
+def _value(value):
+    return '-' if value is None else value
+
+
+def _size(count):
+    if count is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB'):
+        if count < 1024:
+            return '{:.0f} {}'.format(count, unit)
+        count /= 1024
+    return '{:.1f} GB'.format(count)
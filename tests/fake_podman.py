@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Minimal stand-in for podman used by the build tests.
+
+State (known images and the list of invocations) lives in the JSON file named
+by $FAKE_PODMAN_STATE, with a separate file per --connection or --url endpoint;
+the endpoints listed in $FAKE_PODMAN_DOWN fail every command. $FAKE_PODMAN_FAIL makes builds of matching tags fail at
+once and $FAKE_PODMAN_SLEEP delays every other build by that many seconds, $FAKE_PODMAN_PULL_SLEEP every pull.
+Every pull records when it started and ended under "pulls".
+The size of an image follows from its ID, and an image a tag no longer points at stays until removed by ID.
+Like podman, rmi only untags an image other names still point at and refuses images other images are built on.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+
+def _normalize(name):
+    if '@' in name:
+        return name
+    if '/' not in name:
+        name = 'localhost/' + name
+    if ':' not in name.rsplit('/', 1)[-1]:
+        name += ':latest'
+    return name
+
+
+def _option(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def _set_tag(state, name, image_id):
+    """Point name at image_id; the image it pointed at stays around untagged, like in podman."""
+    previous = state['images'].get(name)
+    state['images'][name] = image_id
+    if previous is not None and previous not in state['images'].values():
+        state.setdefault('untagged', []).append(previous)
+
+
+def _remove(state, name):
+    """Remove the image name (a tag or an ID) the way podman rmi does, and return the exit code."""
+    image_id = state['images'].get(_normalize(name))
+    by_id = image_id is None
+    if by_id:
+        image_id = name
+    tags = [tag for tag, value in state['images'].items() if value == image_id]
+    if not tags and image_id not in state.get('untagged', []):
+        print('Error: {}: image not known'.format(name), file=sys.stderr)
+        return 1
+    if not by_id and len(tags) > 1:
+        del state['images'][_normalize(name)]
+        return 0
+    if by_id and len(tags) > 1:
+        print('Error: unable to delete image {} by ID with more than one tag'.format(name), file=sys.stderr)
+        return 2
+    alive = set(state['images'].values()) | set(state.get('untagged', []))
+    if any(parent == image_id and child in alive for child, parent in state.get('parents', {}).items()):
+        print('Error: image {} has dependent children'.format(name), file=sys.stderr)
+        return 2
+    for tag in tags:
+        del state['images'][tag]
+    if image_id in state.get('untagged', []):
+        state['untagged'].remove(image_id)
+    return 0
+
+
+def main(argv):
+    path = os.environ['FAKE_PODMAN_STATE']
+    endpoint = _option(argv, '--connection') or _option(argv, '--url')
+    if endpoint:
+        if endpoint in os.environ.get('FAKE_PODMAN_DOWN', '').split(','):
+            print('Error: unable to connect to {}'.format(endpoint), file=sys.stderr)
+            return 125
+        path = '{}.{}'.format(path, endpoint.replace('/', '_'))
+    failing = os.environ.get('FAKE_PODMAN_FAIL') and os.environ['FAKE_PODMAN_FAIL'] in (_option(argv, '--tag') or '')
+    if 'build' in argv and os.environ.get('FAKE_PODMAN_SLEEP') and not failing:
+        time.sleep(float(os.environ['FAKE_PODMAN_SLEEP']))
+    started = time.time()
+    if 'pull' in argv and os.environ.get('FAKE_PODMAN_PULL_SLEEP'):
+        time.sleep(float(os.environ['FAKE_PODMAN_PULL_SLEEP']))
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _main(path, argv, started)
+
+
+def _main(path, argv, started):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {'images': {}, 'calls': []}
+    state['calls'].append(argv)
+    # skip global options such as --connection NAME
+    args = list(argv)
+    while args and args[0].startswith('-'):
+        args = args[2:] if '=' not in args[0] else args[1:]
+    command, args = args[0], args[1:]
+    rc = 0
+    if command == 'build':
+        tag = _option(args, '--tag')
+        image_id = hashlib.sha256(json.dumps([argv, len(state['calls'])]).encode()).hexdigest()
+        print('STEP 1/1: RUN true')
+        print('COMMIT {}'.format(tag))
+        _set_tag(state, _normalize(tag), image_id)
+        base = _option(args, '--from')
+        if base:
+            state.setdefault('parents', {})[image_id] = state['images'].get(_normalize(base), base)
+        if _option(args, '--platform'):
+            state.setdefault('platforms', {})[image_id] = _option(args, '--platform')
+        state.setdefault('contexts', {})[tag] = sorted(
+            os.path.relpath(os.path.join(root, name)) for root, _, files in os.walk('.') for name in files)
+        iidfile = _option(args, '--iidfile')
+        if iidfile:
+            with open(iidfile, 'w') as f:
+                f.write('sha256:' + image_id)
+        if os.environ.get('FAKE_PODMAN_FAIL') and os.environ['FAKE_PODMAN_FAIL'] in tag:
+            rc = 1
+    elif command == 'images':
+        for name, image_id in sorted(state['images'].items()):
+            print('{} sha256:{}'.format(name, image_id))
+    elif command == 'image' and args[0] == 'inspect':
+        template = _option(args, '--format') or '{{.Id}}'
+        lines = []
+        for name in [name for name in args[1:] if name not in ('--format', template)]:
+            image_id = state['images'].get(_normalize(name))
+            if image_id is None and name in state['images'].values():
+                image_id = name
+            if image_id is None:
+                rc = 125
+                break
+            platform = state.get('platforms', {}).get(image_id, 'linux/amd64').split('/')
+            lines.append(template.replace('{{.Id}}', 'sha256:' + image_id).replace('{{.Digest}}', 'sha256:' + image_id)
+                         .replace('{{.Os}}', platform[0]).replace('{{.Architecture}}', platform[1])
+                         .replace('{{.Size}}', str(int(image_id[:4], 16) * 1000)))
+        else:
+            print('\n'.join(lines))
+    elif command == 'rmi':
+        for name in args:
+            rc = _remove(state, name) or rc
+    elif command == 'pull':
+        platform = _option(args, '--platform')
+        image_id = hashlib.sha256((args[-1] + (platform or '')).encode()).hexdigest()
+        _set_tag(state, _normalize(args[-1]), image_id)
+        state.setdefault('pulls', []).append([args[-1], started, time.time()])
+        if platform:
+            state.setdefault('platforms', {})[image_id] = platform
+    elif command == 'manifest':
+        manifests = state.setdefault('manifests', {})
+        if args[0] == 'exists':
+            rc = 0 if args[1] in manifests else 1
+        elif args[0] == 'rm':
+            rc = 0 if manifests.pop(args[1], None) is not None else 1
+        elif args[0] == 'create':
+            manifests[args[1]] = []
+        elif args[0] == 'add':
+            manifests[args[1]].append(args[2])
+    elif command == 'tag':
+        _set_tag(state, _normalize(args[1]), state['images'][_normalize(args[0])])
+    with open(path, 'w') as f:
+        json.dump(state, f)
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
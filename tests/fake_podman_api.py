@@ -0,0 +1,177 @@
+"""
+Minimal stand-in for the Podman REST API used by the API backend tests.
+
+Serves the endpoints fab uses on a Unix socket from a thread and keeps its
+images in memory. Builds of tags containing ``fail`` stream an error, and a
+build repeating an earlier one reports a layer cache hit.
+"""
+
+import hashlib
+import io
+import json
+import os
+import socketserver
+import tarfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+
+def _normalize(name):
+    if '/' not in name:
+        name = 'localhost/' + name
+    if ':' not in name.rsplit('/', 1)[-1]:
+        name += ':latest'
+    return name
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.api.connections += 1
+
+    def address_string(self):
+        return 'unix'
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _json(self, status, value=None):
+        data = json.dumps(value).encode() if value is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, messages):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for message in messages:
+            data = json.dumps(message).encode() + b'\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _route(self, method):
+        url = urllib.parse.urlparse(self.path)
+        params = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        path = url.path.split('/libpod', 1)[1]
+        body = self._body()
+        api = self.server.api
+        with api.lock:
+            api.requests.append((method, path, params))
+            images = api.images
+            if path == '/info':
+                return self._json(200, {'host': {'arch': 'amd64'}})
+            if path == '/images/json':
+                tags = {}
+                for name, image_id in images.items():
+                    tags.setdefault(image_id, []).append(name)
+                return self._json(200, [{'Id': image_id, 'RepoTags': names} for image_id, names in tags.items()])
+            if path.startswith('/images/') and path.endswith('/json'):
+                name = urllib.parse.unquote(path[len('/images/'):-len('/json')])
+                image_id = images.get(_normalize(name)) or (name if name in images.values() else None)
+                if image_id is None:
+                    return self._json(404, {'message': 'no such image'})
+                return self._json(200, {'Id': image_id, 'Digest': 'sha256:' + image_id, 'Os': 'linux',
+                                        'Architecture': 'amd64', 'Size': int(image_id[:4], 16) * 1000})
+            if path.startswith('/images/') and method == 'DELETE':
+                name = urllib.parse.unquote(path[len('/images/'):])
+                names = [tag for tag, image_id in images.items() if _normalize(name) == tag or name == image_id]
+                for tag in names:
+                    del images[tag]
+                return self._json(200 if names else 404, {'Deleted': names})
+            if path == '/images/pull':
+                image_id = hashlib.sha256(params['reference'].encode()).hexdigest()
+                images[_normalize(params['reference'])] = image_id
+                return self._stream([{'stream': 'Trying to pull {}...\n'.format(params['reference'])},
+                                     {'images': [image_id], 'id': image_id}])
+            if path.startswith('/images/') and path.endswith('/tag'):
+                source = urllib.parse.unquote(path[len('/images/'):-len('/tag')])
+                image_id = images.get(_normalize(source)) or (source if source in images.values() else None)
+                if image_id is None:
+                    return self._json(404, {'message': 'no such image'})
+                images[_normalize('{}:{}'.format(params['repo'], params['tag']))] = image_id
+                return self._json(201)
+            if path == '/build':
+                with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                    files = {os.path.normpath(member.name): member for member in tar.getmembers() if member.isfile()}
+                    members = sorted(files)
+                    containerfile = tar.extractfile(files[os.path.normpath(params['dockerfile'])]).read().decode()
+                tag = params.get('t', '')
+                build = dict(params, context=members, containerfile=containerfile)
+                repeated = build in api.builds
+                api.builds.append(build)
+                if 'fail' in tag:
+                    return self._stream([{'stream': 'STEP 1/2: FROM {}\n'.format(params.get('from'))},
+                                         {'error': 'building at STEP "RUN false": exit status 1'}])
+                image_id = hashlib.sha256(json.dumps([build, len(api.builds)]).encode()).hexdigest()
+                images[_normalize(tag)] = image_id
+                messages = [{'stream': 'STEP 1/2: FROM {}\n'.format(params.get('from'))},
+                            {'stream': 'STEP 2/2: RUN true\n'}]
+                if repeated:
+                    messages.append({'stream': '--> Using cache {}\n'.format(image_id)})
+                messages += [{'stream': 'COMMIT {}\n'.format(tag)}, {'aux': {'ID': 'sha256:' + image_id}},
+                             {'stream': 'Successfully built {}\n'.format(image_id[:12])}]
+                return self._stream(messages)
+            if path == '/manifests':
+                api.manifests[params['name']] = []
+                return self._json(201, {'Id': params['name']})
+            if path.startswith('/manifests/'):
+                name, _, action = urllib.parse.unquote(path[len('/manifests/'):]).partition('/')
+                if action == 'exists':
+                    return self._json(204 if name in api.manifests else 404)
+                if action == 'add':
+                    api.manifests[name] += json.loads(body)['images']
+                    return self._json(200, {'Id': name})
+                if method == 'DELETE':
+                    return self._json(200 if api.manifests.pop(name, None) is not None else 404)
+        return self._json(404, {'message': 'unknown endpoint {}'.format(path)})
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class FakePodmanApi:
+    """Serve the fake API on socket_path until stop()."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.images = {}
+        self.manifests = {}
+        self.requests = []
+        self.builds = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = _Server(socket_path, Handler)
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,39 @@
+"""
+Tests for the offline benchmark suite.
+"""
+
+import json
+
+from fab.bench import BenchSuite, compare
+
+
+def test_bench_suites_run_offline(tmp_path, monkeypatch, capsys):
+    from fab.cli import main
+    results = BenchSuite(modules=3, buildargs=2, users=20, stub_latency=0, stub_lines=10, log_mb=1).run(
+        ['plan', 'build', 'logs', 'kickstart'])
+    metrics = results['metrics']
+    for name in ('yaml_load_s', 'plan_s', 'build_s', 'cached_build_s', 'log_stream_mb_per_s',
+                 'kickstart_entries_per_s'):
+        assert metrics[name]['value'] > 0
+    assert metrics['log_stream_mb_per_s']['better'] == 'higher'
+
+    baseline = tmp_path / 'baseline.json'
+    metrics['plan_s']['value'] = 1e-9
+    baseline.write_text(json.dumps(results))
+    monkeypatch.setattr('sys.argv', ['fab', 'bench', '--suite', 'plan', '--modules', '3', '--baseline',
+                                     str(baseline), '--output', str(tmp_path / 'results.json')])
+    assert main() == 1
+    assert 'plan_s' in capsys.readouterr().out.split('Regressions')[1]
+    assert 'plan_s' in json.loads((tmp_path / 'results.json').read_text())['metrics']
+
+
+def test_compare_respects_direction_and_threshold():
+    def results(**values):
+        return {'metrics': {name: {'value': value, 'unit': 's', 'better': 'higher' if name.endswith('rate')
+                                   else 'lower'} for name, value in values.items()}}
+
+    baseline = results(build_s=1.0, rate=100.0, gone=1.0)
+    assert compare(results(build_s=1.1, rate=95.0, new=5.0), baseline, 0.2) == []
+    regressions = compare(results(build_s=1.5, rate=50.0), baseline, 0.2)
+    assert [line.split(':')[0] for line in regressions] == ['build_s', 'rate']
+    assert compare(results(build_s=0.1, rate=1000.0), baseline, 0.2) == []
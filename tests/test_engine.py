@@ -0,0 +1,63 @@
+"""
+Tests for the Podman REST API backend, run against tests/fake_podman_api.py.
+"""
+
+import os
+import shutil
+
+import pytest
+
+from fab.builder import StageBuilder
+from fab.cache import StageCache
+from fab.engine import ApiEngine
+from fab.fabfile import FabFile
+from fab.logstream import QUIET, LogConsole
+
+from tests.fake_podman_api import FakePodmanApi
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(SAMPLES, 'modules'), tmp_path / 'modules')
+    shutil.copy(os.path.join(SAMPLES, 'Fabfile.example'), tmp_path / 'Fabfile')
+    monkeypatch.chdir(tmp_path)
+    server = FakePodmanApi(str(tmp_path / 'podman.sock'))
+    yield server
+    server.stop()
+
+
+def api_builder(api, tmp_path, **kwargs):
+    return StageBuilder(engine=ApiEngine(api.socket_path), cache=StageCache(tmp_path / 'stages.json'),
+                        console=LogConsole(QUIET), **kwargs)
+
+
+def test_api_build_streams_context_and_reads_image_ids(api, tmp_path):
+    builder = api_builder(api, tmp_path)
+    assert FabFile('Fabfile').build(builder=builder)
+    ssh, dnf = api.builds
+    assert ssh['t'] == 'fabrules-stage-ssh'
+    assert ssh['from'] == api.images['quay.io/centos-bootc/centos-bootc:stream9']
+    assert ssh['context'] == ['Containerfile']
+    assert dnf['from'] == 'fabrules-stage-ssh'
+    assert dnf['context'] == ['install.Containerfile']
+    assert dnf['buildargs'] == '{"RPMS": "tmux cloud-init"}'
+    assert api.images['localhost/fabrules:latest'] == api.images['localhost/fabrules-stage-dnf-install:latest']
+    assert builder.cache.lookup('fabrules-stage-ssh', builder.cache.entries['fabrules-stage-ssh']['key']) == \
+        api.images['localhost/fabrules-stage-ssh:latest']
+    # every request went over one pooled keep-alive connection
+    assert api.connections == 1
+
+
+def test_api_build_reports_errors_and_cache_hits(api, tmp_path):
+    builder = api_builder(api, tmp_path, stage_cache=False)
+    assert FabFile('Fabfile').build(builder=builder)
+    assert FabFile('Fabfile').build(builder=builder)
+    assert builder.logs['fabrules-stage-ssh'].cache_hits == 1
+
+    (tmp_path / 'Fabfile').write_text((tmp_path / 'Fabfile').read_text().replace('fabrules', 'fail'))
+    assert not FabFile('Fabfile').build(builder=builder)
+    log = builder.logs['fail-stage-ssh']
+    assert log.returncode == 1
+    assert 'Error: building at STEP "RUN false": exit status 1' in log.lines
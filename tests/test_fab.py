@@ -134,5 +134,18 @@ group --name=testgroup
             os.remove(test_file)
 
 
+def test_version_command_imports_no_subcommand_modules():
+    """Test that the version command does not load the build and kickstart dependencies."""
+    import subprocess
+    probe = ("import sys; sys.argv = ['fab', 'version']; from fab.cli import main; main(); "
+             "print(' '.join(sorted(sys.modules)))")
+    result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    modules = result.stdout.splitlines()[-1].split()
+    for heavy in ("yaml", "pykickstart", "subprocess", "fab.fabfile", "fab.kickstart"):
+        assert heavy not in modules
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,507 @@
+"""
+Tests for Fabfile builds, run against tests/fake_podman.py.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import fab.cache
+from fab.fabfile import FabFile
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+FAKE_PODMAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_podman.py')
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Copy the sample modules into a temp dir and point fab at the fake container tool."""
+    shutil.copytree(os.path.join(SAMPLES, 'modules'), tmp_path / 'modules')
+    shutil.copy(os.path.join(SAMPLES, 'Fabfile.example'), tmp_path / 'Fabfile')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('FAKE_PODMAN_STATE', str(tmp_path / 'podman.json'))
+    monkeypatch.setattr(fab.cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path
+
+
+def builds(workdir):
+    """Return the tags built so far by the fake container tool."""
+    with open(workdir / 'podman.json') as f:
+        calls = json.load(f)['calls']
+    return [call[call.index('--tag') + 1] for call in calls if 'build' in call]
+
+
+def test_build_tags_every_stage(workdir):
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert builds(workdir) == ['fabrules-stage-ssh', 'fabrules-stage-dnf-install']
+
+
+def test_stage_cache_skips_unchanged_stages(workdir):
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert len(builds(workdir)) == 2
+
+    with open(workdir / 'modules' / 'dnf' / 'install.Containerfile', 'a') as f:
+        f.write('RUN true\n')
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert builds(workdir)[2:] == ['fabrules-stage-dnf-install']
+
+
+def test_no_stage_cache_rebuilds(workdir):
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert FabFile('Fabfile', FAKE_PODMAN, stage_cache=False).build()
+    assert len(builds(workdir)) == 4
+
+
+def test_failed_stage_fails_build(workdir, monkeypatch):
+    monkeypatch.setenv('FAKE_PODMAN_FAIL', 'dnf-install')
+    assert not FabFile('Fabfile', FAKE_PODMAN).build()
+
+
+def tags(workdir):
+    """Return the (source, target) pairs tagged so far by the fake container tool."""
+    with open(workdir / 'podman.json') as f:
+        calls = json.load(f)['calls']
+    return [tuple(call[-2:]) for call in calls if call[0] == 'tag']
+
+
+def test_matrix_builds_shared_prefix_once(workdir):
+    with open(workdir / 'Fabfile', 'a') as f:
+        f.write('matrix:\n'
+                '  - name: tools\n'
+                '    buildargs:\n'
+                '      - RPMS: tmux vim\n'
+                '  - name: cloud\n'
+                '    include:\n'
+                '      - modules/cloud-init/enable.yaml\n')
+    assert FabFile('Fabfile', FAKE_PODMAN).build(jobs=2)
+    built = builds(workdir)
+    assert len([tag for tag in built if tag.endswith('-stage-ssh')]) == 1
+    assert len([tag for tag in built if tag.endswith('-stage-dnf-install')]) == 2
+    assert 'cloud-stage-cloud-init-enable' in built
+    assert ('tools-stage-dnf-install', 'tools') in tags(workdir)
+    assert ('cloud-stage-cloud-init-enable', 'cloud') in tags(workdir)
+
+
+def test_build_many_fabfiles_from_cli(workdir, monkeypatch):
+    from fab.cli import main
+    with open(workdir / 'Fabfile') as f:
+        content = f.read()
+    with open(workdir / 'Fabfile.other', 'w') as f:
+        f.write(content.replace('fabrules', 'other').replace('tmux cloud-init', 'vim'))
+    monkeypatch.setattr('sys.argv', ['fab', 'build', 'Fabfile', 'Fabfile.other',
+                                     '--container-tool', FAKE_PODMAN, '--jobs', '2'])
+    assert main() == 0
+    built = builds(workdir)
+    assert built[0] in ('fabrules-stage-ssh', 'other-stage-ssh')
+    assert sorted(built[1:]) == ['fabrules-stage-dnf-install', 'other-stage-dnf-install']
+
+
+def test_fused_build_is_a_single_invocation(workdir, monkeypatch):
+    from fab.builder import StageBuilder
+    from fab.fuse import FusedBuild, render_containerfile
+    fabfile = FabFile('Fabfile', FAKE_PODMAN)
+    containerfile, contexts = render_containerfile(fabfile)
+    assert 'FROM quay.io/centos-bootc/centos-bootc:stream9 AS stage0' in containerfile
+    assert 'FROM stage0 AS stage1' in containerfile
+    assert sorted(contexts) == ['module0', 'module1']
+
+    builder = StageBuilder(FAKE_PODMAN)
+    assert FusedBuild(fabfile, builder).build()
+    assert builds(workdir) == ['fabrules']
+    assert FusedBuild(fabfile, builder, stage_tags=True).build()
+    assert builds(workdir)[1:] == ['fabrules', 'fabrules-stage-ssh', 'fabrules-stage-dnf-install']
+
+
+def test_fused_copy_reads_module_context(tmp_path):
+    from fab.fuse import render_module
+
+    class Module:
+        name = 'files'
+        containerfile_path = tmp_path / 'Containerfile'
+
+    Module.containerfile_path.write_text('FROM scratch AS build\nCOPY a /a\n'
+                                         'FROM foobar\nCOPY --from=build /a /a\n'
+                                         'RUN --mount=type=bind,source=b,target=/b cat /b\n')
+    _, body = render_module(3, Module, 'stage2')
+    assert body[1:] == ['FROM stage2 AS stage3-0', 'COPY --from=module3 a /a',
+                        'FROM foobar AS stage3', 'COPY --from=stage3-0 /a /a',
+                        'RUN --mount=type=bind,source=b,target=/b,from=module3 cat /b']
+
+
+def test_stream_keeps_tail_and_compressed_log(tmp_path):
+    import gzip
+    import io
+    import subprocess
+    import sys
+    from fab.logstream import PROGRESS, LogConsole, StageLog, stream
+
+    script = 'import sys\nfor i in range(1000): print("line", i)\nsys.stdout.write("last")\nsys.exit(3)\n'
+    process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = io.StringIO()
+    log = StageLog('demo-stage-ssh', tmp_path, tail=5)
+    assert stream(process, log, LogConsole(PROGRESS, stream=output)) == 3
+
+    assert list(log.lines) == ['line 996', 'line 997', 'line 998', 'line 999', 'last']
+    assert log.line_count == 1001
+    with gzip.open(log.path, 'rb') as f:
+        assert f.read().count(b'\n') == 1000
+    lines = output.getvalue().splitlines()
+    assert lines[0] == '==> demo-stage-ssh started'
+    assert lines[1].startswith('==> demo-stage-ssh failed with exit code 3')
+    assert lines[-1] == '    | last'
+    assert len(lines) == 2 + 1 + 5
+
+
+def test_catalog_resolves_includes_by_name(workdir, monkeypatch):
+    from fab.catalog import Catalog
+    catalog = Catalog(workdir / 'modules')
+    assert catalog.index() == 6
+    catalog.save()
+
+    with open(workdir / 'Fabfile.names', 'w') as f:
+        f.write('metadata:\n  name: named\nfrom: quay.io/centos-bootc/centos-bootc:stream9\n'
+                'catalog: modules\ninclude:\n  - ssh\n  - dnf-install\n')
+    fabfile = FabFile('Fabfile.names', FAKE_PODMAN)
+    assert [module.name for module in fabfile.includes] == ['ssh', 'dnf-install']
+    assert fabfile.includes[1].definition['buildargs'] == ['RPMS']
+
+    # unchanged modules are served from the index, only changed ones are parsed again
+    import fab.catalog
+    parsed = []
+    monkeypatch.setattr(fab.catalog, 'load_yaml', lambda data: parsed.append(data) or fab.module.load_yaml(data))
+    FabFile('Fabfile.names', FAKE_PODMAN)
+    assert parsed == []
+    with open(workdir / 'modules' / 'ssh' / 'ssh.yaml', 'a') as f:
+        f.write('# touched\n')
+    FabFile('Fabfile.names', FAKE_PODMAN)
+    assert len(parsed) == 1
+
+
+def test_trace_records_stage_spans(workdir, monkeypatch, capsys):
+    from fab.cli import main
+    argv = ['fab', 'build', 'Fabfile', '--container-tool', FAKE_PODMAN, '--trace', 'trace.json']
+    monkeypatch.setattr('sys.argv', argv)
+    assert main() == 0
+    monkeypatch.setattr('sys.argv', argv[:-1] + ['trace2.json'])
+    assert main() == 0
+
+    with open(workdir / 'trace.json') as f:
+        events = json.load(f)['traceEvents']
+    spans = {event['name']: event for event in events if event['ph'] == 'X'}
+    stage = spans['fabrules-stage-ssh']
+    assert stage['cat'] == 'stage'
+    assert stage['args']['cache'] == 'miss'
+    assert stage['args']['exit_code'] == 0
+    assert stage['args']['lines'] == 2
+    assert stage['args']['max_rss_kb'] > 0
+    assert 'yaml_load_ms' in stage['args']
+    assert spans['pull quay.io/centos-bootc/centos-bootc:stream9']['cat'] == 'pull'
+    assert any(event['cat'] == 'load' for event in spans.values())
+
+    with open(workdir / 'trace2.json') as f:
+        events = json.load(f)['traceEvents']
+    assert [event['args']['cache'] for event in events if event.get('cat') == 'cache'] == ['hit', 'hit']
+    output = capsys.readouterr().out
+    assert 'Stage time (2 spans)' in output and 'Build wall time' in output
+    assert output.count('fabrules-stage-dnf-install') >= 2
+
+
+def test_trace_summary_wall_time_counts_concurrent_stages_once():
+    from fab.trace import Tracer
+    tracer = Tracer()
+    start = tracer.origin
+    tracer.span('a-stage-one', 'stage', start, start + 2.0)
+    tracer.span('b-stage-one', 'stage', start + 0.5, start + 2.5)
+    summary = tracer.summary()
+    assert re.search(r'Stage time \(2 spans\)\s+4\.0s', summary)
+    assert re.search(r'Build wall time\s+2\.5s', summary)
+
+
+def build_cli(monkeypatch, *extra):
+    from fab.cli import main
+    monkeypatch.setattr('sys.argv', ['fab', 'build', 'Fabfile', '--container-tool', FAKE_PODMAN] + list(extra))
+    return main()
+
+
+def test_resume_rebuilds_from_failed_stage(workdir, monkeypatch):
+    monkeypatch.setenv('FAKE_PODMAN_FAIL', 'dnf-install')
+    assert build_cli(monkeypatch) == 1
+    with open(workdir / 'Fabfile.lock') as f:
+        image = json.load(f)['images']['fabrules']
+    assert image['base']['reference'] == 'quay.io/centos-bootc/centos-bootc:stream9'
+    assert [stage['tag'] for stage in image['stages']] == ['fabrules-stage-ssh']
+
+    monkeypatch.delenv('FAKE_PODMAN_FAIL')
+    assert build_cli(monkeypatch, '--resume', '--no-stage-cache') == 0
+    assert builds(workdir) == ['fabrules-stage-ssh', 'fabrules-stage-dnf-install', 'fabrules-stage-dnf-install']
+    with open(workdir / 'Fabfile.lock') as f:
+        stages = json.load(f)['images']['fabrules']['stages']
+    assert [stage['tag'] for stage in stages] == ['fabrules-stage-ssh', 'fabrules-stage-dnf-install']
+
+
+def test_locked_build_uses_pinned_base(workdir, monkeypatch):
+    assert build_cli(monkeypatch, '--locked') == 1
+    assert build_cli(monkeypatch) == 0
+    assert build_cli(monkeypatch, '--locked', '--no-stage-cache') == 0
+    with open(workdir / 'podman.json') as f:
+        calls = json.load(f)['calls']
+    assert sum(1 for call in calls if call[0] == 'pull') == 1
+    with open(workdir / 'Fabfile.lock') as f:
+        base = json.load(f)['images']['fabrules']['base']
+    ssh = [call for call in calls if 'build' in call and call[call.index('--tag') + 1] == 'fabrules-stage-ssh']
+    assert ssh[-1][ssh[-1].index('--from') + 1] == base['id']
+
+
+def test_build_context_pruned_to_module_sources(workdir):
+    module = workdir / 'shared'
+    (module / 'files').mkdir(parents=True)
+    (module / 'files' / 'motd').write_text('hello\n')
+    (module / 'setup.sh').write_text('true\n')
+    (module / 'large.img').write_bytes(b'\0' * 4096)
+    (module / 'copy.Containerfile').write_text(
+        'FROM scratch\nCOPY files/ /etc/\nRUN --mount=type=bind,source=setup.sh,target=/setup.sh sh /setup.sh\n')
+    (module / 'copy.yaml').write_text('metadata:\n  name: copy\ncontainerfile: copy.Containerfile\n')
+    (module / 'listed.Containerfile').write_text('FROM scratch\nRUN true\n')
+    (module / 'listed.yaml').write_text('metadata:\n  name: listed\ncontainerfile: listed.Containerfile\n'
+                                        'context:\n  - "*.sh"\n')
+    (workdir / 'Fabfile').write_text('metadata:\n  name: pruned\nfrom: quay.io/fedora/fedora:40\n'
+                                     'include:\n  - shared/copy.yaml\n  - shared/listed.yaml\n')
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    with open(workdir / 'podman.json') as f:
+        contexts = json.load(f)['contexts']
+    assert contexts['pruned-stage-copy'] == ['copy.Containerfile', 'files/motd', 'setup.sh']
+    assert contexts['pruned-stage-listed'] == ['listed.Containerfile', 'setup.sh']
+
+    # files outside every module's context don't invalidate the stage cache
+    (module / 'large.img').write_bytes(b'\1' * 4096)
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert len(builds(workdir)) == 2
+
+
+def test_digest_cache_skips_unchanged_files(tmp_path, monkeypatch):
+    path = tmp_path / 'payload'
+    path.write_text('payload\n')
+    os.utime(path, ns=(0, 10 ** 9))
+    digests = fab.cache.DigestCache(tmp_path / 'digests.json')
+    expected = fab.cache.hash_file(path)
+    assert digests.digest(path) == expected
+    digests.save()
+
+    monkeypatch.setattr(fab.cache, 'hash_file', lambda path: pytest.fail('rehashed an unchanged file'))
+    assert fab.cache.DigestCache(tmp_path / 'digests.json').digest(path) == expected
+    monkeypatch.undo()
+    path.write_text('changed\n')
+    assert fab.cache.DigestCache(tmp_path / 'digests.json').digest(path) == fab.cache.hash_file(path)
+
+
+def build_args(workdir, tag):
+    """Return the --build-arg values of the last build of tag."""
+    with open(workdir / 'podman.json') as f:
+        calls = [call for call in json.load(f)['calls'] if 'build' in call and call[call.index('--tag') + 1] == tag]
+    return [value for option, value in zip(calls[-1], calls[-1][1:]) if option == '--build-arg']
+
+
+def test_stages_get_only_their_scoped_buildargs(workdir, caplog):
+    (workdir / 'Fabfile').write_text(
+        'metadata:\n  name: scoped\nfrom: quay.io/fedora/fedora:40\n'
+        'include:\n  - include: modules/dnf/install.yaml\n    buildargs:\n      - RPMS: vim\n'
+        '  - modules/ssh/ssh.yaml\n'
+        'buildargs:\n  - SSHPUBKEY: key-one\n  - RPMS: tmux\n  - UNUSED: value\n')
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert build_args(workdir, 'scoped-stage-dnf-install') == ['RPMS=vim']
+    assert build_args(workdir, 'scoped-stage-ssh') == ['SSHPUBKEY=key-one']
+    assert 'Build arg UNUSED is set in scoped but no included module declares it' in caplog.text
+
+    with open(workdir / 'Fabfile') as f:
+        fabfile = f.read()
+    (workdir / 'Fabfile').write_text(fabfile.replace('key-one', 'key-two'))
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert builds(workdir) == ['scoped-stage-dnf-install', 'scoped-stage-ssh', 'scoped-stage-ssh']
+
+
+def test_declared_but_unset_buildarg_is_reported(workdir, caplog):
+    with open(workdir / 'Fabfile') as f:
+        fabfile = f.read()
+    (workdir / 'Fabfile').write_text(fabfile.replace('  - RPMS: tmux cloud-init\n', ''))
+    assert FabFile('Fabfile', FAKE_PODMAN).build()
+    assert 'Module dnf-install declares build arg RPMS but fabrules does not set it' in caplog.text
+    assert build_args(workdir, 'fabrules-stage-dnf-install') == []
+
+
+def test_platform_builds_and_manifest_list(workdir, monkeypatch):
+    assert build_cli(monkeypatch, '--platform', 'linux/amd64,linux/arm64') == 0
+    assert sorted(builds(workdir)) == ['fabrules-amd64-stage-dnf-install', 'fabrules-amd64-stage-ssh',
+                                       'fabrules-arm64-stage-dnf-install', 'fabrules-arm64-stage-ssh']
+    with open(workdir / 'podman.json') as f:
+        state = json.load(f)
+    assert state['manifests'] == {'fabrules': ['containers-storage:localhost/fabrules-amd64',
+                                               'containers-storage:localhost/fabrules-arm64']}
+    arm = [call for call in state['calls'] if 'build' in call and 'fabrules-arm64-stage-ssh' in call][0]
+    assert arm[arm.index('--platform') + 1] == 'linux/arm64'
+    assert state['platforms'][arm[arm.index('--from') + 1]] == 'linux/arm64'
+    assert os.path.exists(workdir / 'cache' / 'logs' / 'fabrules-arm64-stage-ssh.log.gz')
+
+
+def test_failed_platform_cancels_the_others(workdir, monkeypatch):
+    import time
+    monkeypatch.setenv('FAKE_PODMAN_SLEEP', '30')
+    monkeypatch.setenv('FAKE_PODMAN_FAIL', 'arm64-stage-ssh')
+    start = time.monotonic()
+    assert build_cli(monkeypatch, '--platform', 'linux/amd64,linux/arm64') == 1
+    assert time.monotonic() - start < 20
+    with open(workdir / 'podman.json') as f:
+        state = json.load(f)
+    assert 'manifests' not in state
+    assert not any('dnf-install' in call for call in state['calls'] if 'build' in call)
+
+
+def endpoint_builds(workdir, endpoint):
+    """Return the tags built on a stub build node."""
+    path = workdir / 'podman.json.{}'.format(endpoint)
+    if not path.exists():
+        return []
+    with open(path) as f:
+        calls = json.load(f)['calls']
+    return [call[call.index('--tag') + 1] for call in calls if 'build' in call]
+
+
+def test_farm_spreads_chains_and_keeps_affinity(workdir, monkeypatch, capsys):
+    shutil.copy(workdir / 'Fabfile', workdir / 'Fabfile.b')
+    with open(workdir / 'Fabfile.b') as f:
+        other = f.read().replace('fabrules', 'other').replace('  - modules/ssh/ssh.yaml\n', '')
+    (workdir / 'Fabfile.b').write_text(other)
+    from fab.cli import main
+    argv = ['fab', 'build', 'Fabfile', 'Fabfile.b', '--container-tool', FAKE_PODMAN, '--node', 'node-a',
+            '--node', 'node-b']
+    monkeypatch.setattr('sys.argv', argv)
+    assert main() == 0
+    a, b = endpoint_builds(workdir, 'node-a'), endpoint_builds(workdir, 'node-b')
+    assert sorted([a, b]) == [['fabrules-stage-ssh', 'fabrules-stage-dnf-install'], ['other-stage-dnf-install']]
+    assert 'node-a' in capsys.readouterr().out
+
+    # the nodes holding each chain's stages get the same chains again, all from their stage caches
+    monkeypatch.setattr('sys.argv', argv[:-4] + ['--node', 'node-b', '--node', 'node-a'])
+    assert main() == 0
+    assert (endpoint_builds(workdir, 'node-a'), endpoint_builds(workdir, 'node-b')) == (a, b)
+
+
+def test_farm_builds_from_each_nodes_own_base(workdir):
+    from fab.farm import BuildHost, FarmBuild
+    # node-b holds an older copy of the base image than the one node-a pulls
+    base = 'quay.io/centos-bootc/centos-bootc:stream9'
+    with open(workdir / 'podman.json.node-b', 'w') as f:
+        json.dump({'images': {base: 'b' * 64}, 'calls': []}, f)
+    hosts = [BuildHost.parse(name, FAKE_PODMAN, cache_dir=workdir / 'cache') for name in ('node-a', 'node-b')]
+    farm = FarmBuild(FabFile('Fabfile', FAKE_PODMAN).images(), hosts)
+    (root,) = farm.tree.roots.values()
+    (stage,) = root.children.values()
+    # the base is resolved on node-b after node-a, before node-a builds its first stage
+    assert farm._ensure(root, hosts[0]) != farm._ensure(root, hosts[1])
+    assert farm._ensure(stage, hosts[0]) is not None
+    with open(workdir / 'podman.json.node-a') as f:
+        state = json.load(f)
+    (build,) = [call for call in state['calls'] if 'build' in call]
+    assert build[build.index('--from') + 1] == state['images'][base]
+
+
+def test_farm_retries_on_another_node(workdir, monkeypatch, capsys):
+    monkeypatch.setenv('FAKE_PODMAN_DOWN', 'node-a')
+    assert build_cli(monkeypatch, '--node', 'node-a,capacity=2', '--node', 'node-b') == 0
+    assert endpoint_builds(workdir, 'node-b') == ['fabrules-stage-ssh', 'fabrules-stage-dnf-install']
+    summary = capsys.readouterr().out
+    assert re.search(r'node-a\s+2\s+0\s+0\s+0\s+.*down', summary)
+    assert re.search(r'node-b\s+1\s+2\s+0\s+0\s+.*up', summary)
+
+
+def test_images_prefetched_once_and_concurrently(workdir, monkeypatch, caplog):
+    import logging
+    from fab.cli import main
+    with open(workdir / 'Fabfile') as f:
+        content = f.read()
+    for name, base in (('other', 'quay.io/fedora/fedora-bootc:41'), ('third', 'quay.io/fedora/fedora-bootc:41')):
+        with open(workdir / 'Fabfile.{}'.format(name), 'w') as f:
+            f.write(content.replace('fabrules', name).replace('quay.io/centos-bootc/centos-bootc:stream9', base))
+    with open(workdir / 'modules' / 'dnf' / 'install.Containerfile', 'a') as f:
+        f.write('FROM quay.io/example/tools:1 AS tools\nFROM localhost/only-here\n')
+    monkeypatch.setenv('FAKE_PODMAN_PULL_SLEEP', '1')
+    monkeypatch.setattr('sys.argv', ['fab', 'build', 'Fabfile', 'Fabfile.other', 'Fabfile.third',
+                                     '--container-tool', FAKE_PODMAN, '--jobs', '2', '--pull-jobs', '3'])
+    with caplog.at_level(logging.INFO):
+        assert main() == 0
+    with open(workdir / 'podman.json') as f:
+        pulls = json.load(f)['pulls']
+    assert sorted(pull[0] for pull in pulls) == ['quay.io/centos-bootc/centos-bootc:stream9',
+                                                 'quay.io/example/tools:1', 'quay.io/fedora/fedora-bootc:41']
+    # all three pulls at once: each started before any of them ended
+    assert max(pull[1] for pull in pulls) < min(pull[2] for pull in pulls)
+    assert 'Pulled 3 images: ' in caplog.text
+
+
+def test_gc_removes_least_recently_used_stages(workdir, monkeypatch, capsys):
+    from fab.cli import main
+    with open(workdir / 'Fabfile') as f:
+        content = f.read()
+    for name in ('old', 'newer'):
+        with open(workdir / 'Fabfile.{}'.format(name), 'w') as f:
+            f.write(content.replace('fabrules', name))
+    for source in ('Fabfile', 'Fabfile.old', 'Fabfile.newer'):
+        monkeypatch.setattr('sys.argv', ['fab', 'build', source, '--container-tool', FAKE_PODMAN])
+        assert main() == 0
+    # the stages of Fabfiles without a lock file are not protected
+    os.remove(workdir / 'Fabfile.old.lock')
+    os.remove(workdir / 'Fabfile.newer.lock')
+
+    # but the last stage of each Fabfile is also its final image: removing its tag would free nothing
+    monkeypatch.setattr('sys.argv', ['fab', 'gc', '--max-images', '4', '--container-tool', FAKE_PODMAN])
+    assert main() == 0
+    assert 'Removed 0 stage tags (0B) and 0 superseded images; kept 6 stage images' in capsys.readouterr().out
+    # so their stages are still cached
+    for source in ('Fabfile.old', 'Fabfile.newer'):
+        monkeypatch.setattr('sys.argv', ['fab', 'build', source, '--container-tool', FAKE_PODMAN])
+        assert main() == 0
+        os.remove(workdir / '{}.lock'.format(source))
+    assert len(builds(workdir)) == 6
+
+    with open(workdir / 'modules' / 'dnf' / 'install.Containerfile', 'a') as f:
+        f.write('RUN true\n')
+    assert build_cli(monkeypatch) == 0
+    subprocess.run([FAKE_PODMAN, 'rmi', 'old', 'newer'], check=True)
+    with open(workdir / 'podman.json') as f:
+        before = json.load(f)['images']
+
+    gc = ['fab', 'gc', '--max-images', '4', '--container-tool', FAKE_PODMAN]
+    monkeypatch.setattr('sys.argv', gc + ['--dry-run'])
+    assert main() == 0
+    assert 'Would remove old-stage-dnf-install\nWould remove old-stage-ssh\n' in capsys.readouterr().out
+    with open(workdir / 'podman.json') as f:
+        assert json.load(f)['images'] == before
+
+    monkeypatch.setattr('sys.argv', gc)
+    assert main() == 0
+    assert 'Removed 2 stage tags' in capsys.readouterr().out
+    with open(workdir / 'podman.json') as f:
+        state = json.load(f)
+    removals = [call[1:] for call in state['calls'] if call[0] == 'rmi'][1:]
+    # the image fabrules-stage-dnf-install was rebuilt over goes first, then the old stages, child first
+    assert len(removals) == 3 and re.match(r'^[0-9a-f]{64}$', removals[0][0])
+    assert removals[1:] == [['old-stage-dnf-install'], ['old-stage-ssh']]
+    assert sorted(state['images']) == sorted(set(before) - {'localhost/old-stage-dnf-install:latest',
+                                                            'localhost/old-stage-ssh:latest'})
+    with open(workdir / 'cache' / 'stages.json') as f:
+        entries = json.load(f)
+    assert sorted(entries) == ['fabrules-stage-dnf-install', 'fabrules-stage-ssh', 'newer-stage-dnf-install',
+                               'newer-stage-ssh']
+    assert not any('superseded' in entry for entry in entries.values())
+    # like podman, an image other images are built on cannot be removed
+    assert subprocess.run([FAKE_PODMAN, 'rmi', 'newer-stage-ssh'], capture_output=True).returncode == 2
+
+    # the locked stages and the stages they are built on stay, whatever the budget
+    monkeypatch.setattr('sys.argv', gc[:2] + ['--max-images', '0'] + gc[4:])
+    assert main() == 0
+    with open(workdir / 'cache' / 'stages.json') as f:
+        assert sorted(json.load(f)) == ['fabrules-stage-dnf-install', 'fabrules-stage-ssh']
@@ -0,0 +1,286 @@
+"""
+Tests for applying Kickstart files to a temporary root.
+"""
+
+import os
+import sys
+from io import StringIO
+
+import pytest
+
+from fab.cli import main
+
+
+@pytest.fixture
+def root(tmp_path):
+    etc = tmp_path / 'etc'
+    etc.mkdir()
+    (etc / 'passwd').write_text('root:x:0:0:root:/root:/bin/bash\nold:x:1000:1000::/home/old:/bin/bash\n')
+    (etc / 'group').write_text('root:x:0:\nwheel:x:10:\nold:x:1000:\n')
+    (etc / 'shadow').write_text('root:!::0:99999:7:::\nold:!::0:99999:7:::\n')
+    (etc / 'gshadow').write_text('root:::\nwheel:::\nold:!::\n')
+    (etc / 'skel').mkdir()
+    (etc / 'skel' / '.bashrc').write_text('# bashrc\n')
+    return tmp_path
+
+
+def kickstart(tmp_path, content, *args):
+    path = tmp_path / 'test.ks'
+    path.write_text(content)
+    old_stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        sys.argv = ['fab', 'kickstart', str(path)] + list(args)
+        return main(), sys.stdout.getvalue()
+    finally:
+        sys.stdout = old_stdout
+
+
+def read(root, name):
+    return [line.split(':') for line in (root / 'etc' / name).read_text().splitlines()]
+
+
+def test_bulk_accounts_in_root(root):
+    rc, output = kickstart(root, 'group --name fabbers\ngroup --name redhatters --gid 2000\n'
+                                 'user --name foo1\nuser --name foo2 --groups redhatters,wheel --uid 1500\n'
+                                 'user --name foo3 --gid 2000 --password $6$x$y --iscrypted --lock\n',
+                           '--root', str(root))
+    assert rc == 0, output
+    passwd = {entry[0]: entry for entry in read(root, 'passwd')}
+    group = {entry[0]: entry for entry in read(root, 'group')}
+    shadow = {entry[0]: entry for entry in read(root, 'shadow')}
+    assert group['fabbers'][2] == '1001'
+    assert group['redhatters'] == ['redhatters', 'x', '2000', 'foo2']
+    assert group['wheel'][3] == 'foo2'
+    assert passwd['foo1'][2:4] == ['1001', '2001']
+    assert passwd['foo2'][2:4] == ['1500', '1500']
+    assert passwd['foo3'][2:4] == ['1501', '2000']
+    assert shadow['foo3'][1] == '!$6$x$y'
+    assert (root / 'home' / 'foo1' / '.bashrc').exists()
+    assert [entry[0] for entry in read(root, 'gshadow')][-2:] == ['foo1', 'foo2']
+
+
+def test_bulk_accounts_reject_collisions(root):
+    rc, output = kickstart(root, 'group --name dup --gid 10\n', '--root', str(root))
+    assert rc == 1
+    assert "GID '10' already exists" in output
+    # nothing is written when any entry fails
+    assert read(root, 'group')[-1][0] == 'old'
+
+
+@pytest.mark.parametrize('password, setting, expected', [
+    ('Hello world!', '$6$saltstring',
+     '$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJuesI68u4OTLiBFdcbYEdFCoEOfaS35inz1'),
+    ('Hello world!', '$6$rounds=10000$saltstringsaltstring',
+     '$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHbbMCVNSnCM/UrjmM0Dp8vOuZeHBy/YTBmSK6H9qs/'
+     'y3RnOaw5v.'),
+    ('This is just a test', '$6$rounds=5000$toolongsaltstring',
+     '$6$rounds=5000$toolongsaltstrin$lQ8jolhgVRVhY4b5pZKaysCLi0QBxGoNeKQzQ3glMhwllF7oGDZxUhx1yxdYcz/e1JSbq3y6JMxxl8'
+     'audkUEm0'),
+    ('a very much longer text to encrypt.  This one even stretches over morethan one line.',
+     '$6$rounds=1400$anotherlongsaltstring',
+     '$6$rounds=1400$anotherlongsalts$POfYwTEok97VWcjxIiSOjiykti.o/pQs.wPvMxQ6Fm7I6IoYN3CmLs66x9t0oSwbtEW7o7UmJEiDwGqd'
+     '8p4ur1'),
+    ('we have a short salt string but not a short password', '$6$rounds=77777$short',
+     '$6$rounds=77777$short$WuQyW2YR.hBNpjjRhpYD/ifIw05xdfeEyQoMxIXbkvr0gge1a1x3yRULJ5CCaUeOxFmtlcGZelFl5CxtgfiAc0'),
+    ('a short string', '$6$rounds=123456$asaltof16chars..',
+     '$6$rounds=123456$asaltof16chars..$BtCwjqMJGx5hrJhZywWvt0RLE8uZ4oPwcelCjmw2kSYu.Ec6ycULevoBK25fs2xXgMNrCzIMVcgEJAs'
+     'tJeonj1'),
+    ('the minimum number is still observed', '$6$rounds=10$roundstoolow',
+     '$6$rounds=1000$roundstoolow$kUMsbe306n21p9R.FRkW3IGn.S9NPN0x50YhH1xhLsPuWGsUSklZt58jaTfF4ZEQpyUNGc0dqbpBYYBaHHr'
+     'sX.'),
+])
+def test_sha512_crypt_glibc_vectors(password, setting, expected):
+    from fab.sha512crypt import sha512_crypt
+    assert sha512_crypt(password, setting) == expected
+
+
+def test_plaintext_passwords_hashed_in_pool(root):
+    from fab.sha512crypt import sha512_crypt
+    users = ''.join('user --name svc{0} --password secret{0}\n'.format(i) for i in range(4))
+    rc, output = kickstart(root, users, '--root', str(root), '--password-rounds', '1000', '--hash-workers', '2')
+    assert rc == 0, output
+    shadow = {entry[0]: entry[1] for entry in read(root, 'shadow')}
+    assert shadow['svc3'].startswith('$6$rounds=1000$')
+    assert sha512_crypt('secret3', shadow['svc3']) == shadow['svc3']
+
+
+def test_whitelist_checked_while_parsing(root):
+    content = ('# generated\ngroup --name fabbers\nlang en_US.UTF-8\n'
+               '%post\necho not a command\n%end\n'
+               '%onerror\nrm -rf /tmp/x\n%end\n')
+    rc, output = kickstart(root, content, '--root', str(root))
+    assert rc == 1
+    assert "Line 3: Warning: Unknown command 'lang'" in output
+    assert "Line 7: Warning: Unknown command '%onerror'" in output
+    assert 'echo' not in output and "'rm'" not in output
+    assert 'fabbers' not in (root / 'etc' / 'group').read_text()
+
+    rc, output = kickstart(root, content, '--root', str(root), '--ignore-unknown')
+    assert rc == 0, output
+    assert '(9 lines)' in output
+    assert 'fabbers' in (root / 'etc' / 'group').read_text()
+
+
+def package_manager(tmp_path):
+    calls = tmp_path / 'calls.jsonl'
+    script = tmp_path / 'dnf.py'
+    script.write_text('import json, sys\nwith open({!r}, "a") as f:\n    f.write(json.dumps(sys.argv[1:]) + "\\n")\n'
+                      .format(str(calls)))
+    return '{} {}'.format(sys.executable, script), calls
+
+
+def test_per_command_user_lock(root, tmp_path, monkeypatch):
+    import json
+    calls = tmp_path / 'calls.jsonl'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for tool in ('groupadd', 'useradd', 'usermod'):
+        script = bin_dir / tool
+        script.write_text('#!{}\nimport json, sys\nwith open({!r}, "a") as f:\n'
+                          '    f.write(json.dumps(sys.argv) + "\\n")\n'.format(sys.executable, str(calls)))
+        script.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_dir, os.environ['PATH']))
+    monkeypatch.setattr(os, 'geteuid', lambda: 0)
+    rc, output = kickstart(root, 'user --name foo --lock\nuser --name bar\n', '--root', str(root), '--per-command',
+                           '--no-journal')
+    assert rc == 0, output
+    commands = [[os.path.basename(call[0])] + call[1:] for call in map(json.loads, calls.read_text().splitlines())]
+    assert commands == [['useradd', '--root', str(root), 'foo'], ['usermod', '--root', str(root), '--lock', 'foo'],
+                        ['useradd', '--root', str(root), 'bar']]
+
+
+def test_packages_installed_in_one_transaction(root, tmp_path):
+    import json
+    command, calls = package_manager(tmp_path)
+    cache = tmp_path / 'cache'
+    content = ('%packages --excludedocs --exclude-weakdeps\n@^minimal-environment\n@container-tools\n'
+               'vim-enhanced\ntmux\n-nano\n%end\n')
+    args = ('--root', str(root), '--package-manager', command, '--package-cache', str(cache), '--no-journal')
+    rc, output = kickstart(root, content, *args)
+    assert rc == 0, output
+    rc, output = kickstart(root, content, *args)
+    assert rc == 0, output
+    first, second = [json.loads(line) for line in calls.read_text().splitlines()]
+    assert first[:4] == ['install', '-y', '--installroot', str(root)]
+    assert '--setopt=cachedir={}'.format(cache) in first and '--setopt=keepcache=True' in first
+    assert '--setopt=tsflags=nodocs' in first and '--setopt=install_weak_deps=False' in first
+    assert '--exclude=nano' in first
+    assert first[first.index('--') + 1:] == ['@^minimal-environment', '@container-tools', 'tmux', 'vim-enhanced']
+    # the first transaction refreshed the metadata in the shared cache
+    assert '--setopt=*.metadata_expire=-1' not in first
+    assert '--setopt=*.metadata_expire=-1' in second
+
+    rc, output = kickstart(root, content, *args, '--metadata-max-age', '0')
+    assert rc == 0, output
+    assert '--setopt=*.metadata_expire=-1' not in json.loads(calls.read_text().splitlines()[-1])
+
+    rc, output = kickstart(root, content, *args, '--dry-run')
+    assert rc == 0, output
+    assert 'Package transaction:' in output and 'vim-enhanced' in output
+    assert len(calls.read_text().splitlines()) == 3
+
+
+def test_journal_skips_applied_steps(root, tmp_path):
+    import json
+    command, calls = package_manager(tmp_path)
+    content = ('%pre\necho pre >> {0}/pre.log\n%end\n'
+               '%packages\ntmux\n%end\n'
+               'group --name fabbers\nuser --name foo1\n'
+               '%post --nochroot --log {0}/post.log\necho root=$FAB_ROOT\n%end\n'
+               '%post --nochroot --erroronfail\ntest -e {0}/ready\n%end\n').format(tmp_path)
+    args = ('--root', str(root), '--package-manager', command, '--package-cache', str(tmp_path / 'cache'))
+    rc, output = kickstart(root, content, *args)
+    assert rc == 1
+    assert 'script from line 12 failed with exit status 1' in output
+    journal = [json.loads(line) for line in (root / 'var' / 'lib' / 'fab' / 'kickstart.journal').read_text()
+               .splitlines()]
+    assert [(entry['kind'], entry['status']) for entry in journal] == [
+        ('%pre', 0), ('%packages', 0), ('group', 0), ('user', 0), ('%post', 0), ('%post', 1)]
+    assert (tmp_path / 'post.log').read_text() == 'root={}\n'.format(root)
+
+    # the rerun only repeats the failed script
+    (tmp_path / 'ready').write_text('')
+    rc, output = kickstart(root, content, *args)
+    assert rc == 0, output
+    assert output.count('already applied') == 5
+    assert (tmp_path / 'pre.log').read_text() == 'pre\n'
+    assert len(calls.read_text().splitlines()) == 1
+    assert [entry[0] for entry in read(root, 'passwd')].count('foo1') == 1
+
+
+def test_script_timeout(root, tmp_path):
+    rc, output = kickstart(root, '%post --nochroot --erroronfail\nsleep 5\n%end\n',
+                           '--root', str(root), '--script-timeout', '1')
+    assert rc == 1
+    assert 'timed out after 1s' in output and 'exit status 124' in output
+
+
+def test_emit_containerfile_module(root, tmp_path):
+    from fab.context import context_files
+    from fab.module import FabModule
+    content = ('%packages\n@container-tools\nvim\n-nano\n%end\n'
+               'user --name foo --groups dev --password secret --lock\ngroup --name dev --gid 2000\n'
+               '%post --log /var/log/post.log\necho FAB_SCRIPT\n%end\n')
+    rc, output = kickstart(tmp_path, content, '--emit-containerfile', '--password-rounds', '1000')
+    assert rc == 0
+    assert output.startswith('# Generated by fab kickstart --emit-containerfile from test.ks\n')
+    instructions = output.split('\n\n')
+    assert instructions[1] == 'FROM registry.fedoraproject.org/fedora-bootc:latest'
+    assert instructions[2].startswith('RUN --mount=type=cache,target=/var/cache/fab-packages,sharing=locked '
+                                      'dnf install -y --setopt=cachedir=/var/cache/fab-packages')
+    assert instructions[2].endswith('--exclude=nano -- @container-tools vim')
+    # groups before users, each set in one layer
+    assert instructions[3] == 'RUN groupadd -g 2000 dev'
+    assert instructions[4].startswith("RUN useradd --password '$6$rounds=1000$")
+    assert instructions[4].endswith('--groups dev foo && \\\n    usermod --lock foo')
+    assert 'secret' not in output
+    # a salt derived from the Kickstart: compiling again gives the same Containerfile
+    assert kickstart(tmp_path, content, '--emit-containerfile', '--password-rounds', '1000') == (rc, output)
+    assert instructions[5] == ("RUN /bin/sh <<'FAB_SCRIPT' >> /var/log/post.log 2>&1 || true\n"
+                               "echo FAB_SCRIPT\nFAB_SCRIPT\n")
+
+    rc, output = kickstart(tmp_path, content, '--emit-containerfile', str(tmp_path / 'modules') + os.sep)
+    assert rc == 0, output
+    module = FabModule(str(tmp_path / 'modules' / 'test.yaml'))
+    assert module.name == 'test'
+    assert module.containerfile_path.read_text().count('RUN ') == 4
+    assert context_files(module) == ['test.Containerfile']
+
+
+def test_bulk_validation_report(tmp_path):
+    import json
+    import xml.etree.ElementTree as ElementTree
+    tree = tmp_path / 'ks'
+    (tree / 'nested').mkdir(parents=True)
+    for i in range(6):
+        # the same user in every file: each file is parsed with a clean handler
+        (tree / 'nested' / 'valid{}.ks'.format(i)).write_text('user --name foo\ngroup --name fabbers\n')
+    (tree / 'unknown.ks').write_text('user --name foo\nlang en_US.UTF-8\n')
+    (tree / 'broken.ks').write_text('user --bogus\n')
+    (tree / 'notes.txt').write_text('lang en_US.UTF-8\n')
+    report = tmp_path / 'report.json'
+    sys.argv = ['fab', 'kickstart', '--dry-run', str(tree), str(tmp_path / 'missing.ks'),
+                '--jobs', '2', '--report', str(report)]
+    assert main() == 1
+    data = json.loads(report.read_text())
+    results = {os.path.relpath(result['file'], tmp_path): result for result in data['results']}
+    assert sorted(results) == ['ks/broken.ks', 'ks/nested/valid0.ks', 'ks/nested/valid1.ks', 'ks/nested/valid2.ks',
+                               'ks/nested/valid3.ks', 'ks/nested/valid4.ks', 'ks/nested/valid5.ks', 'ks/unknown.ks',
+                               'missing.ks']
+    assert (data['files'], data['failures'], data['errors']) == (9, 1, 2)
+    assert results['ks/unknown.ks']['violations'] == ["Line 2: Warning: Unknown command 'lang' - not in valid list"]
+    assert 'required: --name' in results['ks/broken.ks']['error']
+    assert results['missing.ks']['error'] == 'Kickstart file not found'
+    assert all(results['ks/nested/valid{}.ks'.format(i)]['error'] is None and
+               not results['ks/nested/valid{}.ks'.format(i)]['violations'] for i in range(6))
+
+    report = tmp_path / 'report.xml'
+    sys.argv = ['fab', 'kickstart', '--dry-run', str(tree / '**' / 'valid*.ks'), str(tree / 'unknown.ks'),
+                '--ignore-unknown', '--report', str(report)]
+    assert main() == 0
+    suite = ElementTree.parse(str(report)).getroot()
+    assert (suite.get('tests'), suite.get('failures'), suite.get('errors')) == ('7', '0', '0')
+
+    sys.argv = ['fab', 'kickstart', str(tree)]
+    assert main() == 1
@@ -0,0 +1,165 @@
+"""
+Tests for the `fab serve` daemon and the `fab --remote` client.
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from fab.server import FabClient, ServerError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = os.path.join(ROOT, 'samples')
+FAKE_PODMAN = os.path.join(ROOT, 'tests', 'fake_podman.py')
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Start `fab serve` on a socket in tmp_path; returns a function taking extra environment."""
+    servers = []
+
+    def start(jobs=1, **env):
+        socket_path = str(tmp_path / 'fab.sock')
+        environ = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=str(tmp_path / 'cache'),
+                       FAKE_PODMAN_STATE=str(tmp_path / 'podman.json'), **env)
+        process = subprocess.Popen([sys.executable, '-m', 'fab', 'serve', '--socket', socket_path,
+                                    '--jobs', str(jobs)], env=environ, stdout=subprocess.DEVNULL)
+        servers.append(process)
+        for _ in range(200):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        return FabClient(socket_path)
+
+    yield start
+    for process in servers:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def test_remote_kickstart_runs_in_client_cwd(serve, tmp_path):
+    client = serve()
+    (tmp_path / 'test.ks').write_text('group --name fabbers\nlang en_US\n')
+    output = io.StringIO()
+    assert client.run(['kickstart', 'test.ks', '--dry-run'], cwd=str(tmp_path), stream=output) == 1
+    assert "Line 2: Warning: Unknown command 'lang'" in output.getvalue()
+
+    output = io.StringIO()
+    rc = client.run(['kickstart', 'test.ks', '--dry-run', '--ignore-unknown'], cwd=str(tmp_path), stream=output)
+    assert rc == 0
+    assert 'Dry run mode' in output.getvalue()
+
+
+def test_remote_build_and_cli_client(serve, tmp_path):
+    client = serve()
+    shutil.copytree(os.path.join(SAMPLES, 'modules'), tmp_path / 'modules')
+    shutil.copy(os.path.join(SAMPLES, 'Fabfile.example'), tmp_path / 'Fabfile')
+    result = subprocess.run([sys.executable, '-m', 'fab', '--remote', client.socket_path, 'build', 'Fabfile',
+                             '--container-tool', FAKE_PODMAN], cwd=tmp_path, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'COMMIT fabrules-stage-dnf-install' in result.stdout
+    with open(tmp_path / 'podman.json') as f:
+        assert sum(1 for call in json.load(f)['calls'] if 'build' in call) == 2
+
+
+def test_cancel_running_and_queued_jobs(serve, tmp_path):
+    client = serve(FAKE_PODMAN_SLEEP='30')
+    shutil.copytree(os.path.join(SAMPLES, 'modules'), tmp_path / 'modules')
+    shutil.copy(os.path.join(SAMPLES, 'Fabfile.example'), tmp_path / 'Fabfile')
+    results = {}
+
+    def run(name):
+        results[name] = client.run(['build', 'Fabfile', '--container-tool', FAKE_PODMAN],
+                                   cwd=str(tmp_path), stream=io.StringIO())
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.5)
+    jobs = client.status()
+    assert [job['status'] for job in jobs] == ['running', 'queued']
+    start = time.monotonic()
+    for job in reversed(jobs):
+        assert client.cancel(job['job'])
+    for thread in threads:
+        thread.join(timeout=10)
+    assert time.monotonic() - start < 10
+    assert results == {'first': 143, 'second': 143}
+    assert client.status() == []
+
+
+def test_client_without_server(tmp_path):
+    with pytest.raises(ServerError):
+        FabClient(str(tmp_path / 'missing.sock')).status()
+
+
+def test_output_split_inside_a_character_is_decoded_whole(tmp_path):
+    import selectors
+    from fab.server import FabServer, Job
+
+    class Recorder:
+        outgoing = b''
+
+        def __init__(self):
+            self.messages = []
+
+        def send(self, message):
+            self.messages.append(message)
+
+    server = FabServer(str(tmp_path / 'fab.sock'))
+    server.selector = selectors.DefaultSelector()
+    client = Recorder()
+    job = Job(1, [], '/', client)
+    read_fd, write_fd = os.pipe()
+    # one ASCII byte first, so the 64 KiB reads end in the middle of a two byte character
+    process = subprocess.Popen([sys.executable, '-c', 'import sys; sys.stdout.buffer.write(("a" + "é" * 100000)'
+                                '.encode())'], stdout=write_fd)
+    os.close(write_fd)
+    job.pid, job.output, job.status = process.pid, read_fd, 'running'
+    job.state_path = str(tmp_path / '1.state')
+    server.running[job.id] = job
+    server.selector.register(read_fd, selectors.EVENT_READ, ('job', job))
+    while job.status != 'done':
+        server._read_job(job)
+    output = ''.join(message.get('output', '') for message in client.messages)
+    assert output == 'a' + 'é' * 100000
+    assert client.messages[-1] == {'job': 1, 'exit': 0}
+
+
+def test_stalled_client_does_not_block_the_daemon():
+    import selectors
+    import socket
+    from fab.server import Client
+    selector = selectors.DefaultSelector()
+    conn, peer = socket.socketpair()
+    conn.setblocking(False)
+    selector.register(conn, selectors.EVENT_READ, None)
+    client = Client(conn, selector)
+    start = time.monotonic()
+    for index in range(200):
+        client.send({'job': 1, 'output': '{:06}'.format(index) * 10000})
+    # nothing reads the peer: what does not fit is kept and the socket watched for writability
+    assert time.monotonic() - start < 1
+    assert client.outgoing and selector.get_key(conn).events == selectors.EVENT_READ | selectors.EVENT_WRITE
+
+    received = b''
+    peer.setblocking(False)
+    while received.count(b'\n') < 200:
+        client.flush()
+        try:
+            received += peer.recv(1024 * 1024)
+        except BlockingIOError:
+            pass
+    assert selector.get_key(conn).events == selectors.EVENT_READ
+    lines = received.splitlines()
+    assert len(lines) == 200 and json.loads(lines[-1]) == {'job': 1, 'output': '000199' * 10000}
+    conn.close()
+    peer.close()
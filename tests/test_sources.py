@@ -0,0 +1,83 @@
+"""
+Tests for remote module sources, against a local http.server and a local bare git repository.
+"""
+
+import functools
+import http.server
+import os
+import shutil
+import subprocess
+import threading
+
+import pytest
+
+from fab.fabfile import FabFile
+from fab.sources import SourceCache, SourceError
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+
+@pytest.fixture
+def modules(tmp_path):
+    shutil.copytree(os.path.join(SAMPLES, 'modules'), tmp_path / 'modules')
+    return tmp_path / 'modules'
+
+
+@pytest.fixture
+def server(modules):
+    """Serve the modules directory over HTTP, recording every request."""
+    requests = []
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests.append((self.path, self.headers.get('If-Modified-Since')))
+            return super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(modules)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1]), requests
+    httpd.shutdown()
+
+
+def test_http_source_revalidates_and_works_offline(tmp_path, server):
+    url, requests = server
+    path = SourceCache(tmp_path / 'cache').fetch(url + '/ssh/ssh.yaml')
+    assert os.path.basename(path) == 'ssh.yaml'
+    assert os.path.exists(os.path.join(os.path.dirname(path), 'Containerfile'))
+    assert [request[0] for request in requests] == ['/ssh/ssh.yaml', '/ssh/Containerfile']
+
+    # a new run revalidates with conditional requests and lands on the same directory
+    assert SourceCache(tmp_path / 'cache').fetch(url + '/ssh/ssh.yaml') == path
+    assert all(since is not None for _, since in requests[2:])
+
+    offline = SourceCache(tmp_path / 'cache', offline=True)
+    assert offline.fetch(url + '/ssh/ssh.yaml') == path
+    assert len(requests) == 4
+    with pytest.raises(SourceError):
+        offline.fetch(url + '/dnf/install.yaml')
+
+
+def test_git_source_in_fabfile(tmp_path, modules, monkeypatch):
+    work = tmp_path / 'work'
+    shutil.copytree(modules, work)
+
+    def git(*args, cwd=work):
+        subprocess.run(['git', '-c', 'user.name=fab', '-c', 'user.email=fab@example.com'] + list(args),
+                       cwd=cwd, check=True, capture_output=True)
+    git('init', '-q')
+    git('add', '.')
+    git('commit', '-q', '-m', 'modules')
+    git('clone', '-q', '--bare', str(work), str(tmp_path / 'modules.git'), cwd=tmp_path)
+
+    repo = 'git+file://{}'.format(tmp_path / 'modules.git')
+    (tmp_path / 'Fabfile').write_text(
+        'metadata:\n  name: remote\nfrom: quay.io/centos-bootc/centos-bootc:stream9\ninclude:\n'
+        '  - {0}#ssh/ssh.yaml\n  - {0}?ref=HEAD#dnf/install.yaml\n'.format(repo))
+    fabfile = FabFile(str(tmp_path / 'Fabfile'), sources=SourceCache(tmp_path / 'cache'))
+    assert [module.name for module in fabfile.includes] == ['ssh', 'dnf-install']
+    assert fabfile.includes[0].origin == repo + '#ssh/ssh.yaml'
+    assert fabfile.includes[1].containerfile_path.exists()